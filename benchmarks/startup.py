@@ -0,0 +1,97 @@
+"""
+Measures the startup time of psync, i.e. the wall time of commands which do not transfer anything.
+
+    python benchmarks/startup.py [--runs 10] [--replicas 20]
+
+Each command is run `runs` times with a cold cache (first run, the config is parsed by OmegaConf) and with a warm
+one (the compiled config is read from the cache). A throwaway project and cache folder are used, so that your own
+config and cache are left untouched.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+COMMANDS = [
+    ["--help"],
+    ["replicas", "list"],
+    ["push", "--help"],
+]
+
+
+def write_project(root: Path, n_replicas: int):
+    lines = ["general:", "  local: local", "  remote: replica0", "replicas:"]
+    lines += ["  local:", f"    path: {root}", "    host:", "      hostname: localhost"]
+    lines += ["      user: user", "      port: 22"]
+
+    for i in range(n_replicas):
+        lines += [f"  replica{i}:", f"    path: /tmp/replica{i}", "    host:"]
+        lines += [f"      hostname: 10.0.0.{i % 256}", "      user: user"]
+        lines += [f"      port: {2200 + i}"]
+
+    (root / ".psync.yml").write_text("\n".join(lines) + "\n")
+
+
+def run(command, cwd: Path, env) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "psync.application"] + command,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return time.perf_counter() - start
+
+
+def imports_omegaconf(command, cwd: Path, env) -> bool:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "psync.application"] + command,
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    return "omegaconf" in result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--replicas", type=int, default=20)
+    args = parser.parse_args()
+
+    package_root = Path(__file__).absolute().parent.parent
+
+    with tempfile.TemporaryDirectory() as tmp:
+        project, cache = Path(tmp) / "project", Path(tmp) / "cache"
+        project.mkdir()
+        write_project(project, args.replicas)
+
+        env = dict(os.environ, XDG_CACHE_HOME=str(cache), PYTHONPATH=str(package_root))
+        env.pop("PSYNC_LOCAL_PROJECT", None)
+
+        print(f"{'command':<20} {'cold (ms)':>10} {'warm (ms)':>10}  omegaconf (warm)")
+        for command in COMMANDS:
+            cold, warm = [], []
+            for _ in range(args.runs):
+                subprocess.run(["rm", "-rf", str(cache)])
+                cold.append(run(command, project, env))
+                warm.append(run(command, project, env))
+
+            print(
+                f"{' '.join(command):<20} "
+                f"{statistics.median(cold) * 1000:>10.1f} "
+                f"{statistics.median(warm) * 1000:>10.1f}  "
+                f"{'yes' if imports_omegaconf(command, project, env) else 'no'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""
+Measures the throughput and latency of psync push/pull on synthetic projects.
+
+    python benchmarks/transfers.py [--runs 3] [--scale 1.0] [--scenarios tiny huge deep mixed]
+                                   [--transport shim|ssh|local] [--output results.json]
+                                   [--baseline benchmarks/baseline.json] [--save-baseline] [--threshold 0.2]
+
+Each scenario generates a project tree (seeded, so every run sees the same layout and data) and synchronizes it with a
+stand-in replica in a temporary folder, through the following steps:
+
+    push-cold      first push to an empty replica, with an empty psync cache
+    push-warm      push again, with nothing changed
+    push-modified  push after rewriting part of the files
+    pull-cold      pull into an empty clone of the project
+    pull-warm      pull again, with nothing changed
+
+For each step, the wall time of psync, the time spent in rsync (as logged in .psync/transfers.jsonl), psync's own
+overhead (the difference between the two), the number of ssh/rsync processes spawned and the bytes sent over the
+connection are reported. With `--transport shim` (the default), `ssh` is replaced by a script which runs the remote
+side of rsync locally, so no SSH server is needed; `--transport ssh` goes through the SSH server on localhost instead
+(which must accept key-based logins for the current user). Both disable the direct copy of replicas on this machine,
+which `--transport local` measures.
+
+Results can be stored with `--save-baseline` (in benchmarks/baseline.json, or `--baseline`) and are then compared
+against by later runs: the exit code is 1 when any step got slower than the baseline by more than `--threshold`. The
+baseline is specific to the machine, so none is committed: a `--baseline` which does not exist is an error, and runs
+without any baseline only print their results.
+"""
+
+import argparse
+import getpass
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+MB = 1000 * 1000
+DEFAULT_BASELINE = Path(__file__).absolute().parent / "baseline.json"
+
+# replaces ssh: skips its options and the destination, then runs the remote command locally
+SSH_SHIM = """#!{python}
+import os, sys
+
+OPTIONS_WITH_ARGUMENT = set("bcDEeFIiJLlmOopQRSWw")
+
+args = sys.argv[1:]
+if "-G" in args:
+    print("hostname localhost\\nuser {user}\\nport 22")
+    sys.exit(0)
+if "-O" in args:
+    sys.exit(1)
+
+while args and args[0].startswith("-"):
+    option = args.pop(0)
+    if len(option) == 2 and option[1] in OPTIONS_WITH_ARGUMENT:
+        args.pop(0)
+args = args[1:]  # the destination
+
+os.execvp("sh", ["sh", "-c", " ".join(args)])
+"""
+
+# wraps ssh/rsync, counting how many times they are spawned
+COUNTING_WRAPPER = """#!/bin/sh
+echo {name} >> "$PSYNC_BENCH_SPAWNS"
+exec {target} "$@"
+"""
+
+
+def random_bytes(rng: random.Random, size: int) -> bytes:
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size > 0 else b""
+
+
+def write_file(path: Path, rng: random.Random, size: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, MB)
+            f.write(random_bytes(rng, chunk))
+            remaining -= chunk
+
+
+def tiny_tree(root: Path, rng: random.Random, scale: float):
+    for i in range(int(2000 * scale)):
+        write_file(root / f"dir{i % 50}" / f"file{i}.txt", rng, rng.randint(10, 2000))
+
+
+def huge_tree(root: Path, rng: random.Random, scale: float):
+    for i in range(3):
+        write_file(root / f"blob{i}.bin", rng, int(64 * MB * scale))
+
+
+def deep_tree(root: Path, rng: random.Random, scale: float):
+    for branch in range(max(1, int(10 * scale))):
+        path = root / f"branch{branch}"
+        for depth in range(30):
+            path = path / f"level{depth}"
+            write_file(path / "file.txt", rng, rng.randint(100, 5000))
+
+
+def mixed_tree(root: Path, rng: random.Random, scale: float):
+    tiny_tree(root / "src", rng, scale / 4)
+    deep_tree(root / "nested", rng, scale / 5)
+    for i in range(int(20 * scale)):
+        write_file(root / "data" / f"chunk{i}.bin", rng, rng.randint(1, 8) * MB)
+
+
+SCENARIOS: Dict[str, Callable[[Path, random.Random, float], None]] = {
+    "tiny": tiny_tree,
+    "huge": huge_tree,
+    "deep": deep_tree,
+    "mixed": mixed_tree,
+}
+
+
+def modify_tree(root: Path, rng: random.Random, fraction: float = 0.1):
+    """Rewrites a block in the middle of a fraction of the files, leaving their size as it is."""
+    files = sorted(
+        path
+        for path in root.rglob("*")
+        if path.is_file() and ".psync" not in path.parts
+    )
+    for path in rng.sample(files, max(1, int(len(files) * fraction))):
+        size = path.stat().st_size
+        block = min(size, 4096)
+        with path.open("r+b") as f:
+            f.seek(rng.randint(0, size - block))
+            f.write(random_bytes(rng, block))
+
+
+def write_config(project: Path, replica: Path):
+    user = getpass.getuser()
+    lines = ["general:", "  local: local", "  remote: bench", "  multiplex: false"]
+    lines += ["replicas:"]
+    for alias, path in [("local", project), ("bench", replica)]:
+        lines += [f"  {alias}:", f"    path: {path}", "    host:"]
+        lines += ["      hostname: localhost", f"      user: {user}", "      port: 22"]
+    (project / ".psync.yml").write_text("\n".join(lines) + "\n")
+
+
+def install_shims(bin_dir: Path, transport: str):
+    bin_dir.mkdir()
+    targets = {"rsync": shutil.which("rsync"), "ssh": shutil.which("ssh")}
+    if targets["rsync"] is None:
+        sys.exit("rsync is required to run the benchmarks")
+
+    if transport == "local":
+        # psync copies the files itself, without ssh
+        del targets["ssh"]
+    elif transport == "shim":
+        shim = bin_dir / "ssh-shim"
+        shim.write_text(SSH_SHIM.format(python=sys.executable, user=getpass.getuser()))
+        shim.chmod(0o755)
+        targets["ssh"] = str(shim)
+    elif targets["ssh"] is None:
+        sys.exit("ssh is required to run the benchmarks with --transport ssh")
+
+    for name, target in targets.items():
+        wrapper = bin_dir / name
+        wrapper.write_text(COUNTING_WRAPPER.format(name=name, target=target))
+        wrapper.chmod(0o755)
+
+
+class Bench:
+    def __init__(self, tmp: Path, transport: str, package_root: Path):
+        self.tmp = tmp
+        self.cache = tmp / "cache"
+        self.spawns = tmp / "spawns"
+
+        bin_dir = tmp / "bin"
+        install_shims(bin_dir, transport)
+
+        self.env = dict(
+            os.environ,
+            PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+            PYTHONPATH=str(package_root),
+            XDG_CACHE_HOME=str(self.cache),
+            PSYNC_BENCH_SPAWNS=str(self.spawns),
+        )
+        for name in ["PSYNC_LOCAL_PROJECT", "PSYNC_ASK_CONFIRM", "PSYNC_DEBUG"]:
+            self.env.pop(name, None)
+        # localhost would be copied to directly otherwise
+        self.env["PSYNC_BYPASS_LOCAL_SSH"] = "true" if transport == "local" else "false"
+
+    def psync(self, project: Path, *args) -> dict:
+        log = project / ".psync" / "transfers.jsonl"
+        n_records = len(log.read_text().splitlines()) if log.exists() else 0
+        self.spawns.write_text("")
+
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "psync.application", *args],
+            cwd=project,
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        wall = time.perf_counter() - start
+
+        records = []
+        if log.exists():
+            records = [json.loads(line) for line in log.read_text().splitlines()]
+        records = records[n_records:]
+
+        rsync = sum(record["wall_time"] for record in records)
+        return dict(
+            wall=wall,
+            rsync=rsync,
+            overhead=wall - rsync,
+            spawns=len(self.spawns.read_text().splitlines()),
+            bytes=sum(r["bytes_sent"] + r["bytes_received"] for r in records),
+        )
+
+    def run_scenario(self, name: str, scale: float) -> Dict[str, dict]:
+        rng = random.Random(name)
+        root = self.tmp / name
+        project, replica, clone = root / "project", root / "replica", root / "clone"
+
+        project.mkdir(parents=True)
+        SCENARIOS[name](project, rng, scale)
+        write_config(project, replica)
+        replica.mkdir()
+
+        shutil.rmtree(self.cache, ignore_errors=True)
+        results = {"push-cold": self.psync(project, "push", "bench")}
+        results["push-warm"] = self.psync(project, "push", "bench")
+
+        modify_tree(project, rng)
+        results["push-modified"] = self.psync(project, "push", "bench")
+
+        clone.mkdir()
+        write_config(clone, replica)
+        shutil.rmtree(self.cache, ignore_errors=True)
+        results["pull-cold"] = self.psync(clone, "pull", "bench")
+        results["pull-warm"] = self.psync(clone, "pull", "bench")
+
+        shutil.rmtree(root)
+        return results
+
+
+def median_results(runs: List[Dict[str, dict]]) -> Dict[str, dict]:
+    return {
+        step: {
+            metric: statistics.median(run[step][metric] for run in runs)
+            for metric in runs[0][step]
+        }
+        for step in runs[0]
+    }
+
+
+def print_results(results: Dict[str, Dict[str, dict]], baseline: dict):
+    header = ("scenario", "step", "wall (ms)", "rsync (ms)", "overhead (ms)")
+    header += ("spawns", "bytes", "vs baseline")
+    rows = []
+
+    for scenario, steps in results.items():
+        for step, metrics in steps.items():
+            reference = baseline.get(scenario, {}).get(step)
+            delta = ""
+            if reference is not None and reference["wall"] > 0:
+                delta = f"{(metrics['wall'] / reference['wall'] - 1) * 100:+.1f}%"
+
+            rows.append(
+                (
+                    scenario,
+                    step,
+                    f"{metrics['wall'] * 1000:.1f}",
+                    f"{metrics['rsync'] * 1000:.1f}",
+                    f"{metrics['overhead'] * 1000:.1f}",
+                    f"{metrics['spawns']:g}",
+                    f"{metrics['bytes']:.0f}",
+                    delta,
+                )
+            )
+
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def regressions(results, baseline, threshold: float) -> List[str]:
+    slower = []
+    for scenario, steps in results.items():
+        for step, metrics in steps.items():
+            reference = baseline.get(scenario, {}).get(step)
+            if reference is not None and metrics["wall"] > reference["wall"] * (
+                1 + threshold
+            ):
+                slower.append(f"{scenario}/{step}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument(
+        "--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS
+    )
+    parser.add_argument("--transport", choices=["shim", "ssh", "local"], default="shim")
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # checked before the (long) runs: comparing against a baseline which does not exist would always pass
+    compare = not args.save_baseline and (
+        args.baseline is not None or DEFAULT_BASELINE.exists()
+    )
+    if args.baseline is None:
+        args.baseline = DEFAULT_BASELINE
+    if compare and not args.baseline.exists():
+        sys.exit(f"No baseline at {args.baseline}: save one first with --save-baseline")
+
+    package_root = Path(__file__).absolute().parent.parent
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        bench = Bench(Path(tmp), args.transport, package_root)
+        for scenario in args.scenarios:
+            runs = [bench.run_scenario(scenario, args.scale) for _ in range(args.runs)]
+            results[scenario] = median_results(runs)
+
+    baseline = {}
+    if compare:
+        baseline = json.loads(args.baseline.read_text())
+
+    print_results(results, baseline)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"\nBaseline saved to {args.baseline}")
+        return
+    if not compare:
+        print(
+            f"\nNo baseline at {args.baseline} to compare with (save one with --save-baseline)."
+        )
+        return
+
+    slower = regressions(results, baseline, args.threshold)
+    if len(slower) > 0:
+        print(
+            f"\nSlower than the baseline by more than {args.threshold:.0%}: {', '.join(slower)}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
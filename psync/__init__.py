@@ -1,3 +1,4 @@
-from psync.config import get_config
+from psync.config import LazyPsyncConfig
 
-config = get_config()
+# loaded on first access
+config = LazyPsyncConfig()
@@ -1,11 +1,26 @@
+import importlib
+import sys
+import time
 from typing import Dict, Union, Type
 
 from jsonargparse import ArgumentParser
 
 from psync.command import PsyncBaseCommand
-from psync.init import InitCommand
-from psync.push_pull import PushCommand, PullCommand
-from psync.replicas import PsyncReplicasCommand
+from psync.profiling import STARTUP, enable_from_argv, profiler, span
+
+# command name -> (module, attribute), so that only the modules of the command being run are imported
+COMMANDS = {
+    "replicas": ("psync.replicas", "PsyncReplicasCommand"),
+    "init": ("psync.init", "InitCommand"),
+    "push": ("psync.push_pull", "PushCommand"),
+    "pull": ("psync.push_pull", "PullCommand"),
+    "plan": ("psync.push_pull", "PlanCommand"),
+    "sync": ("psync.sync", "SyncCommand"),
+    "broadcast": ("psync.broadcast", "BroadcastCommand"),
+    "snapshots": ("psync.snapshots", "PsyncSnapshotsCommand"),
+    "verify": ("psync.verify", "VerifyCommand"),
+    "watch": ("psync.watch", "WatchCommand"),
+}
 
 
 class PsyncApplication:
@@ -21,7 +36,8 @@ class PsyncApplication:
         return parser
 
     def run(self):
-        args = self.get_parser().parse_args()
+        with span("parse arguments", STARTUP):
+            args = self.get_parser().parse_args()
         command = args.cmd
         command_config = getattr(args, command)
         self.commands[command].run(command_config)
@@ -41,13 +57,33 @@ class PsyncApplication:
         return instance
 
 
+def load_command(name: str) -> Union[Type[PsyncBaseCommand], PsyncBaseCommand]:
+    module, attribute = COMMANDS[name]
+    return getattr(importlib.import_module(module), attribute)
+
+
 def run():
-    PsyncApplication.create(
-        PsyncReplicasCommand,
-        InitCommand,
-        PushCommand,
-        PullCommand,
-    ).run()
+    # --profile is accepted by every command (see psync.profiling)
+    profiling = enable_from_argv(sys.argv)
+
+    # all the commands are needed only to print the help (or an error)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        names = [sys.argv[1]]
+    else:
+        names = list(COMMANDS)
+
+    try:
+        with span("import commands", STARTUP):
+            commands = [load_command(name) for name in names]
+        PsyncApplication.create(*commands).run()
+    finally:
+        if profiling:
+            from psync.runner import process_stats
+
+            total = time.perf_counter() - profiler.start
+            path = profiler.write(names[0] if len(names) == 1 else "psync")
+            profiler.print_summary(total, process_stats())
+            print(f"\nTrace written to {path} (open it with https://ui.perfetto.dev)")
 
 
 if __name__ == "__main__":
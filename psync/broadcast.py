@@ -0,0 +1,453 @@
+import dataclasses
+import os
+import shlex
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from jsonargparse import ArgumentParser
+
+from psync import config as pconf
+from psync.config import PsyncReplicaConfig
+from psync.filters import walk
+from psync.probe import ReplicaProber
+from psync.push_pull import PushPullCommand, Transfer
+from psync.ssh_config import resolve_host
+from psync.telemetry import TransferStats, stream_transfer
+from psync.utils import format_duration, format_size, write_files_from
+
+DEFAULT_FANOUT = 2
+MAX_ATTEMPTS = 2  # per replica, each time from a different sender
+LOCAL = "local"  # the sender of the hops pushed from this machine
+
+
+class Hop(NamedTuple):
+    source: str  # alias of the sender
+    target: str
+    returncode: int
+    stats: TransferStats
+    elapsed: float
+
+
+def relay_options(target: Transfer) -> List[str]:
+    """
+    The options of the transfer to `target` (compression and the like) which still apply when run on another
+    replica: not the shell (its control socket is on this machine), nor the exclusions (the file lists already
+    account for them, and the merged filter file is here too).
+    """
+    options, skip = [], False
+    for option in target.options[1:]:
+        if skip:
+            skip = False
+        elif option in ("-e", "--exclude"):
+            skip = True
+        elif not option.startswith("--filter="):
+            options.append(option)
+    return options
+
+
+def hop_ssh(target: Transfer) -> List[str]:
+    """The ssh command run on another replica to reach `target`, with what our ssh config says about it."""
+    dst = target.host
+    # no password prompt can be answered from there
+    argv = ["ssh", "-p", str(dst.port), "-o", "BatchMode=yes"]
+    argv += ["-o", f"HostName={dst.hostname}"]
+
+    options = resolve_host(dst.host) if dst.host is not None else {}
+    if options.get("proxyjump", "none") != "none":
+        argv += ["-o", f"ProxyJump={options['proxyjump']}"]
+    # only an explicit one: ssh -G lists its defaults (~/.ssh/id_rsa, ...) otherwise, and the replica has its own
+    identity = options.get("identityfile", "")
+    if identity != "" and not identity.startswith("~/.ssh/id_"):
+        argv += ["-o", f"IdentityFile={identity}"]
+
+    return argv
+
+
+def relay_command(source: Transfer, target: Transfer) -> str:
+    """The rsync command run on the `source` replica to send the files listed on its stdin to `target`."""
+    src, dst = source.host, target.host
+    files = ["--from0", "--files-from=-"]
+
+    if source.same_host:
+        # sent from this machine, exactly as psync push does
+        return shlex.join(target.options + files + [source.remote_path, target.remote])
+
+    argv = ["rsync"] + relay_options(target) + files
+    if (src.hostname, src.user, src.port) == (dst.hostname, dst.user, dst.port):
+        # both replicas are on the same remote machine
+        destination = target.remote_path
+    else:
+        # through the alias, so that the config of the sender (if it knows it) applies as well
+        argv += ["-e", shlex.join(hop_ssh(target))]
+        destination = f"{dst.user}@{dst.host or dst.hostname}:{target.remote_path}"
+
+    return shlex.join(argv + [source.remote_path, destination])
+
+
+def can_reach(source: Transfer, target: Transfer) -> bool:
+    """Whether the `source` replica can open an SSH session to `target` without any prompt."""
+    src, dst = source.host, target.host
+    if source.same_host or (src.hostname, src.user, src.port) == (
+        dst.hostname,
+        dst.user,
+        dst.port,
+    ):
+        return True
+
+    command = hop_ssh(target) + [f"{dst.user}@{dst.host or dst.hostname}", "true"]
+    return source.host.run_remote(command, stdin=subprocess.DEVNULL, timeout=30).ok
+
+
+class Broadcast:
+    """
+    Distributes the files from a seed replica to the others along a tree: every replica which has them sends them
+    to up to `fanout` others at a time, as soon as it is free, so the copies grow geometrically and the wall time
+    with the logarithm of the number of replicas. Each hop is an rsync run on the sender (started over SSH from
+    here) which connects directly to the receiver, so the local uplink is only used for the seed (and for the
+    receivers which a sender cannot reach).
+    """
+
+    def __init__(
+        self,
+        seed: Transfer,
+        targets: List[Transfer],
+        paths: Dict[str, List[str]],
+        lists: Dict[str, str],
+        fanout: int = DEFAULT_FANOUT,
+    ):
+        self.transfers = {t.replica.alias: t for t in [seed] + targets}
+        self.seed = seed.replica.alias
+        self.targets = [t.replica.alias for t in targets]
+        # alias -> what it should receive, as a set and as a files-from list
+        self.paths = {alias: set(files) for alias, files in paths.items()}
+        self.lists = lists
+        self.fanout = fanout
+        self.hops: List[Hop] = []
+        self.failed: List[str] = []
+
+    def run(self) -> List[Hop]:
+        free = {self.seed: self.fanout}  # senders -> free slots
+        pending = deque(self.targets)
+        tried: Dict[str, List[str]] = {alias: [] for alias in self.targets}
+        running = {}
+
+        with ThreadPoolExecutor(max(len(self.targets), 1)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for sender in list(free):
+                    while free[sender] > 0:
+                        target = next(
+                            (
+                                t
+                                for t in pending
+                                if sender not in tried[t] and self.can_send(sender, t)
+                            ),
+                            None,
+                        )
+                        if target is None:
+                            break
+                        pending.remove(target)
+                        tried[target].append(sender)
+                        free[sender] -= 1
+                        running[executor.submit(self.relay, sender, target)] = (
+                            sender,
+                            target,
+                        )
+
+                if len(running) == 0:
+                    # no sender left for these replicas
+                    self.failed += list(pending)
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sender, target = running.pop(future)
+                    free[sender] += 1
+                    hop = future.result()
+                    self.hops.append(hop)
+                    self.print_hop(hop)
+
+                    if hop.returncode == 0:
+                        free[target] = self.fanout
+                    elif len(tried[target]) < MAX_ATTEMPTS:
+                        pending.append(target)
+                    else:
+                        self.failed.append(target)
+
+        return self.hops
+
+    def can_send(self, sender: str, target: str) -> bool:
+        source, destination = self.transfers[sender], self.transfers[target]
+        # a replica on this machine (maybe without a host) cannot be reached from another one, and a replica with
+        # more exclusions than the target does not have all of its files
+        return (source.same_host or not destination.same_host) and self.paths[
+            target
+        ] <= self.paths[sender]
+
+    def relay(self, sender: str, target: str) -> Hop:
+        source, destination = self.transfers[sender], self.transfers[target]
+        stats = TransferStats()
+
+        if not can_reach(source, destination):
+            print(
+                f"[{sender} -> {target}] {sender} cannot connect to {target} with SSH (without a prompt), "
+                f"pushing from here instead",
+                flush=True,
+            )
+            command = destination.command(self.lists[target], recursive=False)
+            returncode, _, stats, elapsed = stream_transfer(
+                command, capture_stderr=False
+            )
+            return Hop(LOCAL, target, returncode, stats, elapsed)
+
+        with open(self.lists[target], "rb") as files:
+            result = source.host.run_remote(
+                relay_command(source, destination),
+                stdin=files,
+                capture_stdout=False,
+                on_stdout=stats.feed,
+            )
+
+        if not result.ok:
+            print(f"[{sender} -> {target}] {result.stderr.strip()}")
+        return Hop(sender, target, result.returncode, stats, result.elapsed)
+
+    @staticmethod
+    def print_hop(hop: Hop):
+        status = "done" if hop.returncode == 0 else f"failed ({hop.returncode})"
+        print(
+            f"[{hop.source} -> {hop.target}] {status}: {format_size(hop.stats.transferred_size)} "
+            f"in {format_duration(hop.elapsed)}",
+            flush=True,
+        )
+
+
+class BroadcastCommand(PushPullCommand):
+    name = "broadcast"
+
+    def __init__(self):
+        super().__init__()
+        # the seed is pushed to, the others receive the files from the replicas
+        self.mode = "push"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser(
+            description="Pushes the current folder to many replicas, sending it only once: the seed replica "
+            "(the destination, or the fastest one) forwards it to the others, which in turn forward it to the rest."
+        )
+
+        self.add_transfer_arguments(parser)
+
+        parser.add_argument(
+            "--to",
+            default=None,
+            help="Comma-separated replicas to broadcast to (e.g., r1,r2,r3)",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Broadcast to all replicas (except the local one)",
+        )
+        parser.add_argument(
+            "--fanout",
+            type=int,
+            default=DEFAULT_FANOUT,
+            help="Number of replicas each replica sends the files to at the same time",
+        )
+        parser.add_argument(
+            "-n",
+            "--confirm",
+            action="store_true",
+            help="Print the replicas and the seed before execution",
+        )
+        parser.add_argument(
+            "--metrics-file",
+            default=None,
+            help="JSON-lines file where the statistics of each transfer are appended (defaults to "
+            ".psync/transfers.jsonl in the project)",
+        )
+
+        return parser
+
+    def run(self, config):
+        self.split_destination(config)
+
+        if config.debug:
+            print(config)
+
+        if config.delete:
+            print(
+                "psync broadcast only adds and updates files, use psync push --to/--all --delete to delete them."
+            )
+            exit(1)
+        if config.fanout < 1:
+            print("--fanout must be at least 1.")
+            exit(1)
+
+        replicas = self.replicas(config)
+        seed, targets = self.choose_seed(config, replicas)
+
+        seed_transfer = self.transfer(config, seed)
+        target_transfers = [self.transfer(config, replica) for replica in targets]
+
+        root = Path(seed_transfer.local)
+        files, invalid = self.split_files(config.files, root, True)
+        if len(invalid) > 0:
+            self.print_summary(len(config.files), invalid)
+            if len(files) == 0:
+                exit(1)
+
+        paths = self.file_lists(config, root, files, [seed] + targets)
+        lists = {alias: write_files_from(files) for alias, files in paths.items()}
+        try:
+            if self.should_confirm(config):
+                print(f"Seed: {seed.alias}, then {', '.join(r.alias for r in targets)}")
+                print(f"Up to {config.fanout} transfer(s) from each replica at a time.")
+                self.confirm()
+
+            start = time.perf_counter()
+            returncode = self.push_seed(config, seed_transfer, lists)
+            if returncode != 0:
+                exit(returncode)
+
+            broadcast = Broadcast(
+                seed_transfer, target_transfers, paths, lists, config.fanout
+            )
+            for hop in broadcast.run():
+                relayed = broadcast.transfers[hop.target]
+                if hop.source != LOCAL:
+                    relayed = dataclasses.replace(
+                        relayed, local=broadcast.transfers[hop.source].remote
+                    )
+                self.log_transfer(
+                    config,
+                    relayed,
+                    hop.returncode,
+                    hop.stats,
+                    hop.elapsed,
+                    label=f"broadcast-from-{hop.source}",
+                )
+        finally:
+            for files_from in lists.values():
+                os.remove(files_from)
+
+        n_done = len(targets) - len(broadcast.failed)
+        print(
+            f"Broadcast to {n_done + 1} out of {len(targets) + 1} replica(s) "
+            f"in {format_duration(time.perf_counter() - start)}."
+        )
+        if len(broadcast.failed) > 0:
+            print(f"Failed: {', '.join(broadcast.failed)}")
+            exit(1)
+
+    @staticmethod
+    def replicas(config) -> List[PsyncReplicaConfig]:
+        if config.all:
+            aliases = [alias for alias in pconf.aliases if alias != pconf.general.local]
+        elif config.to is not None:
+            aliases = [alias.strip() for alias in config.to.split(",") if alias]
+        else:
+            print("Choose the replicas to broadcast to with --to or --all.")
+            exit(1)
+
+        if config.destination is not None and config.destination not in aliases:
+            aliases.insert(0, config.destination)
+
+        if pconf.general.local in aliases:
+            print(
+                f"{pconf.general.local} is the local replica, the source of the broadcast."
+            )
+            exit(1)
+
+        unknown = [alias for alias in aliases if alias not in pconf.replicas]
+        if len(unknown) > 0:
+            print(
+                f"{', '.join(unknown)} not among valid remotes: {', '.join(pconf.aliases)}"
+            )
+            exit(1)
+
+        return [pconf.replicas[alias] for alias in dict.fromkeys(aliases)]
+
+    @staticmethod
+    def choose_seed(
+        config, replicas: List[PsyncReplicaConfig]
+    ) -> Tuple[PsyncReplicaConfig, List[PsyncReplicaConfig]]:
+        """The seed (the destination, or the fastest replica) and the other online replicas."""
+        results = {r.alias: r for r in ReplicaProber().probe(replicas)}
+
+        offline = [alias for alias, result in results.items() if not result.online]
+        if len(offline) > 0:
+            print(f"Skipping offline replica(s): {', '.join(offline)}")
+        online = [replica for replica in replicas if results[replica.alias].online]
+
+        if config.destination is not None:
+            seed = pconf.replicas[config.destination]
+            if seed not in online:
+                print(f"The seed {seed.alias} is offline.")
+                exit(1)
+        elif len(online) > 0:
+            # replicas on this machine last: they would relay the files through the local uplink again
+            seed = max(
+                online,
+                key=lambda r: (not results[r.alias].local, results[r.alias].rank),
+            )
+            print(f"Seed: {seed.alias} (the fastest replica)")
+        else:
+            print("No online replica to broadcast to.")
+            exit(1)
+
+        return seed, [replica for replica in online if replica is not seed]
+
+    def file_lists(
+        self,
+        config,
+        root: Path,
+        files: List[str],
+        replicas: List[PsyncReplicaConfig],
+    ) -> Dict[str, List[str]]:
+        """
+        The files each replica should receive (its own exclusions apply). The seed receives every file needed by any
+        replica, as the others get the files from it.
+        """
+        by_exclude: Dict[Tuple[str, ...], List[str]] = {}
+        for replica in replicas:
+            by_exclude.setdefault(tuple(replica.exclude), []).append(replica.alias)
+
+        lists, needed = {}, set()
+        for aliases in by_exclude.values():
+            matcher = self.matcher(config, root, pconf.replicas[aliases[0]])
+            paths = []
+            for prefix in files or [""]:
+                if prefix != "":
+                    paths.append(prefix)
+                    if not (root / prefix).is_dir():
+                        continue
+                paths += [
+                    path for path, _ in walk(root, matcher, prefix, include_dirs=True)
+                ]
+
+            needed.update(paths)
+            for alias in aliases:
+                lists[alias] = paths
+
+        lists[replicas[0].alias] = sorted(needed)
+        return lists
+
+    def push_seed(self, config, transfer: Transfer, lists: Dict[str, str]) -> int:
+        alias = transfer.replica.alias
+        print(f"Pushing to the seed ({alias})...")
+
+        # the listed folders are created without recursing into them, the files inside are listed too
+        command = transfer.command(lists[alias], recursive=False)
+        if config.debug:
+            print("Executing", shlex.join(command))
+
+        returncode, _, stats, elapsed = stream_transfer(command, capture_stderr=False)
+        self.log_transfer(config, transfer, returncode, stats, elapsed, label="seed")
+        print(
+            f"[local -> {alias}] {format_size(stats.transferred_size)} in {format_duration(elapsed)}"
+        )
+        return returncode
@@ -0,0 +1,447 @@
+import dataclasses
+import hashlib
+import json
+import os
+import queue
+import re
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from psync.connection import get_manager
+from psync.filters import PARTIAL_DIR
+from psync.local import PARTIAL_TRANSFER
+from psync.runner import check_output, run_binary
+from psync.shards import ListingEntry, parse_listing
+from psync.telemetry import TransferStats
+from psync.utils import cache_dir, format_size
+
+DEFAULT_CHUNK_SIZE = "256M"
+DEFAULT_CONNECTIONS = 4
+BLOCK_SIZE = 1024 * 1024  # dd's block size, and what is read at a time locally
+MAX_BACKOFF = 30  # seconds between the attempts of a range
+
+SHA1 = re.compile(r"\b[0-9a-f]{40}\b")
+# the tools run on the replica, with GNU options (e.g. dd's iflag=skip_bytes, stat -c, touch -d @...)
+GNU_TOOLS = ("dd", "sha1sum", "stat", "touch", "truncate")
+
+
+class Range(NamedTuple):
+    index: int
+    offset: int
+    length: int
+
+
+def split_ranges(size: int, chunk_size: int) -> List[Range]:
+    return [
+        Range(i, offset, min(chunk_size, size - offset))
+        for i, offset in enumerate(range(0, size, chunk_size))
+    ]
+
+
+def exclusion(path: str) -> str:
+    # anchored to the root of the transfer, with rsync's wildcards escaped
+    return "--exclude=/" + re.sub(r"([*?\[\\])", r"\\\1", path)
+
+
+class RangeCheckpoint:
+    """
+    The ranges of a large file which are already on the target (and verified), stored in ~/.cache/psync/chunks/ so
+    that an interrupted transfer only sends the missing ones. A modified source file gets a new checkpoint.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.completed: Dict[int, str] = {}  # range index -> SHA-1
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_file(
+        cls, transfer, file: ListingEntry, chunk_size: int
+    ) -> "RangeCheckpoint":
+        signature = json.dumps(
+            [transfer.mode, transfer.src, transfer.tgt, file.path, file.size]
+            + [file.mtime, chunk_size]
+        )
+        return cls(hashlib.sha1(signature.encode()).hexdigest()[:16]).load()
+
+    @property
+    def path(self) -> Path:
+        return cache_dir("chunks") / f"{self.key}.json"
+
+    def load(self) -> "RangeCheckpoint":
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return self
+
+        self.completed = {int(index): digest for index, digest in data.items()}
+        return self
+
+    def complete(self, index: int, digest: str):
+        with self._lock:
+            self.completed[index] = digest
+            tmp_path = self.path.with_name(f"{self.key}.{threading.get_ident()}.tmp")
+            tmp_path.write_text(json.dumps(self.completed))
+            os.replace(tmp_path, self.path)
+
+    def reset(self):
+        self.completed = {}
+        self.remove()
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+class ChunkedTransfer:
+    """
+    Transfers the files larger than `threshold` as ranges of `chunk_size` bytes over `connections` parallel SSH
+    connections (each one with its own ControlMaster), rather than through a single rsync stream. Each range is
+    written in place into a file preallocated in the partial-dir of the target, and checked against the SHA-1 of the
+    source; verified ranges are recorded (see RangeCheckpoint). Once complete, the file is moved into place with the
+    permissions and modification time of the source, so that rsync sees it as up to date afterwards.
+
+    The replica needs GNU coreutils (see GNU_TOOLS), which select checks first.
+    """
+
+    def __init__(
+        self,
+        transfer,
+        threshold: int,
+        chunk_size: int,
+        connections: int = DEFAULT_CONNECTIONS,
+        retries: int = 3,
+    ):
+        self.transfer = transfer
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.connections = connections
+        self.retries = retries
+        self.push = transfer.mode == "push"
+        self.files: List[ListingEntry] = []  # to transfer, once selected
+        self.stats = TransferStats()
+        self._lock = threading.Lock()
+
+    @property
+    def host(self):
+        return self.transfer.host
+
+    def select(self, files_from: Optional[str]) -> bool:
+        """
+        Finds the large files among those of the transfer, returning False (printing why) if the listing failed or
+        the replica lacks GNU coreutils.
+        """
+        missing = self.missing_tools()
+        if len(missing) > 0:
+            print(
+                f"--large-files needs GNU coreutils on {self.transfer.replica.alias}, which lacks the GNU "
+                f"{', '.join(missing)}: transfer without --large-files."
+            )
+            return False
+
+        # exact sizes, rather than the rounded ones printed with -h
+        listing = check_output(
+            self.transfer.list_command(files_from, extra=["--no-human-readable"])
+        )
+        if listing is None:
+            return False
+
+        large = [
+            entry
+            for entry in parse_listing(listing)
+            if entry.type == "-" and entry.size >= self.threshold
+        ]
+        # rsync's quick check: those with the same size and modification time on the target are skipped
+        targets = self.target_states([entry.path for entry in large])
+        self.files = [
+            entry
+            for entry in large
+            if targets.get(entry.path) != (entry.size, entry.mtime)
+        ]
+
+        self.stats.files = len(large)
+        self.stats.total_size = sum(entry.size for entry in large)
+        return True
+
+    def missing_tools(self) -> List[str]:
+        """The tools in GNU_TOOLS which the replica lacks (or has in a version without the GNU options)."""
+        # GNU coreutils mention themselves in --version, which BSD and busybox tools do not even accept
+        script = "; ".join(
+            f"{tool} --version 2>/dev/null | grep -q GNU || echo {tool}"
+            for tool in GNU_TOOLS
+        )
+        result = self.host.run_remote(script, stdin=subprocess.DEVNULL)
+        if not result.ok:
+            return list(GNU_TOOLS)
+        return result.stdout.split()
+
+    def target_states(self, paths: List[str]) -> Dict[str, Tuple[int, int]]:
+        """The (size, mtime) of the files which exist on the target."""
+        states = {}
+
+        if not self.push:
+            for path in paths:
+                try:
+                    stat = os.stat(Path(self.transfer.local) / path)
+                except OSError:
+                    continue
+                states[path] = (stat.st_size, int(stat.st_mtime))
+            return states
+
+        if len(paths) == 0:
+            return states
+
+        root = self.transfer.remote_path
+        # fails if any file is missing, while still printing the others
+        result = self.host.run_remote(
+            ["stat", "-c", "%s %Y %n", "--"] + [root + path for path in paths]
+        )
+        for line in result.stdout.splitlines():
+            try:
+                size, mtime, name = line.split(" ", 2)
+                states[name[len(root) :]] = (int(size), int(mtime))
+            except ValueError:
+                continue
+        return states
+
+    def rest(self):
+        """The transfer of everything else, to be run by rsync."""
+        return dataclasses.replace(
+            self.transfer,
+            options=self.transfer.options + [exclusion(f.path) for f in self.files],
+        )
+
+    def print_files(self):
+        n_ranges = sum(len(split_ranges(f.size, self.chunk_size)) for f in self.files)
+        print(
+            f"Large files ({len(self.files)}), sent as {n_ranges} ranges of "
+            f"{format_size(self.chunk_size)} over {self.connections} connections:"
+        )
+        for file in self.files:
+            print("  ", f"{file.path} ({format_size(file.size)})")
+
+    def run(self) -> Tuple[int, TransferStats, float]:
+        start = time.perf_counter()
+
+        # each connection is used by one range at a time
+        lanes = queue.Queue()
+        for lane in range(self.connections):
+            lanes.put(lane)
+
+        failed = []
+        try:
+            with ThreadPoolExecutor(self.connections) as executor:
+                for file in self.files:
+                    if self.transfer_file(file, executor, lanes):
+                        self.stats.transferred_files += 1
+                    else:
+                        failed.append(file.path)
+        finally:
+            get_manager().close_lanes(self.host, range(self.connections))
+
+        elapsed = time.perf_counter() - start
+        if len(failed) > 0:
+            print(
+                f"{len(failed)} large file(s) could not be transferred (run again to resume them):"
+            )
+            for path in failed:
+                print("  ", path)
+
+        return PARTIAL_TRANSFER if failed else 0, self.stats, elapsed
+
+    def transfer_file(
+        self, file: ListingEntry, executor: ThreadPoolExecutor, lanes: queue.Queue
+    ) -> bool:
+        start = time.perf_counter()
+        checkpoint = RangeCheckpoint.for_file(self.transfer, file, self.chunk_size)
+
+        previous_size = self.prepare(file)
+        if previous_size is None:
+            return False
+        if previous_size != file.size:
+            # the partial file is gone (or belongs to another version): the recorded ranges are not there
+            checkpoint.reset()
+
+        ranges = split_ranges(file.size, self.chunk_size)
+        pending = [r for r in ranges if r.index not in checkpoint.completed]
+        done, moved = len(ranges) - len(pending), 0
+
+        for r, digest in zip(
+            pending, executor.map(lambda r: self.send_range(file, r, lanes), pending)
+        ):
+            if digest is None:
+                continue
+
+            checkpoint.complete(r.index, digest)
+            done += 1
+            moved += r.length
+            speed = moved / max(time.perf_counter() - start, 1e-6)
+            print(
+                f"\r   {file.path}: {done}/{len(ranges)} ranges ({format_size(speed)}/s)",
+                end="",
+                flush=True,
+            )
+        print()
+
+        with self._lock:
+            self.stats.transferred_size += moved
+            self.stats.literal_data += moved
+            if self.push:
+                self.stats.bytes_sent += moved
+            else:
+                self.stats.bytes_received += moved
+
+        if done < len(ranges) or not self.finalize(file):
+            return False
+
+        checkpoint.remove()
+        return True
+
+    def send_range(
+        self, file: ListingEntry, r: Range, lanes: queue.Queue
+    ) -> Optional[str]:
+        """Transfers (and verifies) a range, with retries, returning its SHA-1 or None if it failed."""
+        lane = lanes.get()
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    time.sleep(min(2**attempt, MAX_BACKOFF))
+                digest = (self._push_range if self.push else self._pull_range)(
+                    file, r, lane
+                )
+                if digest is not None:
+                    return digest
+            return None
+        finally:
+            lanes.put(lane)
+
+    def partial_path(self, root: str, file: ListingEntry) -> str:
+        parent, _, name = file.path.rpartition("/")
+        folder = f"{root}{parent}/" if parent else root
+        return f"{folder}{PARTIAL_DIR}/{name}"
+
+    def ssh(self, lane: int, script: str) -> List[str]:
+        return get_manager().ssh_args(self.host, lane) + [
+            self.host.ssh_destination,
+            script,
+        ]
+
+    def prepare(self, file: ListingEntry) -> Optional[int]:
+        """
+        Preallocates the partial file on the target, returning its previous size (-1 if it did not exist), or None
+        if it failed.
+        """
+        if not self.push:
+            path = Path(self.partial_path(self.transfer.local, file))
+            previous = path.stat().st_size if path.exists() else -1
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("ab"):
+                pass
+            os.truncate(path, file.size)
+            return previous
+
+        partial = self.partial_path(self.transfer.remote_path, file)
+        path, folder = shlex.quote(partial), shlex.quote(os.path.dirname(partial))
+        result = self.host.run_remote(
+            f"mkdir -p {folder} && if [ -f {path} ]; then stat -c %s {path}; fi && "
+            f"truncate -s {file.size} {path}"
+        )
+        if not result.check():
+            print(result.stderr.rstrip())
+            return None
+        return int(result.stdout.strip() or -1)
+
+    def _push_range(self, file: ListingEntry, r: Range, lane: int) -> Optional[str]:
+        local_hash = hashlib.sha1()
+
+        def source():
+            with open(Path(self.transfer.local) / file.path, "rb") as f:
+                f.seek(r.offset)
+                remaining = r.length
+                while remaining > 0:
+                    chunk = f.read(min(BLOCK_SIZE, remaining))
+                    if not chunk:
+                        # the file shrank: the checksums will not match
+                        break
+                    local_hash.update(chunk)
+                    remaining -= len(chunk)
+                    yield chunk
+
+        path = shlex.quote(self.partial_path(self.transfer.remote_path, file))
+        # written in place and synced, then read back to verify what is on the disk
+        script = (
+            f"dd of={path} bs={BLOCK_SIZE} seek={r.offset} oflag=seek_bytes conv=notrunc,fsync status=none && "
+            f"dd if={path} bs={BLOCK_SIZE} skip={r.offset} count={r.length} iflag=skip_bytes,count_bytes "
+            "status=none | sha1sum"
+        )
+        result = run_binary(self.ssh(lane, script), source=source())
+
+        match = SHA1.search(result.stdout)
+        if not result.ok or match is None or match.group() != local_hash.hexdigest():
+            return None
+        return match.group()
+
+    def _pull_range(self, file: ListingEntry, r: Range, lane: int) -> Optional[str]:
+        local_hash = hashlib.sha1()
+        received = 0
+
+        fd = os.open(self.partial_path(self.transfer.local, file), os.O_WRONLY)
+        try:
+
+            def on_chunk(chunk: bytes):
+                nonlocal received
+                os.pwrite(fd, chunk, r.offset + received)
+                local_hash.update(chunk)
+                received += len(chunk)
+
+            path = shlex.quote(f"{self.transfer.remote_path}{file.path}")
+            # the data goes to stdout, and its checksum (computed on the same read) to stderr
+            script = (
+                f"{{ dd if={path} bs={BLOCK_SIZE} skip={r.offset} count={r.length} iflag=skip_bytes,count_bytes "
+                "status=none | tee /dev/fd/3 | sha1sum >&2; } 3>&1"
+            )
+            result = run_binary(self.ssh(lane, script), on_chunk=on_chunk)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        match = SHA1.search(result.stderr)
+        if (
+            not result.ok
+            or received != r.length
+            or match is None
+            or match.group() != local_hash.hexdigest()
+        ):
+            return None
+        return match.group()
+
+    def finalize(self, file: ListingEntry) -> bool:
+        """Moves the assembled file into place, with the permissions and modification time of the source."""
+        if not self.push:
+            partial = Path(self.partial_path(self.transfer.local, file))
+            try:
+                os.chmod(partial, file.mode)
+                os.utime(partial, (file.mtime, file.mtime))
+                os.replace(partial, Path(self.transfer.local) / file.path)
+            except OSError as e:
+                print(f"{file.path}: {e}")
+                return False
+            try:
+                partial.parent.rmdir()
+            except OSError:
+                pass
+            return True
+
+        root = self.transfer.remote_path
+        partial = shlex.quote(self.partial_path(root, file))
+        target = shlex.quote(f"{root}{file.path}")
+        folder = shlex.quote(os.path.dirname(self.partial_path(root, file)))
+        return self.host.run_remote(
+            f"chmod {file.mode:o} {partial} && touch -m -d @{file.mtime} {partial} && "
+            f"mv -f {partial} {target} && {{ rmdir {folder} 2>/dev/null || true; }}"
+        ).check()
@@ -0,0 +1,206 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Union
+
+from psync.filters import ExclusionMatcher, walk
+from psync.probe import ProbeResult, ReplicaProber
+from psync.runner import run
+from psync.utils import cache_dir, format_size
+
+# formats which are already compressed: compressing them again only wastes CPU time
+# fmt: off
+SKIP_COMPRESS = [
+    # archives and compressed streams
+    "7z", "bz2", "gz", "lz", "lz4", "lzma", "lzo", "rar", "tbz", "tgz", "txz", "xz", "z", "zip", "zst",
+    # data
+    "npz", "parquet", "feather", "arrow", "orc", "avro", "h5", "hdf5", "pt", "pth", "ckpt", "safetensors",
+    "tfrecord", "jar", "whl", "egg", "deb", "rpm", "apk", "dmg", "iso", "squashfs",
+    # media
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "avif", "tif", "tiff", "mp3", "mp4", "m4a", "m4v", "aac",
+    "flac", "ogg", "opus", "mkv", "mov", "avi", "webm", "wav",
+    # documents
+    "pdf", "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub",
+]
+# fmt: on
+
+CAPABILITIES_TTL = 24 * 60 * 60  # seconds
+SAMPLE_FILES = 5000
+
+# link throughput (bytes/s) above which each algorithm stops paying off: on fast links, compression only costs CPU
+NO_COMPRESSION_ABOVE = 500 * 1000 * 1000
+LZ4_ABOVE = 50 * 1000 * 1000
+ZSTD_FAST_ABOVE = 5 * 1000 * 1000
+# below this fraction of compressible data, compression is not worth it
+MIN_COMPRESSIBLE = 0.2
+
+YES, NO, AUTO = "yes", "no", "auto"
+
+
+def normalize(value: Union[str, bool, None]) -> str:
+    """Maps the values accepted by --compress / general.compress (e.g., true, false, auto) to yes, no or auto."""
+    if isinstance(value, bool) or value is None:
+        return YES if value else NO
+
+    value = value.strip().lower()
+    if value in ("", "0", "false", "no", "off", "none"):
+        return NO
+    if value == AUTO:
+        return AUTO
+    return YES
+
+
+@dataclass
+class Compression:
+    algorithm: Optional[str] = (
+        None  # None means no compression, "zlib" is rsync's default
+    )
+    level: Optional[int] = None
+    reason: str = ""
+
+    @property
+    def options(self) -> List[str]:
+        if self.algorithm is None:
+            return []
+
+        options = ["-z", f"--skip-compress={'/'.join(SKIP_COMPRESS)}"]
+        if self.algorithm != "zlib":
+            options.append(f"--compress-choice={self.algorithm}")
+        if self.level is not None:
+            options.append(f"--compress-level={self.level}")
+        return options
+
+    def __str__(self):
+        if self.algorithm is None:
+            choice = "none"
+        else:
+            choice = self.algorithm
+            if self.level is not None:
+                choice += f" (level {self.level})"
+        return f"{choice}, {self.reason}" if self.reason else choice
+
+
+def parse_compress_list(version_output: str) -> List[str]:
+    # rsync >= 3.2 prints "Compress list:" followed by an indented line with the algorithms
+    lines = version_output.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("Compress list:"):
+            algorithms = []
+            for following in lines[i + 1 :]:
+                if not following.startswith((" ", "\t")):
+                    break
+                algorithms += following.split()
+            return algorithms
+
+    # older versions only support zlib
+    return ["zlib"]
+
+
+def compress_list(host=None) -> List[str]:
+    """Returns the compression algorithms supported by rsync locally (or on `host`), caching them for a day."""
+    key = "local" if host is None else f"{host.user}@{host.hostname}:{host.port}"
+    cache_file = cache_dir() / "rsync_compress.json"
+
+    try:
+        cache = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        cache = {}
+
+    cached = cache.get(key)
+    if cached is not None and time.time() - cached["timestamp"] < CAPABILITIES_TTL:
+        return cached["algorithms"]
+
+    if host is None:
+        result = run(["rsync", "--version"])
+    else:
+        result = host.run_remote(["rsync", "--version"])
+    if not result.ok:
+        return ["zlib"]
+
+    algorithms = parse_compress_list(result.stdout)
+    cache[key] = dict(algorithms=algorithms, timestamp=time.time())
+
+    tmp_path = cache_file.with_name(f"rsync_compress.json.{os.getpid()}")
+    try:
+        tmp_path.write_text(json.dumps(cache))
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        pass
+
+    return algorithms
+
+
+def is_compressible(path: str) -> bool:
+    name = path.rsplit("/", 1)[-1].lower()
+    return not any(name.endswith(f".{extension}") for extension in SKIP_COMPRESS)
+
+
+def compressible_fraction(root: Path, matcher: ExclusionMatcher) -> Optional[float]:
+    """Returns the fraction of bytes (among the first files found under `root`) that are worth compressing."""
+    total, compressible = 0, 0
+
+    for i, (path, stat) in enumerate(walk(root, matcher)):
+        if i >= SAMPLE_FILES:
+            break
+        total += stat.st_size
+        if is_compressible(path):
+            compressible += stat.st_size
+
+    return compressible / total if total > 0 else None
+
+
+def choose(
+    throughput: Optional[float],
+    fraction: Optional[float],
+    algorithms: List[str],
+) -> Compression:
+    """
+    Picks the compression for a link with the given `throughput` (bytes/s), when `fraction` of the data is
+    compressible and both ends support `algorithms`.
+    """
+    if fraction is not None and fraction < MIN_COMPRESSIBLE:
+        return Compression(reason=f"{fraction:.0%} compressible data")
+
+    link = (
+        "unknown link speed"
+        if throughput is None
+        else f"link at {format_size(throughput)}/s"
+    )
+    if fraction is not None:
+        link += f", {fraction:.0%} compressible data"
+
+    if throughput is not None and throughput >= NO_COMPRESSION_ABOVE:
+        return Compression(reason=link)
+
+    if throughput is not None and throughput >= LZ4_ABOVE:
+        if "lz4" in algorithms:
+            return Compression("lz4", reason=link)
+        return Compression(reason=f"{link}, lz4 not supported")
+
+    if "zstd" in algorithms:
+        slow = throughput is not None and throughput < ZSTD_FAST_ABOVE
+        return Compression("zstd", 9 if slow else 3, reason=link)
+
+    return Compression("zlib", reason=link)
+
+
+def auto_compression(
+    replica, host, root: Optional[Path], matcher, probe: Optional[ProbeResult] = None
+) -> Compression:
+    """
+    Measures the link to `replica` (see psync replicas status, unless `probe` already did) and the file-type mix
+    under `root` (the local copy of the project, if any) to choose the compression of a transfer.
+    """
+    result = probe if probe is not None else ReplicaProber().probe([replica])[0]
+    throughput = result.throughput if result.online else None
+
+    fraction = None
+    if root is not None and root.is_dir():
+        fraction = compressible_fraction(root, matcher)
+
+    local, remote = compress_list(), compress_list(host)
+    algorithms = [algorithm for algorithm in local if algorithm in remote]
+
+    return choose(throughput, fraction, algorithms)
@@ -1,11 +1,21 @@
+import hashlib
+import json
 import os
+import re
 from pathlib import Path
 
-from typing import Dict, Optional
-from omegaconf import OmegaConf, SI
-from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional
+from dataclasses import dataclass, field
 
 from psync.host_data import HostData
+from psync.profiling import CONFIG, PROFILE_ENV, span
+from psync.utils import cache_dir
+
+MISSING = "???"  # omegaconf.MISSING, i.e. a replica without a host
+
+# OmegaConf is only imported when the config is not cached (or needs to be modified), as it is slow to import.
+# The defaults below are interpolations, i.e. the same as omegaconf.SI("...")
 
 
 @dataclass
@@ -13,6 +23,10 @@ class PsyncReplicaConfig:
     alias: str
     path: str
     host: HostData
+    exclude: List[str] = field(default_factory=list)  # only applied to this replica
+    # retention of the snapshots pushed with psync push --snapshot (see psync.snapshots.RetentionPolicy)
+    keep_snapshots: Optional[int] = None
+    keep_snapshot_days: Optional[float] = None
 
     @property
     def hostdata(self) -> HostData:
@@ -20,6 +34,11 @@ class PsyncReplicaConfig:
             HostData.from_host(self.host) if isinstance(self.host, str) else self.host
         )
 
+    @property
+    def absolute_path(self) -> str:
+        # the path as used by the transfers
+        return str(Path(self.path).expanduser().absolute())
+
     def __str__(self):
         host = self.hostdata.filled
         return f"{host.user}@{host.hostname}:{host.port} -> {self.path}"
@@ -27,43 +46,79 @@ class PsyncReplicaConfig:
 
 @dataclass
 class PsyncGeneralConfig:
-    local: str = SI("${oc.env:PSYNC_LOCAL}")
-    remote: Optional[str] = SI("${oc.env:PSYNC_LOCAL,null}")
-    ask_confirm: bool = SI("${oc.decode:${oc.env:PSYNC_ASK_CONFIRM,false}}")
-    compress: bool = SI("${oc.decode:${oc.env:PSYNC_COMPRESS,false}}")
-    debug: bool = SI("${oc.decode:${oc.env:PSYNC_DEBUG,false}}")
+    local: str = "${oc.env:PSYNC_LOCAL}"
+    remote: Optional[str] = "${oc.env:PSYNC_LOCAL,null}"
+    ask_confirm: bool = "${oc.decode:${oc.env:PSYNC_ASK_CONFIRM,false}}"
+    compress: str = "${oc.env:PSYNC_COMPRESS,no}"  # yes, no or auto
+    debug: bool = "${oc.decode:${oc.env:PSYNC_DEBUG,false}}"
+    multiplex: bool = "${oc.decode:${oc.env:PSYNC_MULTIPLEX,true}}"
+    control_persist: str = "${oc.env:PSYNC_CONTROL_PERSIST,10m}"
+    # replicas on this machine are copied directly, rather than through ssh to localhost
+    bypass_local_ssh: bool = "${oc.decode:${oc.env:PSYNC_BYPASS_LOCAL_SSH,true}}"
 
 
 @dataclass
 class PsyncConfigOC:
     replicas: Dict[str, PsyncReplicaConfig]
-    general: PsyncGeneralConfig = PsyncGeneralConfig()
+    general: PsyncGeneralConfig = field(default_factory=PsyncGeneralConfig)
 
 
 class PsyncConfig:
-    def __init__(self, oc: PsyncConfigOC, path: Path):
+    found = True
+
+    def __init__(self, data: Dict[str, Any], path: Path, oc: PsyncConfigOC = None):
+        # data is the resolved config as plain python objects, oc is only loaded when the config is modified
+        self.__data = data
         self.__config = oc
         self.__config_path = path
+        self.__general: Optional[PsyncGeneralConfig] = None
+        self.__replicas: Optional[Mapping[str, PsyncReplicaConfig]] = None
+
+    @property
+    def oc(self) -> PsyncConfigOC:
+        if self.__config is None:
+            self.__config = load_omegaconf(self.__config_path)
+        return self.__config
+
+    def invalidate(self):
+        """Drops the materialized general config and replicas, which are rebuilt on their next access."""
+        self.__general = None
+        self.__replicas = None
 
     @property
     def general(self) -> PsyncGeneralConfig:
-        return OmegaConf.to_object(self.__config.general)
+        if self.__general is None:
+            self.__general = PsyncGeneralConfig(**self.__data["general"])
+        return self.__general
 
     @property
     def replicas_real(self):
-        return self.__config.replicas
+        return self.oc.replicas
 
     @property
-    def replicas(self) -> Dict[str, PsyncReplicaConfig]:
-        result = {}
-        for alias, replica in self.__config.replicas.items():
-            replica.alias = alias
-            result[alias] = OmegaConf.to_object(replica)
-        return result
+    def replicas(self) -> Mapping[str, PsyncReplicaConfig]:
+        # built once and read-only: modifications go through replicas_real (and persist)
+        if self.__replicas is None:
+            replicas = {}
+            for alias, replica in self.__data["replicas"].items():
+                host = replica["host"]
+                if host is None or host == MISSING:
+                    # a path on this machine, transferred without SSH
+                    host = HostData()
+                replicas[alias] = PsyncReplicaConfig(
+                    alias=alias,
+                    path=replica["path"],
+                    host=HostData(**host) if isinstance(host, dict) else host,
+                    exclude=list(replica.get("exclude") or []),
+                    keep_snapshots=replica.get("keep_snapshots"),
+                    keep_snapshot_days=replica.get("keep_snapshot_days"),
+                )
+            self.__replicas = MappingProxyType(replicas)
+        return self.__replicas
 
     @property
     def local(self) -> PsyncReplicaConfig:
-        return self.replicas[self.__config.general.local]
+        return self.replicas[self.general.local]
 
     @property
     def project(self) -> str:
@@ -75,23 +130,22 @@ class PsyncConfig:
 
     @property
     def default_replica(self) -> PsyncReplicaConfig:
-        if self.__config.general.remote is not None:
-            return self.replicas[self.__config.general.remote]
+        remote = self.general.remote
+        if remote is not None:
+            return self.replicas[remote]
 
-        replicas = list(self.replicas.values())
+        replicas = self.replicas
         n = len(replicas)
         if n == 1:
             print(
-                f"There is only one replica ({replicas[0]}), which should be the local replica."
+                f"There is only one replica ({next(iter(replicas.values()))}), which should be the local replica."
             )
             exit()
 
         if n == 2:
+            local = self.general.local
             return next(
-                filter(
-                    lambda replica: replica.alias != self.general.local,
-                    self.replicas.values(),
-                )
+                replica for alias, replica in replicas.items() if alias != local
             )
 
         raise ValueError(
@@ -99,25 +153,38 @@ class PsyncConfig:
         )
 
     @property
-    def aliases(self):
-        return list(self.replicas.keys())
+    def aliases(self) -> List[str]:
+        return list(self.replicas)
 
     def as_yaml(self):
-        return OmegaConf.to_yaml(self.__config, resolve=True)
+        from omegaconf import OmegaConf
+
+        return OmegaConf.to_yaml(self.oc, resolve=True)
 
     @property
     def path(self) -> Path:
         return self.__config_path
 
     def persist(self, backup: bool = True):
+        from omegaconf import OmegaConf
+
         if backup:
             backup_path = self.path.rename(self.path.parent / (self.path.name + ".bak"))
             print(f"Config backed up at {backup_path}")
 
-        for replica in self.replicas_real.values():
-            replica.alias = None
+        data = to_data(self.oc)
+        for replica in data["replicas"].values():
+            # the alias is the key of the replica, so it is not saved
+            replica.pop("alias", None)
+            if not replica.get("exclude"):
+                replica.pop("exclude", None)
+            for key in ["keep_snapshots", "keep_snapshot_days"]:
+                if replica.get(key) is None:
+                    replica.pop(key, None)
 
-        OmegaConf.save(self.__config, self.path, resolve=True)
+        OmegaConf.save(OmegaConf.create(data), self.path)
+        self.__data = data
+        self.invalidate()
 
 
 def try_find_config_file(search_home: bool = True) -> Optional[Path]:
@@ -153,6 +220,8 @@ class ConfigNotFoundException(BaseException):
 
 
 class NullPsyncConfig(PsyncConfig):
+    found = False
+
     def __init__(self):
         super().__init__(None, None)  # noqa
 
@@ -160,14 +229,91 @@ class NullPsyncConfig(PsyncConfig):
         raise ConfigNotFoundException()
 
 
-def get_config() -> PsyncConfig:
-    config_path = try_find_config_file()
+class LazyPsyncConfig:
+    """Stands for the config of the current project, which is only loaded (by get_config) when first accessed."""
 
-    if config_path is None:
-        return NullPsyncConfig()
+    def __init__(self):
+        self.__config: Optional[PsyncConfig] = None
+
+    def load(self) -> PsyncConfig:
+        if self.__config is None:
+            self.__config = get_config()
+        return self.__config
+
+    def __getattr__(self, item):
+        return getattr(self.load(), item)
+
+
+@span("load_omegaconf", CONFIG)
+def load_omegaconf(config_path: Path) -> PsyncConfigOC:
+    from omegaconf import OmegaConf
 
     _conf = OmegaConf.load(config_path)
     schema = OmegaConf.structured(PsyncConfigOC)
     oc = OmegaConf.merge(schema, _conf)
     OmegaConf.resolve(oc)
-    return PsyncConfig(oc, config_path)  # noqa
+    return oc  # noqa
+
+
+def to_data(oc: PsyncConfigOC) -> Dict[str, Any]:
+    from omegaconf import OmegaConf
+
+    return OmegaConf.to_container(oc, resolve=True)
+
+
+def cache_key(config_path: Path) -> str:
+    """
+    The resolved config depends on the config file and on the environment variables it (or the schema) refers to.
+    """
+    stat = config_path.stat()
+    referenced = re.findall(
+        r"oc\.env:([A-Za-z_][A-Za-z0-9_]*)", config_path.read_text()
+    )
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if (name.startswith("PSYNC_") and name != PROFILE_ENV) or name in referenced
+    }
+    key = [
+        str(config_path.absolute()),
+        stat.st_mtime_ns,
+        stat.st_size,
+        sorted(env.items()),
+    ]
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def cache_path(config_path: Path) -> Path:
+    name = hashlib.sha1(str(config_path.absolute()).encode("utf-8")).hexdigest()
+    return cache_dir("config") / f"{name}.json"
+
+
+@span("get_config", CONFIG)
+def get_config() -> PsyncConfig:
+    config_path = try_find_config_file()
+
+    if config_path is None:
+        return NullPsyncConfig()
+
+    key = cache_key(config_path)
+    cached = cache_path(config_path)
+
+    try:
+        data = json.loads(cached.read_text())
+        if data["key"] == key:
+            return PsyncConfig(data["config"], config_path)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # only valid configs make it to the cache, since load_omegaconf raises otherwise
+    oc = load_omegaconf(config_path)
+    data = to_data(oc)
+
+    try:
+        tmp_path = cached.with_name(f"{cached.name}.{os.getpid()}")
+        tmp_path.write_text(json.dumps(dict(key=key, config=data)))
+        os.replace(tmp_path, cached)
+    except OSError:
+        pass
+
+    return PsyncConfig(data, config_path, oc)
@@ -0,0 +1,137 @@
+import hashlib
+import shlex
+import subprocess
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from psync.runner import INHERIT, run
+from psync.utils import cache_dir
+
+DEFAULT_PERSIST = "10m"
+
+
+class ConnectionManager:
+    """
+    Keeps one SSH ControlMaster per remote (user, hostname, port) alive for `persist` (in ssh's time format,
+    e.g. 10m or 1h), so that rsync transports and remote commands skip the handshake after the first connection.
+    """
+
+    def __init__(
+        self,
+        persist: str = DEFAULT_PERSIST,
+        enabled: bool = True,
+        bypass_local: bool = True,
+    ):
+        self.persist = persist
+        self.enabled = enabled
+        # whether hosts which are this machine are reached without SSH (see HostData.is_local)
+        self.bypass_local = bypass_local
+
+    @staticmethod
+    def control_path(host, lane: int = 0) -> Path:
+        # unix sockets have a path length limit (~104 chars), so we hash the connection details
+        key = f"{host.user}@{host.hostname}:{host.port}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        if lane > 0:
+            # further connections to the same host, e.g. for the parallel ranges of psync.chunked
+            digest += f"-{lane}"
+        return cache_dir("cm") / digest
+
+    def control_paths(self, host) -> List[Path]:
+        """The sockets of every connection (lane) to the host which may be open."""
+        path = self.control_path(host)
+        return sorted(
+            p for p in [path, *path.parent.glob(f"{path.name}-*")] if p.exists()
+        )
+
+    def ssh_options(self, host, lane: int = 0) -> List[str]:
+        if not self.enabled:
+            return []
+
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path(host, lane)}",
+            "-o",
+            f"ControlPersist={self.persist}",
+        ]
+
+    def ssh_args(self, host, lane: int = 0) -> List[str]:
+        return ["ssh", "-p", str(host.port)] + self.ssh_options(host, lane)
+
+    def ssh_command(self, host) -> str:
+        # as a single string, e.g. for rsync's -e
+        return shlex.join(self.ssh_args(host))
+
+    def open(self, host) -> bool:
+        """Starts the master connection in advance, so that concurrent commands do not race to create it."""
+        if host.is_local:
+            # transferred without SSH
+            return True
+        path = self.control_path(host)
+        if not self.enabled or (path.exists() and self._control(host, path, "check")):
+            return self.enabled
+
+        result = run(
+            self.ssh_args(host) + [f"{host.user}@{host.hostname}", "true"],
+            stdin=subprocess.DEVNULL,
+            capture_stdout=False,
+            stderr=INHERIT,
+        )
+        return result.ok
+
+    def _control(self, host, path: Path, operation: str) -> bool:
+        result = run(
+            [
+                "ssh",
+                "-O",
+                operation,
+                "-o",
+                f"ControlPath={path}",
+                f"{host.user}@{host.hostname}",
+            ]
+        )
+        return result.ok
+
+    def open_connections(self, host) -> int:
+        return sum(
+            self._control(host, path, "check") for path in self.control_paths(host)
+        )
+
+    def is_open(self, host) -> bool:
+        return self.open_connections(host) > 0
+
+    def close_lanes(self, host, lanes: Iterable[int]):
+        """Closes the extra connections (lanes > 0) opened for a transfer, leaving the main one to ControlPersist."""
+        for lane in lanes:
+            path = self.control_path(host, lane)
+            if lane > 0 and path.exists():
+                self._control(host, path, "exit")
+
+    def close(self, host) -> bool:
+        # every lane, not only the main connection
+        results = [
+            self._control(host, path, "exit") for path in self.control_paths(host)
+        ]
+        return len(results) > 0 and all(results)
+
+
+_manager: Optional[ConnectionManager] = None
+
+
+def get_manager() -> ConnectionManager:
+    global _manager
+
+    if _manager is None:
+        from psync import config as pconf
+
+        if not pconf.found:
+            _manager = ConnectionManager()
+        else:
+            general = pconf.general
+            _manager = ConnectionManager(
+                general.control_persist, general.multiplex, general.bypass_local_ssh
+            )
+
+    return _manager
@@ -0,0 +1,177 @@
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from psync.runner import MERGE, run
+from psync.telemetry import TransferStats
+from psync.utils import format_size, parse_size
+
+# e.g. "          1.23M  45%   10.00MB/s    0:00:01 (xfr#1, to-chk=0/3)"
+PROGRESS = re.compile(r"^\s*(?P<bytes>[\d.,]+[KMGTP]?)\s+(?P<percent>\d+)%\s+\S+")
+# e.g. "sent 1.23K bytes  received 35 bytes  2.52K bytes/sec"
+SENT_RECEIVED = re.compile(
+    r"sent (?P<sent>[\d.,]+[KMGTP]?) bytes\s+received (?P<received>[\d.,]+[KMGTP]?) bytes"
+)
+
+
+@dataclass
+class ReplicaStatus:
+    alias: str
+    state: str = "waiting"
+    progress: str = ""
+    transferred: int = 0  # file data moved (from --info=progress2)
+    wire: int = 0  # bytes sent + received over the connection
+    elapsed: float = 0.0
+    returncode: Optional[int] = None
+    errors: List[str] = field(default_factory=list)
+    stats: TransferStats = field(default_factory=TransferStats)
+
+    def __str__(self):
+        return f"[{self.alias}] {self.state:<8} {self.progress}".rstrip()
+
+
+class FanOut:
+    """
+    Runs one rsync command per replica on a bounded pool of workers, showing the live status of every transfer
+    and a summary table once all of them are done.
+    """
+
+    def __init__(
+        self,
+        commands: Dict[str, List[str]],
+        jobs: int = 8,
+        refresh: float = 0.5,
+        label: str = "replica",
+    ):
+        self.commands = commands
+        self.label = label
+        self.jobs = max(1, min(jobs, len(commands)))
+        self.refresh = refresh
+        self.statuses = {alias: ReplicaStatus(alias) for alias in commands}
+        self.live = sys.stdout.isatty()
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._rendered = False
+        self.elapsed = 0.0
+
+    def run(self) -> int:
+        start = time.perf_counter()
+        renderer = None
+        if self.live:
+            renderer = threading.Thread(target=self._render_loop, daemon=True)
+            renderer.start()
+
+        with ThreadPoolExecutor(self.jobs) as pool:
+            list(pool.map(self._transfer, self.commands))
+        self.elapsed = time.perf_counter() - start
+
+        self._done.set()
+        if renderer is not None:
+            renderer.join()
+
+        self.print_summary()
+        return max(status.returncode or 0 for status in self.statuses.values())
+
+    def _transfer(self, alias: str):
+        status = self.statuses[alias]
+        self._set_state(status, "running")
+
+        start = time.perf_counter()
+
+        def on_line(line: str):
+            self._parse_line(status, line)
+            status.elapsed = time.perf_counter() - start
+
+        result = run(
+            self.commands[alias], capture_stdout=False, stderr=MERGE, on_stdout=on_line
+        )
+        if result.stderr:
+            # the command could not be started
+            status.errors.append(result.stderr)
+
+        status.returncode = result.returncode
+        status.elapsed = result.elapsed
+        self._set_state(status, "done" if status.returncode == 0 else "failed")
+
+    @staticmethod
+    def _parse_line(status: ReplicaStatus, line: str):
+        progress = PROGRESS.match(line)
+        if progress is not None:
+            status.progress = line.strip()
+            status.transferred = parse_size(progress.group("bytes"))
+            return
+
+        if status.stats.feed(line):
+            return
+
+        sent_received = SENT_RECEIVED.search(line)
+        if sent_received is not None:
+            status.wire = parse_size(sent_received.group("sent")) + parse_size(
+                sent_received.group("received")
+            )
+        elif line.startswith(("rsync:", "rsync error", "ssh:")):
+            status.errors.append(line)
+
+    def _set_state(self, status: ReplicaStatus, state: str):
+        status.state = state
+        if not self.live:
+            with self._lock:
+                print(status, flush=True)
+
+    def _render(self):
+        with self._lock:
+            if self._rendered:
+                # moves the cursor back to the first status line
+                sys.stdout.write(f"\x1b[{len(self.statuses)}F")
+            for status in self.statuses.values():
+                sys.stdout.write(f"\x1b[2K{status}\n")
+            sys.stdout.flush()
+            self._rendered = True
+
+    def _render_loop(self):
+        while not self._done.wait(self.refresh):
+            self._render()
+        self._render()
+
+    def print_summary(self):
+        header = (self.label, "status", "transferred", "sent+received", "elapsed")
+        rows = [
+            (
+                status.alias,
+                (
+                    status.state
+                    if status.returncode == 0
+                    else f"{status.state} ({status.returncode})"
+                ),
+                format_size(status.transferred),
+                format_size(status.wire),
+                f"{status.elapsed:.1f}s",
+            )
+            for status in self.statuses.values()
+        ]
+
+        widths = [
+            max(len(row[i]) for row in [header] + rows) for i in range(len(header))
+        ]
+        print()
+        for row in [header] + rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print(line.rstrip())
+
+        transferred = sum(status.transferred for status in self.statuses.values())
+        throughput = transferred / self.elapsed if self.elapsed > 0 else 0
+        print(
+            f"\nTotal: {format_size(transferred)} in {self.elapsed:.1f}s "
+            f"({format_size(throughput)}/s)"
+        )
+
+        for status in self.statuses.values():
+            if status.returncode != 0 and len(status.errors) > 0:
+                print(f"\n[{status.alias}] errors:")
+                for error in status.errors:
+                    print("  ", error)
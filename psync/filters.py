@@ -0,0 +1,139 @@
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Pattern, Tuple
+
+# where resumable transfers keep the partially transferred files, on the target
+PARTIAL_DIR = ".psync-partial"
+
+DEFAULT_EXCLUSIONS = [".vscode", ".idea", ".git", ".psync", PARTIAL_DIR]
+
+
+@lru_cache(maxsize=None)
+def translate(glob: str) -> Pattern:
+    """
+    Compiles a glob the way rsync and git match it: * and ? (and character classes) do not match a slash, ** matches
+    anything, and a **/ which starts the glob or follows a slash also matches no folder at all.
+    """
+    regex, i, n = "", 0, len(glob)
+
+    while i < n:
+        char = glob[i]
+        if glob.startswith("**", i):
+            i += 2
+            if glob.startswith("/", i) and (i == 2 or glob[i - 3] == "/"):
+                regex += "(?:.*/)?"
+                i += 1
+            else:
+                regex += ".*"
+            continue
+
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "\\" and i + 1 < n:
+            i += 1
+            regex += re.escape(glob[i])
+        elif char == "[":
+            end = i + 1
+            if end < n and glob[end] in "!^":
+                end += 1
+            if end < n and glob[end] == "]":
+                # a ] right after the [ (or [!) belongs to the class
+                end += 1
+            end = glob.find("]", end)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                body = glob[i + 1 : end].replace("\\", "\\\\").replace("[", "\\[")
+                if body[0] in "!^":
+                    regex += f"[^/{body[1:]}]"
+                else:
+                    regex += f"(?!/)[{body}]"
+                i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    return re.compile(regex + r"\Z", re.DOTALL)
+
+
+def matches(glob: str, path: str) -> bool:
+    return translate(glob).match(path) is not None
+
+
+class ExclusionMatcher:
+    """
+    Matches paths (relative to the transfer root) against rsync-style exclusion patterns: patterns containing no
+    slash match the name of any file or folder, the others match the end of the path (or the whole path, if they
+    start with a slash) and a trailing slash only matches folders.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = []
+
+        for pattern in patterns:
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+
+            if pattern.startswith("/"):
+                globs = [pattern[1:]]
+            elif "/" in pattern or "**" in pattern:
+                # matches the end of the path
+                globs = [pattern, f"**/{pattern}"]
+            else:
+                globs = None  # matches the name alone
+
+            self.patterns.append((pattern, globs, dir_only))
+
+    def excluded(self, path: str, is_dir: bool = False) -> bool:
+        name = path.rsplit("/", 1)[-1]
+
+        for pattern, globs, dir_only in self.patterns:
+            if dir_only and not is_dir:
+                continue
+
+            if globs is None:
+                if matches(pattern, name):
+                    return True
+            elif any(matches(glob, path) for glob in globs):
+                return True
+
+        return False
+
+
+def walk(
+    root: Path, matcher: ExclusionMatcher, prefix: str = "", include_dirs: bool = False
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Yields every non-directory (relative path, lstat) under `root` (or its `prefix` folder), without descending into
+    excluded folders. With `include_dirs`, folders are yielded as well, before their content.
+    """
+    pending = [prefix.rstrip("/")]
+
+    while pending:
+        relative_dir = pending.pop()
+
+        try:
+            entries = list(os.scandir(root / relative_dir))
+        except OSError:
+            continue
+
+        for entry in entries:
+            relative = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+
+            if matcher.excluded(relative, is_dir):
+                continue
+
+            if is_dir:
+                pending.append(relative)
+                if not include_dirs:
+                    continue
+
+            try:
+                yield relative, entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
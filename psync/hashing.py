@@ -0,0 +1,196 @@
+import hashlib
+import json
+import mmap
+import os
+import stat
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# only the standard library and these psync modules, which are sent along to the replica (see remote_script)
+from psync.filters import ExclusionMatcher, walk
+from psync.utils import cache_dir
+
+CRC32, BLAKE2B, SHA256 = "crc32", "blake2b", "sha256"
+ALGORITHMS = [CRC32, BLAKE2B, SHA256]
+
+BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 8
+
+# (inode, size, mtime_ns): a cached digest is valid as long as the file keeps the same one
+FileState = Tuple[int, int, int]
+
+
+class Crc32:
+    """zlib's CRC-32 with the interface of hashlib: not cryptographic, but several times faster than any of them."""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+def new_hash(algorithm: str):
+    return Crc32() if algorithm == CRC32 else hashlib.new(algorithm)
+
+
+def hash_file(path: Path, algorithm: str) -> str:
+    # memory-mapped, so that blocks are hashed straight from the page cache (both zlib and hashlib release the GIL)
+    digest = new_hash(algorithm)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(view), BLOCK_SIZE):
+                        digest.update(view[offset : offset + BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+def file_states(
+    root: Path, matcher: ExclusionMatcher, prefixes: List[str]
+) -> Dict[str, FileState]:
+    """The regular files under `root` (or under the `prefixes` within it, if any)."""
+    states = {}
+    for relative, entry_stat in walk(root, matcher):
+        if not stat.S_ISREG(entry_stat.st_mode):
+            continue
+        if len(prefixes) > 0 and not any(
+            relative == prefix or relative.startswith(prefix + "/")
+            for prefix in prefixes
+        ):
+            continue
+        states[relative] = (
+            entry_stat.st_ino,
+            entry_stat.st_size,
+            entry_stat.st_mtime_ns,
+        )
+    return states
+
+
+class HashCache:
+    """The digests of the files of a folder (stored under the user cache), by relative path along with their state."""
+
+    def __init__(self, root: Path, algorithm: str, enabled: bool = True):
+        key = hashlib.sha1(f"{root.absolute()}:{algorithm}".encode()).hexdigest()[:16]
+        self.path = cache_dir("hashes") / f"{key}.json" if enabled else None
+        self.entries: Dict[str, list] = (
+            {}
+        )  # relative path -> [inode, size, mtime_ns, digest]
+
+    def load(self) -> "HashCache":
+        if self.path is None:
+            return self
+        try:
+            self.entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            pass
+        return self
+
+    def get(self, relative: str, state: FileState) -> Optional[str]:
+        entry = self.entries.get(relative)
+        if entry is not None and tuple(entry[:3]) == state:
+            return entry[3]
+        return None
+
+    def save(self, states: Dict[str, FileState], digests: Dict[str, str]):
+        if self.path is None:
+            return
+        # the other entries are kept, e.g. for the files outside of the folders being verified
+        self.entries.update(
+            {
+                relative: [*states[relative], digest]
+                for relative, digest in digests.items()
+            }
+        )
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.entries))
+        os.replace(tmp_path, self.path)
+
+
+def hash_files(
+    root: Path,
+    states: Dict[str, FileState],
+    algorithm: str,
+    cache: HashCache,
+    workers: int = DEFAULT_WORKERS,
+) -> Tuple[Dict[str, str], int]:
+    """Returns the digest of every file which could be read, and how many of them were hashed (not cached)."""
+    digests, pending = {}, []
+    for relative, state in states.items():
+        cached = cache.get(relative, state)
+        if cached is not None:
+            digests[relative] = cached
+        else:
+            pending.append(relative)
+
+    def job(relative: str) -> Tuple[str, Optional[str]]:
+        try:
+            return relative, hash_file(root / relative, algorithm)
+        except OSError:
+            return relative, None
+
+    with ThreadPoolExecutor(workers) as executor:
+        for relative, digest in executor.map(job, pending):
+            if digest is not None:
+                digests[relative] = digest
+
+    cache.save(states, digests)
+    return digests, len(pending)
+
+
+def remote_script() -> str:
+    """
+    A python3 program which runs `main` on the replica, where psync is not installed: the source of this module and
+    of those it imports is embedded in it.
+    """
+    package = Path(__file__).parent
+    sources = {
+        name: (package / f"{name.split('.')[1]}.py").read_text()
+        for name in ["psync.utils", "psync.filters", "psync.hashing"]
+    }
+    return (
+        "import sys, types\n"
+        "sys.modules['psync'] = types.ModuleType('psync')\n"
+        f"for name, source in {sources!r}.items():\n"
+        "    module = sys.modules[name] = types.ModuleType(name)\n"
+        "    exec(compile(source, name, 'exec'), module.__dict__)\n"
+        "sys.modules['psync.hashing'].main()\n"
+    )
+
+
+def main():
+    """
+    Reads a request from stdin (JSON, with the root, the files to hash, the exclusions and the options), hashes the
+    requested files found under the root and prints the digests, along with the other files found, as JSON.
+    """
+    request = json.load(sys.stdin)
+    root = Path(request["root"]).expanduser()
+    if not root.is_dir():
+        json.dump(dict(error=f"{root} is not a folder"), sys.stdout)
+        return
+
+    states = file_states(
+        root, ExclusionMatcher(request["exclude"]), request["prefixes"]
+    )
+    requested = set(request["files"])
+    algorithm = request["algorithm"]
+
+    digests, hashed = hash_files(
+        root,
+        {
+            relative: state
+            for relative, state in states.items()
+            if relative in requested
+        },
+        algorithm,
+        HashCache(root, algorithm, request["cache"]).load(),
+        request["workers"],
+    )
+    extra = [relative for relative in states if relative not in requested]
+    json.dump(dict(digests=digests, hashed=hashed, extra=extra), sys.stdout)
@@ -1,7 +1,34 @@
+import asyncio
+import getpass
+import shlex
+import socket
 from dataclasses import dataclass
-from typing import Optional
+from functools import cached_property, lru_cache
+from typing import List, Optional, Sequence, Union
 
-from psync.utils import run_command
+from psync.connection import get_manager
+from psync.probe import probe_tcp
+from psync.profiling import HOSTS, span
+from psync.runner import CommandResult, run
+from psync.ssh_config import resolve_host
+
+
+@lru_cache(maxsize=None)
+def is_local_hostname(hostname: str) -> bool:
+    """Whether `hostname` is this machine: a loopback address, or one of the addresses of our own hostname."""
+    if hostname in ("localhost", socket.gethostname(), socket.getfqdn()):
+        return True
+
+    def addresses(name: str) -> set:
+        try:
+            return {info[4][0] for info in socket.getaddrinfo(name, None)}
+        except (OSError, UnicodeError):
+            return set()
+
+    resolved = addresses(hostname)
+    if any(address.startswith("127.") or address == "::1" for address in resolved):
+        return True
+    return len(resolved & addresses(socket.gethostname())) > 0
 
 
 @dataclass
@@ -21,26 +48,74 @@ class HostData:
 
         return f"{hn} --- {self.user}@{self.hostname}{port_str}"
 
-    def remote_run_command(self, command):
-        return run_command(f"ssh {self.ssh_connection} {command}")
+    def run_remote(self, command: Union[str, Sequence[str]], **kwargs) -> CommandResult:
+        """
+        Runs `command` on the host: either a list of arguments (quoted for the remote shell) or a shell script. The
+        keyword arguments are those of psync.runner.run.
+        """
+        if not isinstance(command, str):
+            command = shlex.join(command)
+        if self.is_local:
+            return run(["sh", "-c", command], **kwargs)
+        return run(self.ssh_args + [self.ssh_destination, command], **kwargs)
 
     @classmethod
     def extract(cls, host, info):
-        res = run_command(f'ssh -G {host} | grep "^{info} "')
-        return res.rstrip()[len(info) + 1 :]
+        return resolve_host(host).get(info)
+
+    @cached_property
+    def is_local(self) -> bool:
+        """
+        Whether the host is this machine (as the same user, on the standard port and without proxies), or there is no
+        host at all: SSH is not needed.
+        """
+        filled = self.filled
+        if filled.hostname is None:
+            return True
+        if not get_manager().bypass_local or filled.port != 22:
+            return False
+
+        # a jump host or a proxy command may well land on another machine (or container) than ours
+        options = resolve_host(self.host) if self.host is not None else {}
+        if any(
+            options.get(key, "none") != "none" for key in ("proxyjump", "proxycommand")
+        ):
+            return False
+        return filled.user in (None, getpass.getuser()) and is_local_hostname(
+            filled.hostname
+        )
 
     @property
-    def ssh_connection(self):
+    def ssh_destination(self) -> str:
         filled = self.filled
-        return f"-p {filled.port} {filled.user}@{filled.hostname}"
+        return f"{filled.user}@{filled.hostname}"
+
+    @property
+    def ssh_connection(self) -> List[str]:
+        return ["-p", str(self.filled.port), self.ssh_destination]
+
+    @property
+    def ssh_options(self) -> List[str]:
+        # routes the connection through the shared ControlMaster of this host (if multiplexing is enabled)
+        return get_manager().ssh_options(self.filled)
+
+    @property
+    def ssh_args(self) -> List[str]:
+        return get_manager().ssh_args(self.filled)
+
+    @property
+    def ssh_command(self) -> str:
+        # the remote shell used by rsync (-e)
+        return get_manager().ssh_command(self.filled)
 
     @classmethod
     def from_host(cls, host):
+        resolved = resolve_host(host)
         return cls(
             host,
-            cls.extract(host, "user"),
-            cls.extract(host, "hostname"),
-            int(cls.extract(host, "port")),
+            resolved.get("user"),
+            resolved.get("hostname"),
+            int(resolved.get("port") or 22),
         )
 
     def info(self, info):
@@ -64,18 +139,14 @@ class HostData:
 
     @property
     def filled(self) -> "HostData":
-        return HostData(
-            host=self.host,
-            user=self.info("user"),
-            hostname=self.info("hostname"),
-            port=int(self.info("port") or 22),
-        )
-
-    def is_online(self):
-        return not bool(
-            int(
-                run_command(
-                    f"nc -zw 1 {self.hostname} {self.port} > /dev/null; echo $?"
-                )
+        with span("HostData.filled", HOSTS, host=self.host or self.hostname):
+            return HostData(
+                host=self.host,
+                user=self.info("user"),
+                hostname=self.info("hostname"),
+                port=int(self.info("port") or 22),
             )
-        )
+
+    def is_online(self, timeout: float = 1.0):
+        filled = self.filled
+        return asyncio.run(probe_tcp(filled.hostname, filled.port, timeout)) is not None
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from psync.filters import ExclusionMatcher, matches
+from psync.utils import cache_dir
+
+# files with exclusion patterns, read in every folder of the project (the later ones take precedence)
+IGNORE_FILES = [".gitignore", ".psyncignore"]
+
+
+class IgnoreRule(NamedTuple):
+    base: str  # folder of the ignore file, relative to the project ("" for its root)
+    pattern: str
+    negated: bool  # !pattern, i.e., re-included
+    anchored: bool  # only matches relative to base (the pattern contains a slash)
+    dir_only: bool  # only matches folders (the pattern ends with a slash)
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        """Whether the rule matches `path` (relative to the project)."""
+        if self.dir_only and not is_dir:
+            return False
+
+        if self.base:
+            if not path.startswith(self.base + "/"):
+                return False
+            path = path[len(self.base) + 1 :]
+
+        if self.anchored:
+            return matches(self.pattern, path)
+        if "/" in self.pattern:
+            return matches(self.pattern, path) or matches(f"**/{self.pattern}", path)
+        return matches(self.pattern, path.rsplit("/", 1)[-1])
+
+    def to_rsync(self, root: str) -> List[str]:
+        """
+        Translates the rule to rsync filter rules, for a transfer of the `root` folder (relative to the project).
+        Returns no rule if it cannot apply to that folder.
+        """
+        prefix = "+ " if self.negated else "- "
+        suffix = "/" if self.dir_only else ""
+
+        if root == "" or self.base == root or self.base.startswith(root + "/"):
+            base = self.base[len(root) :].lstrip("/")
+        elif not self.anchored and (
+            self.base == "" or root.startswith(self.base + "/")
+        ):
+            # an ancestor's unanchored rule applies to the whole transfer
+            base = ""
+        else:
+            full = f"{self.base}/{self.pattern}" if self.base else self.pattern
+            if not self.anchored or not full.startswith(root + "/"):
+                return []
+            return [f"{prefix}/{full[len(root) + 1:]}{suffix}"]
+
+        if self.anchored:
+            full = f"{base}/{self.pattern}" if base else self.pattern
+            return [f"{prefix}/{full}{suffix}"]
+        if not base:
+            # rsync matches unanchored patterns against the end of the path, just like git
+            return [f"{prefix}{self.pattern}{suffix}"]
+        return [
+            f"{prefix}/{base}/{self.pattern}{suffix}",
+            f"{prefix}/{base}/**/{self.pattern}{suffix}",
+        ]
+
+
+def parse_ignore_file(text: str, base: str) -> List[IgnoreRule]:
+    rules = []
+
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith(("\\#", "\\!")):
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        pattern = line.rstrip("/")
+        if pattern.startswith("**/"):
+            # "**/foo" matches foo in every folder, like an unanchored pattern
+            pattern = pattern[3:]
+            anchored = False
+        else:
+            anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        if pattern:
+            rules.append(IgnoreRule(base, pattern, negated, anchored, dir_only))
+
+    return rules
+
+
+class IgnoreRules:
+    """
+    The rules of the .gitignore/.psyncignore files found in every (non-excluded) folder of a project. Discovering them
+    needs a walk of the folders, so the folders are cached (in ~/.cache/psync/ignore/) along with their modification
+    times: as long as none of them (nor any ignore file) changed, the rules are loaded without walking the project.
+    """
+
+    def __init__(self, project: Path, matcher: ExclusionMatcher):
+        self.project = project
+        self.matcher = matcher
+        self.rules: List[IgnoreRule] = []
+
+    @property
+    def cache_file(self) -> Path:
+        key = json.dumps(
+            [str(self.project), [(p[0], p[2]) for p in self.matcher.patterns]]
+        )
+        return (
+            cache_dir("ignore") / f"{hashlib.sha1(key.encode()).hexdigest()[:16]}.json"
+        )
+
+    def load(self) -> "IgnoreRules":
+        try:
+            cached = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            cached = None
+
+        if cached is not None and self._unchanged(cached["mtimes"]):
+            self.rules = [IgnoreRule(*rule) for rule in cached["rules"]]
+            return self
+
+        mtimes = self._discover()
+        try:
+            self.cache_file.write_text(
+                json.dumps(dict(mtimes=mtimes, rules=self.rules))
+            )
+        except OSError:
+            pass
+        return self
+
+    def _unchanged(self, mtimes: Dict[str, int]) -> bool:
+        for path, mtime in mtimes.items():
+            try:
+                if os.stat(self.project / path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _discover(self) -> Dict[str, int]:
+        """Walks the folders of the project reading their ignore files, returning the mtimes of both."""
+        mtimes = {}
+        by_depth: List[List[IgnoreRule]] = []
+        pending = [""]
+
+        while pending:
+            relative_dir = pending.pop()
+            folder = self.project / relative_dir
+
+            try:
+                mtimes[relative_dir or "."] = folder.stat().st_mtime_ns
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+
+            depth = relative_dir.count("/") + 1 if relative_dir else 0
+            while len(by_depth) <= depth:
+                by_depth.append([])
+
+            for name in IGNORE_FILES:
+                path = folder / name
+                if not path.is_file():
+                    continue
+                relative = f"{relative_dir}/{name}" if relative_dir else name
+                try:
+                    mtimes[relative] = path.stat().st_mtime_ns
+                    by_depth[depth] += parse_ignore_file(path.read_text(), relative_dir)
+                except (OSError, UnicodeDecodeError):
+                    continue
+
+            # the rules found so far are enough: those of other (deeper) folders do not apply to the subfolders
+            self.rules = [rule for rules in by_depth for rule in rules]
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                relative = (
+                    f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                )
+                if not self.excluded(relative, True):
+                    pending.append(relative)
+
+        # shallower rules first, so that deeper ones take precedence (as in git)
+        self.rules = [rule for rules in by_depth for rule in rules]
+        return mtimes
+
+    def excluded(self, path: str, is_dir: bool = False) -> bool:
+        """Whether `path` (relative to the project) is excluded, according to the last matching rule."""
+        if self.matcher.excluded(path, is_dir):
+            return True
+
+        for rule in reversed(self.rules):
+            if rule.matches(path, is_dir):
+                return not rule.negated
+        return False
+
+    def matcher_for(self, root: Path) -> "IgnoreMatcher":
+        return IgnoreMatcher(self, self.relative(root))
+
+    def relative(self, root: Path) -> str:
+        relative = root.relative_to(self.project).as_posix()
+        return "" if relative == "." else relative
+
+    def filter_file(self, root: Path) -> Optional[Path]:
+        """
+        Compiles the rules into an rsync filter file for a transfer of `root`. As rsync applies the first matching
+        rule (while git applies the last one), the rules are written in reverse order. Files are named after the hash
+        of their content, so they are only written once.
+        """
+        relative = self.relative(root)
+        lines = [
+            line for rule in reversed(self.rules) for line in rule.to_rsync(relative)
+        ]
+        if len(lines) == 0:
+            return None
+
+        content = "\n".join(lines) + "\n"
+        path = (
+            cache_dir("filters")
+            / f"{hashlib.sha256(content.encode()).hexdigest()[:16]}.rules"
+        )
+        if not path.exists():
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}")
+            tmp_path.write_text(content)
+            os.replace(tmp_path, path)
+        return path
+
+
+class IgnoreMatcher:
+    """Same as ExclusionMatcher (i.e. for paths relative to the transfer root), also applying the ignore rules."""
+
+    def __init__(self, rules: IgnoreRules, root: str):
+        self.rules = rules
+        self.prefix = root + "/" if root else ""
+
+    def excluded(self, path: str, is_dir: bool = False) -> bool:
+        return self.rules.excluded(self.prefix + path, is_dir)
+
+
+_loaded: Dict[str, IgnoreRules] = {}
+
+
+def load_rules(project: Path, matcher: ExclusionMatcher) -> IgnoreRules:
+    """Returns the (memoized) ignore rules of `project`."""
+    rules = IgnoreRules(project, matcher)
+    key = str(rules.cache_file)
+    if key not in _loaded:
+        _loaded[key] = rules.load()
+    return _loaded[key]
@@ -0,0 +1,140 @@
+import json
+import os
+import shlex
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from psync.filters import ExclusionMatcher, walk
+
+# relative path (to the project) -> (size, mtime_ns, inode)
+FileStates = Dict[str, Tuple[int, int, int]]
+# relative path (to the transfer root) -> (size, mtime in seconds, or None if it is not preserved), on the replica
+ReplicaStates = Dict[str, Tuple[int, Optional[int]]]
+
+MARKER = ".psync/last_push"
+
+
+class ChangeIndex:
+    """
+    Remembers what was last pushed to a replica (stored under <project>/.psync/index/<alias>.json), so that the next
+    push only needs to send the files which changed since then. A token written both in the index and on the replica
+    cheaply detects whether another machine pushed to it in the meantime. Files edited on the replica itself are only
+    found by comparing its listing to the index (see drift), as rsync preserves sizes and modification times.
+    """
+
+    def __init__(self, project: Path, alias: str):
+        self.project = project
+        self.alias = alias
+        self.token: Optional[str] = None
+        self.files: FileStates = {}
+
+    @property
+    def path(self) -> Path:
+        return self.project / ".psync" / "index" / f"{self.alias}.json"
+
+    def load(self) -> "ChangeIndex":
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return self
+
+        self.token = data.get("token")
+        self.files = {path: tuple(state) for path, state in data["files"].items()}
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(dict(token=self.token, files=self.files)))
+        os.replace(tmp_path, self.path)
+
+    def invalidate(self):
+        self.token = None
+        self.files = {}
+        if self.path.exists():
+            self.path.unlink()
+
+    def scan(self, root: Path, matcher: ExclusionMatcher) -> FileStates:
+        prefix = self.prefix(root)
+        return {
+            prefix + path: (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            for path, stat in walk(root, matcher)
+        }
+
+    def prefix(self, root: Path) -> str:
+        relative = root.relative_to(self.project).as_posix()
+        return "" if relative == "." else relative + "/"
+
+    def diff(self, scanned: FileStates, root: Path) -> Tuple[List[str], List[str]]:
+        """Returns the changed (or new) and deleted files under `root`, relative to it."""
+        prefix = self.prefix(root)
+
+        changed = [
+            path[len(prefix) :]
+            for path, state in scanned.items()
+            if self.files.get(path) != state
+        ]
+        deleted = [
+            path[len(prefix) :]
+            for path in self.files
+            if path.startswith(prefix) and path not in scanned
+        ]
+        return changed, deleted
+
+    def drift(self, replica: ReplicaStates, root: Path) -> Tuple[List[str], List[str]]:
+        """
+        Compares the files on the replica under `root` to the index, returning those which changed there (or are
+        missing) and those which were not pushed (extra), relative to it.
+        """
+        prefix = self.prefix(root)
+
+        changed = []
+        for path, (size, mtime_ns, _) in self.files.items():
+            if not path.startswith(prefix):
+                continue
+            relative = path[len(prefix) :]
+            state = replica.get(relative)
+            if (
+                state is None
+                or state[0] != size
+                or (state[1] is not None and state[1] != mtime_ns // 10**9)
+            ):
+                changed.append(relative)
+
+        extra = [path for path in replica if prefix + path not in self.files]
+        return changed, extra
+
+    def update(self, scanned: FileStates, root: Path, token: str):
+        # only the entries under root have been synchronized, the others are kept as they are
+        prefix = self.prefix(root)
+        self.files = {
+            path: state
+            for path, state in self.files.items()
+            if not path.startswith(prefix)
+        }
+        self.files.update(scanned)
+        self.token = token
+        self.save()
+
+    @staticmethod
+    def marker(replica) -> str:
+        return f"{replica.absolute_path}/{MARKER}"
+
+    @classmethod
+    def remote_token(cls, host, replica) -> Optional[str]:
+        result = host.run_remote(
+            f"cat {shlex.quote(cls.marker(replica))} 2>/dev/null || true"
+        )
+        return result.stdout.strip() or None
+
+    @classmethod
+    def mark_remote(cls, host, replica) -> str:
+        token = f"{int(time.time())}-{uuid.uuid4().hex}"
+        marker = cls.marker(replica)
+        host.run_remote(
+            f"mkdir -p {shlex.quote(os.path.dirname(marker))} && "
+            f"echo {token} > {shlex.quote(marker)}"
+        ).check()
+        return token
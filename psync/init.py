@@ -3,7 +3,6 @@ from pathlib import Path
 from typing import Optional
 
 from jsonargparse import ArgumentParser
-from omegaconf import OmegaConf
 
 from psync.config import PsyncReplicaConfig, try_find_config_file
 from psync.command import PsyncBaseCommand
@@ -39,6 +38,7 @@ class InitCommand(PsyncBaseCommand):
         return parser
 
     def run(self, config):
+        from omegaconf import OmegaConf
 
         config_path = try_find_config_file(search_home=False)
         if config_path is not None:
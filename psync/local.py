@@ -0,0 +1,298 @@
+import fcntl
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from psync.filters import ExclusionMatcher, walk
+from psync.telemetry import TransferStats
+from psync.utils import format_size
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), see linux/fs.h
+CHUNK_SIZE = 1024 * 1024
+# many small files are dominated by system calls, which release the GIL: threads are enough to overlap them
+DEFAULT_WORKERS = 8
+TMP_PREFIX = ".psync-tmp-"
+
+# how the content of a file was copied
+REFLINK, COPY_FILE_RANGE, READ_WRITE = "reflink", "copy_file_range", "read/write"
+
+# rsync's exit code for a partial transfer (some files could not be copied)
+PARTIAL_TRANSFER = 23
+
+
+def copy_data(src_fd: int, dst_fd: int) -> str:
+    """
+    Copies the content of `src_fd` into the (empty) `dst_fd`: as a reflink where the file system supports it (e.g.,
+    btrfs or XFS, the blocks are shared until modified), else with copy_file_range (within the kernel), else by
+    reading and writing it. Returns the method used.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return REFLINK
+    except OSError:
+        pass
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE * 64) > 0:
+                pass
+            return COPY_FILE_RANGE
+        except OSError:
+            # e.g. across file systems, on older kernels
+            os.ftruncate(dst_fd, 0)
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+
+    while True:
+        chunk = os.read(src_fd, CHUNK_SIZE)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view) :]
+    return READ_WRITE
+
+
+def up_to_date(source: os.stat_result, target: Optional[os.stat_result]) -> bool:
+    # rsync's quick check: same type, size and modification time (in seconds)
+    return (
+        target is not None
+        and stat.S_IFMT(source.st_mode) == stat.S_IFMT(target.st_mode)
+        and source.st_size == target.st_size
+        and int(source.st_mtime) == int(target.st_mtime)
+    )
+
+
+def lstat_or_none(path: Path) -> Optional[os.stat_result]:
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+class LocalTransfer:
+    """
+    Synchronizes two folders on the same machine without rsync nor SSH, for replicas which are a local path (e.g., a
+    scratch disk or an NFS mount). Files are compared with rsync's quick check (size and modification time), then the
+    changed ones are copied by a pool of `workers` threads, each one written to a temporary file which replaces the
+    target once complete. Permissions and modification times are preserved, as with rsync -a (ownership is not).
+    """
+
+    def __init__(
+        self,
+        src: Path,
+        tgt: Path,
+        matcher: ExclusionMatcher,
+        files: Optional[List[str]] = None,
+        delete: bool = False,
+        workers: int = DEFAULT_WORKERS,
+    ):
+        self.src = src
+        self.tgt = tgt
+        self.matcher = matcher
+        self.files = files
+        self.delete = delete
+        self.workers = workers
+        self.stats = TransferStats()
+        self.methods: Dict[str, int] = {}
+        self.errors: List[str] = []
+        self.missing: Dict[str, str] = {}  # requested files which do not exist
+
+    def entries(self) -> Iterator[Tuple[str, os.stat_result]]:
+        if self.files is None:
+            yield from walk(self.src, self.matcher, include_dirs=True)
+            return
+
+        for file in self.files:
+            source = lstat_or_none(self.src / file)
+            if source is None:
+                self.missing[file] = "no such file or directory"
+                continue
+
+            # the parents are created too (as with rsync's --relative)
+            parts = file.split("/")
+            for i in range(1, len(parts)):
+                parent = "/".join(parts[:i])
+                yield parent, os.lstat(self.src / parent)
+
+            yield file, source
+            if stat.S_ISDIR(source.st_mode):
+                yield from walk(self.src, self.matcher, file, include_dirs=True)
+
+    def run(self) -> Tuple[int, TransferStats, float]:
+        start = time.perf_counter()
+
+        if not self.src.is_dir():
+            print(f"{self.src} is not a folder.")
+            return PARTIAL_TRANSFER, self.stats, time.perf_counter() - start
+
+        seen, folders, pending = set(), [], []
+        for relative, source in self.entries():
+            if relative in seen:
+                continue
+            seen.add(relative)
+
+            self.stats.files += 1
+            target = lstat_or_none(self.tgt / relative)
+            if target is None:
+                self.stats.created_files += 1
+
+            if stat.S_ISDIR(source.st_mode):
+                folders.append((relative, source))
+                if target is None or not stat.S_ISDIR(target.st_mode):
+                    self._replace_with_folder(relative, target)
+                continue
+
+            if stat.S_ISREG(source.st_mode):
+                self.stats.total_size += source.st_size
+            if not up_to_date(source, target):
+                pending.append((relative, source, target))
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            # the workers only report what they did, the stats are updated here
+            for size, method, literal in executor.map(self._copy, pending):
+                if size is not None:
+                    self.stats.transferred_files += 1
+                    self.stats.transferred_size += size
+                if method is not None:
+                    self.methods[method] = self.methods.get(method, 0) + 1
+                    self.stats.literal_data += literal
+
+        if self.delete:
+            self._delete_extraneous(seen)
+
+        # last, as creating (or deleting) their content changes the modification time of folders
+        for relative, source in reversed(folders):
+            self._set_attributes(self.tgt / relative, source)
+
+        elapsed = time.perf_counter() - start
+        self._print_summary(elapsed)
+        returncode = PARTIAL_TRANSFER if self.errors or self.missing else 0
+        return returncode, self.stats, elapsed
+
+    def _replace_with_folder(self, relative: str, target: Optional[os.stat_result]):
+        path = self.tgt / relative
+        try:
+            if target is not None:
+                path.unlink()
+            path.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            self.errors.append(f"{relative}: {e}")
+
+    def _copy(
+        self, job: Tuple[str, os.stat_result, Optional[os.stat_result]]
+    ) -> Tuple[Optional[int], Optional[str], int]:
+        """Returns the size of the copied entry (None if it was not), and the method and literal data of its copy."""
+        relative, source, target = job
+        path = self.tgt / relative
+        tmp_path = path.with_name(f"{TMP_PREFIX}{path.name}")
+        method, literal = None, 0
+
+        try:
+            if target is not None and stat.S_ISDIR(target.st_mode):
+                self._remove_tree(relative)
+
+            if stat.S_ISLNK(source.st_mode):
+                os.symlink(os.readlink(self.src / relative), tmp_path)
+            elif stat.S_ISREG(source.st_mode):
+                method, literal = self._copy_file(self.src / relative, tmp_path)
+            else:
+                # devices, sockets and pipes are skipped, as with rsync -a run by a regular user
+                return None, None, 0
+
+            self._set_attributes(tmp_path, source)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.errors.append(f"{relative}: {e}")
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            return None, method, literal
+
+        size = source.st_size if stat.S_ISREG(source.st_mode) else 0
+        return size, method, literal
+
+    def _copy_file(self, src: Path, dst: Path) -> Tuple[str, int]:
+        """Returns the method used and how many bytes were actually written (none for reflinks)."""
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                method = copy_data(src_fd, dst_fd)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+        return method, 0 if method == REFLINK else os.path.getsize(dst)
+
+    @staticmethod
+    def _set_attributes(path: Path, source: os.stat_result):
+        if not stat.S_ISLNK(source.st_mode):
+            os.chmod(path, stat.S_IMODE(source.st_mode))
+        try:
+            os.utime(
+                path,
+                ns=(source.st_atime_ns, source.st_mtime_ns),
+                follow_symlinks=False,
+            )
+        except (NotImplementedError, OSError):
+            pass
+
+    def _delete_extraneous(self, seen: set):
+        """Deletes what is not in the source, under the transferred folders (excluded files are left alone)."""
+        if self.files is None:
+            roots = [""]
+        else:
+            roots = [
+                file
+                for file in self.files
+                if file in seen and (self.tgt / file).is_dir()
+            ]
+
+        extraneous = []
+        for root in roots:
+            for relative, _ in walk(self.tgt, self.matcher, root, include_dirs=True):
+                if relative not in seen and not relative.rsplit("/", 1)[-1].startswith(
+                    TMP_PREFIX
+                ):
+                    extraneous.append(relative)
+
+        # the content of a folder before the folder itself
+        for relative in sorted(extraneous, reverse=True):
+            path = self.tgt / relative
+            if not os.path.lexists(path):
+                continue
+            try:
+                if path.is_dir() and not path.is_symlink():
+                    self._remove_tree(relative)
+                else:
+                    path.unlink()
+                self.stats.deleted_files += 1
+            except OSError as e:
+                self.errors.append(f"{relative}: {e}")
+
+    def _remove_tree(self, relative: str):
+        for root, dirs, files in os.walk(self.tgt / relative, topdown=False):
+            for name in files:
+                os.unlink(os.path.join(root, name))
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+        os.rmdir(self.tgt / relative)
+
+    def _print_summary(self, elapsed: float):
+        methods = ", ".join(f"{n} {method}" for method, n in self.methods.items())
+        print(
+            f"Copied {self.stats.transferred_files} file(s) "
+            f"({format_size(self.stats.transferred_size)}{f': {methods}' if methods else ''}) "
+            f"and deleted {self.stats.deleted_files}, out of {self.stats.files} entries, "
+            f"in {elapsed:.2f}s with {self.workers} worker(s)."
+        )
+        for error in self.errors:
+            print("  ", error)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from psync.runner import run
+from psync.telemetry import TransferStats
+from psync.utils import cache_dir, parse_size
+
+# the format of the itemized dry run, e.g. ">f+++++++++ 1.23M path/to/file" or "*deleting   0 path/to/file"
+OUT_FORMAT = "%i %l %n"
+ITEMIZED_LINE = re.compile(
+    r"^(?P<item>\*deleting|[<>ch.*][fdLDS]\S{9}) +(?P<size>[\d.,]+[KMGTP]?) (?P<path>.+)$"
+)
+
+PLAN_TTL = 30 * 60  # seconds during which a plan can be run by push/pull --plan
+THROUGHPUT_TTL = (
+    24 * 60 * 60
+)  # seconds during which a throughput measurement is used for the ETA
+
+# the top-level "directory" of the files in the root of the transfer
+ROOT = "."
+
+
+class PlanEntry(NamedTuple):
+    item: str  # rsync's itemized change, e.g. >f.st...... (or *deleting)
+    size: int
+    path: str
+
+    @property
+    def deleted(self) -> bool:
+        return self.item == "*deleting"
+
+    @property
+    def sent(self) -> bool:
+        # the content of regular files is transferred, anything else only needs its metadata
+        return self.item[0] in "<>" and self.item[1] == "f"
+
+    @property
+    def top_level(self) -> str:
+        if "/" in self.path:
+            return self.path.split("/", 1)[0]
+        return self.path if self.item[1] == "d" else ROOT
+
+
+class DirectoryPlan(NamedTuple):
+    files: int = 0
+    size: int = 0
+    deleted: int = 0
+
+
+class Plan:
+    """
+    What a transfer would do, according to an itemized dry run of rsync: the files it would send (and their size) and
+    those it would delete. Plans are stored in ~/.cache/psync/plans/ for PLAN_TTL seconds, so that push/pull --plan of
+    the same files runs exactly that list, instead of comparing the folders again.
+    """
+
+    def __init__(self, key: str, entries: Optional[List[PlanEntry]] = None):
+        self.key = key
+        self.entries: List[PlanEntry] = entries or []
+        self.stats = TransferStats()
+        self.created = time.time()
+
+    @staticmethod
+    def key_for(transfer, files: Optional[List[str]]) -> str:
+        # the compression does not change what is transferred, and might be chosen differently by the next run
+        options = [o for o in transfer.options if o not in transfer.compression.options]
+        signature = json.dumps(
+            [transfer.mode, transfer.src, transfer.tgt, transfer.delete, options]
+            + [files or []]
+        )
+        return hashlib.sha1(signature.encode()).hexdigest()[:16]
+
+    @classmethod
+    def compute(
+        cls, transfer, files_from: Optional[str], files: Optional[List[str]]
+    ) -> Optional["Plan"]:
+        """Runs the dry run of `transfer`, returning None (printing why) if it failed."""
+        plan = cls(cls.key_for(transfer, files))
+        command = transfer.command(
+            files_from,
+            extra=["--dry-run", "--itemize-changes", f"--out-format={OUT_FORMAT}"],
+        )
+
+        result = run(command, capture_stdout=False, on_stdout=plan.feed)
+        if not result.check():
+            if result.stderr:
+                print(result.stderr.rstrip())
+            return None
+
+        return plan
+
+    @classmethod
+    def load(cls, transfer, files: Optional[List[str]]) -> Optional["Plan"]:
+        """Returns the plan previously computed for `transfer`, if it is recent enough."""
+        plan = cls(cls.key_for(transfer, files))
+        try:
+            data = json.loads(plan.path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - data["created"] > PLAN_TTL:
+            plan.remove()
+            return None
+
+        plan.entries = [PlanEntry(*entry) for entry in data["entries"]]
+        plan.stats = TransferStats(**data["stats"])
+        plan.created = data["created"]
+        return plan
+
+    @property
+    def path(self) -> Path:
+        return cache_dir("plans") / f"{self.key}.json"
+
+    def save(self):
+        data = dict(
+            entries=self.entries, stats=asdict(self.stats), created=self.created
+        )
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+    def feed(self, line: str):
+        if self.stats.feed(line):
+            return
+
+        match = ITEMIZED_LINE.match(line)
+        if match is None:
+            return
+
+        path = match.group("path").rstrip("/")
+        if path in ("", "."):
+            # the root of the transfer itself (e.g. its modification time)
+            return
+
+        size = parse_size(match.group("size"))
+        self.entries.append(PlanEntry(match.group("item"), size, path))
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries if entry.sent)
+
+    def directories(self) -> Dict[str, DirectoryPlan]:
+        """Aggregates the plan by top-level directory, the largest first."""
+        directories: Dict[str, DirectoryPlan] = {}
+
+        for entry in self.entries:
+            files, size, deleted = directories.get(entry.top_level, DirectoryPlan())
+            if entry.deleted:
+                deleted += 1
+            elif entry.sent:
+                files += 1
+                size += entry.size
+            directories[entry.top_level] = DirectoryPlan(files, size, deleted)
+
+        return dict(
+            sorted(directories.items(), key=lambda item: item[1].size, reverse=True)
+        )
+
+    def files_from(self, delete: bool) -> List[str]:
+        # every entry is listed (also directories and metadata-only changes), deletions only if they are requested
+        return [entry.path for entry in self.entries if delete or not entry.deleted]
+
+    @staticmethod
+    def options(delete: bool) -> List[str]:
+        # the files to delete are missing on the source: each one becomes a deletion request on the target
+        if delete:
+            return ["--delete-missing-args", "--force"]
+        # files deleted after the plan was computed are skipped
+        return ["--ignore-missing-args"]
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import shlex
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from psync.connection import get_manager
+from psync.runner import run_async
+from psync.utils import cache_dir
+
+DEFAULT_TTL = 300  # seconds
+DEFAULT_SAMPLE = 2 * 1000 * 1000  # bytes
+
+
+@dataclass
+class ProbeResult:
+    alias: str
+    online: bool = False
+    tcp_ms: Optional[float] = None  # TCP connect latency
+    ssh_ms: Optional[float] = None  # full SSH handshake (without the shared connection)
+    throughput: Optional[float] = None  # bytes/s, sampled over the shared connection
+    has_data: bool = False  # whether the replica path exists
+    error: Optional[str] = None
+    timestamp: float = 0.0
+    local: bool = False  # on this machine, transferred without SSH
+
+    @property
+    def rank(self) -> Tuple[bool, float, float]:
+        # higher is better: local replicas first, then throughput, then latency
+        return self.local, self.throughput or 0, -(self.ssh_ms or float("inf"))
+
+
+async def probe_tcp(hostname: str, port: int, timeout: float = 1.0) -> Optional[float]:
+    """Returns the TCP connect latency in milliseconds, or None if the host cannot be reached."""
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(hostname, port), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return None
+
+    latency = (time.perf_counter() - start) * 1000
+    writer.close()
+    return latency
+
+
+async def probe_online(
+    hosts: Dict[str, object], timeout: float = 1.0
+) -> Dict[str, bool]:
+    """Checks concurrently which of the (filled) hosts accept TCP connections on their SSH port."""
+
+    async def is_online(host) -> bool:
+        if host.is_local:
+            return True
+        return await probe_tcp(host.hostname, host.port, timeout) is not None
+
+    online = await asyncio.gather(*(is_online(host) for host in hosts.values()))
+    return dict(zip(hosts, online))
+
+
+class ReplicaProber:
+    """
+    Measures TCP latency, SSH handshake time and throughput of replicas concurrently, caching the results for
+    `ttl` seconds in ~/.cache/psync/probes.json.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_TTL,
+        timeout: float = 5.0,
+        sample: int = DEFAULT_SAMPLE,
+    ):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.sample = sample
+
+    @staticmethod
+    def key(replica) -> str:
+        host = replica.hostdata.filled
+        return f"{host.user}@{host.hostname}:{host.port}:{replica.absolute_path}"
+
+    @property
+    def cache_file(self):
+        return cache_dir() / "probes.json"
+
+    def load_cache(self) -> Dict[str, dict]:
+        try:
+            return json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def store_cache(self, results: Dict[str, dict]):
+        tmp_path = self.cache_file.with_name(f"probes.json.{os.getpid()}")
+        try:
+            tmp_path.write_text(json.dumps(results))
+            os.replace(tmp_path, self.cache_file)
+        except OSError:
+            pass
+
+    def probe(self, replicas: Iterable, refresh: bool = False) -> List[ProbeResult]:
+        replicas = list(replicas)
+        cache = self.load_cache()
+        now = time.time()
+
+        results, stale = {}, []
+        for replica in replicas:
+            cached = cache.get(self.key(replica))
+            if (
+                not refresh
+                and cached is not None
+                and now - cached["timestamp"] < self.ttl
+            ):
+                results[replica.alias] = ProbeResult(
+                    **dict(cached, alias=replica.alias)
+                )
+            else:
+                stale.append(replica)
+
+        if len(stale) > 0:
+            for replica, result in zip(stale, asyncio.run(self._probe_all(stale))):
+                results[replica.alias] = result
+                cache[self.key(replica)] = asdict(result)
+            self.store_cache(cache)
+
+        return [results[replica.alias] for replica in replicas]
+
+    async def _probe_all(self, replicas) -> List[ProbeResult]:
+        return await asyncio.gather(*(self._probe(replica) for replica in replicas))
+
+    async def _probe(self, replica) -> ProbeResult:
+        host = replica.hostdata.filled
+        result = ProbeResult(replica.alias, timestamp=time.time())
+        target = f"{host.user}@{host.hostname}"
+
+        if host.is_local:
+            result.local = result.online = True
+            result.has_data = os.path.isdir(replica.absolute_path)
+            return result
+
+        result.tcp_ms = await probe_tcp(host.hostname, host.port, self.timeout)
+        if result.tcp_ms is None:
+            result.error = "unreachable"
+            return result
+
+        # a full handshake, bypassing the shared connection, which also checks whether the replica has the data
+        handshake = await run_async(
+            [
+                "ssh",
+                "-p",
+                str(host.port),
+                "-o",
+                "BatchMode=yes",
+                "-o",
+                f"ConnectTimeout={int(self.timeout)}",
+                "-o",
+                "ControlPath=none",
+                target,
+                f"test -d {shlex.quote(replica.absolute_path)}",
+            ],
+            timeout=self.timeout * 2,
+        )
+        if handshake.timed_out:
+            result.error = "ssh timeout"
+            return result
+
+        if handshake.returncode == 255:
+            result.error = "ssh failed"
+            return result
+
+        result.ssh_ms = handshake.elapsed * 1000
+        result.online = True
+        result.has_data = handshake.returncode == 0
+
+        result.throughput = await self._throughput(host, target)
+        return result
+
+    async def _throughput(self, host, target) -> Optional[float]:
+        # times the transfer from the first byte on, so that the handshake (if any) is not accounted for
+        received, start, end = 0, None, None
+
+        def on_chunk(chunk: bytes):
+            nonlocal received, start, end
+            end = time.perf_counter()
+            if start is None:
+                start = end
+            received += len(chunk)
+
+        await run_async(
+            [
+                *get_manager().ssh_args(host),
+                target,
+                f"head -c {self.sample} /dev/zero",
+            ],
+            capture_stdout=False,
+            on_stdout_chunk=on_chunk,
+            timeout=self.timeout * 4,
+        )
+        if start is None or received < self.sample:
+            return None
+
+        elapsed = end - start
+        return received / elapsed if elapsed > 0 else None
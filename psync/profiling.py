@@ -0,0 +1,211 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from psync.utils import cache_dir
+
+PROFILE_ENV = "PSYNC_PROFILE"
+PROFILE_FLAG = "--profile"
+
+# phases (the categories of the trace events)
+STARTUP, CONFIG, HOSTS, COMMAND, FILE_LIST, PROCESS = (
+    "startup",
+    "config",
+    "hosts",
+    "command",
+    "file list",
+    "process",
+)
+
+
+def union(intervals: List[Tuple[float, float]]) -> float:
+    # the time covered by (possibly overlapping, e.g. concurrent) intervals
+    total, end = 0.0, float("-inf")
+    for start, stop in sorted(intervals):
+        if stop > end:
+            total += stop - max(start, end)
+            end = stop
+    return total
+
+
+class Profiler:
+    """
+    Records how long psync spends in each phase (loading the config, resolving hosts, building commands and file
+    lists) and in every subprocess, as complete events of a Chrome trace (which can be opened with Perfetto or
+    chrome://tracing), along with a summary of the wall time per phase.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path: Optional[Path] = None
+        self.start = time.perf_counter()
+        self.events: List[dict] = []
+        self._lock = threading.Lock()
+
+    def enable(self, path: Optional[str] = None):
+        self.enabled = True
+        if path is not None:
+            self.path = Path(path).expanduser()
+
+    def record(self, name: str, category: str, start: float, elapsed: float, **args):
+        """Adds an event which started at `start` (a time.perf_counter value) and lasted `elapsed` seconds."""
+        if not self.enabled:
+            return
+
+        event = dict(
+            name=name,
+            cat=category,
+            ph="X",
+            ts=(start - self.start) * 1e6,
+            dur=elapsed * 1e6,
+            pid=os.getpid(),
+            tid=threading.get_ident(),
+            args=args,
+        )
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.perf_counter() - start, **args)
+
+    def record_process(self, argv: Sequence[str], returncode: int, elapsed: float):
+        # called once the process is done, see psync.runner
+        command = " ".join(argv)
+        self.record(
+            os.path.basename(argv[0]),
+            PROCESS,
+            time.perf_counter() - elapsed,
+            elapsed,
+            command=command if len(command) < 500 else command[:500] + "...",
+            returncode=returncode,
+        )
+
+    def phases(self) -> Dict[str, Tuple[int, float]]:
+        """Calls and wall time (overlapping events are counted once) per phase."""
+        by_category: Dict[str, List[Tuple[float, float]]] = {}
+        for event in self.events:
+            start = event["ts"] / 1e6
+            by_category.setdefault(event["cat"], []).append(
+                (start, start + event["dur"] / 1e6)
+            )
+        return {
+            category: (len(intervals), union(intervals))
+            for category, intervals in by_category.items()
+        }
+
+    def write(self, command: str) -> Path:
+        path = self.path
+        if path is None:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            path = cache_dir("profiles") / f"{stamp}-{command}.json"
+
+        names = {threading.main_thread().ident: "main"}
+        for thread in threading.enumerate():
+            names.setdefault(thread.ident, thread.name)
+        metadata = [
+            dict(
+                name="thread_name",
+                ph="M",
+                pid=os.getpid(),
+                tid=tid,
+                args=dict(name=names.get(tid, str(tid))),
+            )
+            for tid in {event["tid"] for event in self.events}
+        ]
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(
+            json.dumps(
+                dict(traceEvents=metadata + self.events, displayTimeUnit="ms"),
+            )
+        )
+        return path
+
+    def print_summary(self, total: float, processes: Dict):
+        """`processes` are the per-program stats of psync.runner.process_stats."""
+        phases = self.phases()
+        _, in_processes = phases.get(PROCESS, (0, 0.0))
+
+        header = ("phase", "calls", "wall time", "share")
+        rows = [
+            (category, str(calls), f"{elapsed * 1000:.1f}ms", f"{elapsed / total:.0%}")
+            for category, (calls, elapsed) in phases.items()
+        ]
+        # whatever is not spent waiting for a subprocess: imports, argument parsing, Python code
+        own = max(total - in_processes, 0.0)
+        rows += [
+            (
+                "psync (outside processes)",
+                "",
+                f"{own * 1000:.1f}ms",
+                f"{own / total:.0%}",
+            ),
+            ("total", "", f"{total * 1000:.1f}ms", "100%"),
+        ]
+        self.print_table(header, rows)
+
+        if len(processes) > 0:
+            header = ("program", "spawned", "time")
+            rows = [
+                (name, str(stats.count), f"{stats.elapsed * 1000:.1f}ms")
+                for name, stats in sorted(
+                    processes.items(), key=lambda item: -item[1].elapsed
+                )
+            ]
+            self.print_table(header, rows)
+
+    @staticmethod
+    def print_table(header: Tuple[str, ...], rows: List[Tuple[str, ...]]):
+        widths = [
+            max(len(row[i]) for row in [header] + rows) for i in range(len(header))
+        ]
+        print()
+        for row in [header] + rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print(line.rstrip())
+
+
+profiler = Profiler()
+
+
+def span(name: str, category: str, **args):
+    """A context manager (or decorator) timing a phase, which does nothing unless profiling is enabled."""
+    return profiler.span(name, category, **args)
+
+
+def enable_from_argv(argv: List[str]) -> bool:
+    """
+    Enables profiling if $PSYNC_PROFILE is set (to 1, or to the path of the trace) or `argv` contains --profile (or
+    --profile=PATH), which is removed from it so that any command accepts it.
+    """
+    path, enabled = None, False
+
+    env = os.environ.get(PROFILE_ENV, "")
+    if env.lower() not in ("", "0", "false", "no"):
+        enabled = True
+        if env.lower() not in ("1", "true", "yes"):
+            path = env
+
+    for arg in list(argv[1:]):
+        if arg == PROFILE_FLAG or arg.startswith(f"{PROFILE_FLAG}="):
+            argv.remove(arg)
+            enabled = True
+            path = arg.split("=", 1)[1] if "=" in arg else path
+
+    if enabled:
+        profiler.enable(path)
+    return enabled
@@ -1,12 +1,41 @@
+import asyncio
+import dataclasses
 import os
+import re
+import shlex
+import time
 from pathlib import Path
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from jsonargparse import ArgumentParser
 
 from psync import config as pconf
+from psync.chunked import DEFAULT_CHUNK_SIZE, DEFAULT_CONNECTIONS, ChunkedTransfer
 from psync.command import PsyncBaseCommand
-from psync.utils import run_command
+from psync.compression import AUTO, NO, YES, Compression, auto_compression, normalize
+from psync.config import PsyncReplicaConfig
+from psync.fanout import FanOut
+from psync.filters import DEFAULT_EXCLUSIONS, ExclusionMatcher, walk
+from psync.host_data import HostData
+from psync.ignore import load_rules
+from psync.index import ChangeIndex, ReplicaStates
+from psync.local import DEFAULT_WORKERS, LocalTransfer
+from psync.plan import PLAN_TTL, THROUGHPUT_TTL, Plan
+from psync.probe import DEFAULT_TTL, ProbeResult, ReplicaProber, probe_online
+from psync.profiling import COMMAND, FILE_LIST, span
+from psync.resume import ResumableTransfer
+from psync.runner import check_output
+from psync.shards import ShardedTransfer, parse_listing
+from psync.snapshots import RetentionPolicy, SnapshotStore
+from psync.swarm import SwarmTransfer
+from psync.telemetry import MetricsLog, TransferRecord, TransferStats, stream_transfer
+from psync.utils import format_duration, format_size, parse_size, write_files_from
+
+# e.g. rsync: [sender] link_stat "/path/to/file" failed: No such file or directory (2)
+LINK_STAT_ERROR = re.compile(
+    r'link_stat "(?P<path>.*)" failed: (?P<reason>.*?)(?: \(\d+\))?$'
+)
 
 CONSTS = {
     "host": "PSYNC_REMOTE_HOST",
@@ -19,12 +48,142 @@ CONSTS = {
 }
 
 
+@dataclass
+class Transfer:
+    mode: str
+    replica: PsyncReplicaConfig
+    host: HostData  # filled, with the port override applied
+    options: List[str]  # the rsync command, up to the source (excluded)
+    local: str
+    remote: str
+    delete: bool = False
+    compression: Compression = field(default_factory=Compression)
+
+    @property
+    def src(self) -> str:
+        return self.local if self.mode == "push" else self.remote
+
+    @property
+    def tgt(self) -> str:
+        return self.remote if self.mode == "push" else self.local
+
+    @property
+    def same_host(self) -> bool:
+        # the replica is a path on this machine: no SSH, nor compression
+        return self.host.is_local
+
+    @property
+    def remote_path(self) -> str:
+        return self.remote if self.same_host else self.remote.split(":", 1)[1]
+
+    def command(
+        self,
+        files_from: Optional[str] = None,
+        recursive: bool = True,
+        extra: Sequence[str] = (),
+        delete: Optional[bool] = None,
+    ) -> List[str]:
+        options = self.options + list(extra)
+
+        # rsync refuses --delete without recursion
+        if (self.delete if delete is None else delete) and recursive:
+            options.append("--delete")
+
+        if files_from is not None:
+            # -r is needed as --files-from disables the recursion implied by -a
+            if recursive:
+                options.append("-r")
+            options += ["--from0", f"--files-from={files_from}"]
+
+        return options + [self.src, self.tgt]
+
+    def list_command(
+        self, files_from: Optional[str] = None, extra: Sequence[str] = ()
+    ) -> List[str]:
+        # without a target, rsync lists the source files instead of copying them
+        return self.command(files_from, extra=["--list-only", *extra])[:-1]
+
+
 class PushPullCommand(PsyncBaseCommand):
+    def __init__(self):
+        # push or pull (see PlanCommand)
+        self.mode = self.name
+        # measured in advance for the compression of several transfers, see fan_out
+        self.probes: Dict[str, ProbeResult] = {}
+
     def parser(self) -> Optional[ArgumentParser]:
         parser = ArgumentParser(
             description="A glorified rsync which works with default remotes."
         )
 
+        self.add_transfer_arguments(parser)
+
+        parser.add_argument(
+            "-n",
+            "--confirm",
+            action="store_true",
+            help=f'Print the constructed rsync command before execution (enabled if ${CONSTS["confirm"]}) is set)',
+        )
+
+        parser.add_argument(
+            "--streams",
+            type=int,
+            default=1,
+            help="Number of parallel rsync streams, each one transferring a size-balanced shard of the files (or "
+            "of copying workers, for replicas on this machine)",
+        )
+
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Keep partially transferred files and retry when the connection drops, resuming where the transfer "
+            "stopped (also after restarting psync with the same arguments)",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=5,
+            help="Maximum number of retries with --resume",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=60,
+            help="Seconds without any data exchanged after which rsync gives up, with --resume",
+        )
+
+        parser.add_argument(
+            "--plan",
+            action="store_true",
+            help="Run the file list computed by psync plan with the same arguments (in the last "
+            f"{PLAN_TTL // 60} minutes), instead of comparing the folders again",
+        )
+
+        parser.add_argument(
+            "--large-files",
+            default=None,
+            help="Transfer the files larger than this size (e.g. 10G, in powers of 1024) as byte ranges over "
+            f"parallel connections (as many as --streams, or {DEFAULT_CONNECTIONS}), verifying each range and "
+            "resuming them after an interruption",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            default=DEFAULT_CHUNK_SIZE,
+            help="Size of the ranges of --large-files (in powers of 1024, e.g. 256M is 256 MiB)",
+        )
+
+        parser.add_argument(
+            "--metrics-file",
+            default=None,
+            help="JSON-lines file where the statistics of each transfer are appended (defaults to "
+            ".psync/transfers.jsonl in the project)",
+        )
+
+        return parser
+
+    @staticmethod
+    def add_transfer_arguments(parser: ArgumentParser):
+        """The arguments which define a transfer, shared with psync plan."""
         parser.add_argument("destination", default=None, nargs="?")
 
         parser.add_argument(
@@ -57,6 +216,11 @@ class PushPullCommand(PsyncBaseCommand):
             type=str,
             help="Exclusion patterns provided to rsync",
         )
+        parser.add_argument(
+            "--no-ignore",
+            action="store_true",
+            help="Do not apply the exclusions of .gitignore/.psyncignore files",
+        )
 
         parser.add_argument(
             "-p",
@@ -72,12 +236,12 @@ class PushPullCommand(PsyncBaseCommand):
             action="store_true",
             help=f'Activates rsync compression (defaults to ${CONSTS["compress"]})',
         )
-
         parser.add_argument(
-            "-n",
-            "--confirm",
-            action="store_true",
-            help=f'Print the constructed rsync command before execution (enabled if ${CONSTS["confirm"]}) is set)',
+            "--compression",
+            choices=[YES, NO, AUTO],
+            default=None,
+            help="Whether to compress: auto picks the algorithm and level depending on the link speed and the "
+            f'share of already compressed files (defaults to ${CONSTS["compress"]})',
         )
 
         parser.add_argument(
@@ -87,40 +251,644 @@ class PushPullCommand(PsyncBaseCommand):
             f'command (enabled if ${CONSTS["debug"]}) is set)',
         )
 
-        return parser
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete files in the target which do not exist in the source",
+        )
 
     def run(self, config):
-        mode = self.name
-        cwd = Path.cwd()
+        self.split_destination(config)
 
-        compress_flag = "z" if config.compress else ""
-        exclusions = ""
+        if config.debug:
+            print(config)
 
-        default_exclusions = [".vscode", ".idea", ".git"]
-        exclusions_list = default_exclusions + (config.exclude or [])
+        fan_out = getattr(config, "to", None) or getattr(config, "all", False)
+        if config.resume and (fan_out or config.streams > 1):
+            print("--resume cannot be combined with --streams or --to/--all.")
+            exit(1)
 
-        for exclusion in exclusions_list:
-            exclusions += f'--exclude "{exclusion}" '
+        snapshot = getattr(config, "snapshot", False)
+        if snapshot and (fan_out or config.streams > 1 or len(config.files) > 0):
+            print("--snapshot cannot be combined with files, --streams or --to/--all.")
+            exit(1)
 
-        destination = config.destination
+        if getattr(config, "large_files", None) is not None and (fan_out or snapshot):
+            print("--large-files cannot be combined with --snapshot or --to/--all.")
+            exit(1)
+
+        sources = getattr(config, "sources", None)
+        if config.plan and (
+            fan_out or snapshot or sources or config.streams > 1 or config.resume
+        ):
+            print(
+                "--plan cannot be combined with --streams, --resume, --snapshot, --from or --to/--all."
+            )
+            exit(1)
+
+        if sources is not None and config.destination is not None:
+            # the sources replace the destination, so it can only be a file
+            config.files.insert(0, config.destination)
+            config.destination = None
+        if sources is not None and (
+            config.resume
+            or config.streams > 1
+            or config.large_files is not None
+            or config.fastest
+        ):
+            print(
+                "--from cannot be combined with --fastest, --resume, --streams or --large-files."
+            )
+            exit(1)
+
+        if fan_out:
+            self.fan_out(config)
+            return
+
+        if sources is not None:
+            self.swarm_pull(config)
+            return
+
+        dest = self.destination(config)
+        transfer = self.transfer(config, dest)
+
+        if snapshot:
+            returncode = self.push_snapshot(config, transfer)
+            self.forget_index([dest.alias])
+            exit(returncode)
+
+        if config.plan:
+            plan = self.saved_plan(config, transfer)
+            print(
+                f"Running the plan computed {format_duration(time.time() - plan.created)} ago."
+            )
+            returncode = self.execute(config, transfer, None, None, {}, plan)
+            if self.mode == "push":
+                self.forget_index([dest.alias])
+            if returncode != 0:
+                exit(returncode)
+            return
+
+        index, scanned = None, None
+        if self.uses_index(config):
+            with span("changed files", FILE_LIST, replica=dest.alias):
+                index = ChangeIndex(Path(pconf.project), dest.alias).load()
+                scanned = index.scan(
+                    Path(transfer.local),
+                    self.matcher(config, Path(transfer.local), dest),
+                )
+                files = self.changed_files(config, index, scanned, transfer)
+            if files is not None and len(files) == 0:
+                print(f"Nothing changed since the last push to {dest.alias}.")
+                return
+            invalid = {}
+        else:
+            files, invalid = self.split_files(
+                config.files, Path(transfer.local), self.mode == "push"
+            )
+            if len(config.files) > 0 and len(files) == 0:
+                self.print_summary(len(config.files), invalid)
+                exit(1)
+
+        files_from = write_files_from(files) if files else None
+
+        try:
+            returncode = self.execute(config, transfer, files_from, files, invalid)
+        finally:
+            if files_from is not None:
+                os.remove(files_from)
+
+        if index is not None:
+            if returncode == 0:
+                token = index.mark_remote(transfer.host, dest)
+                index.update(scanned, Path(transfer.local), token)
+            else:
+                # we cannot know what made it to the replica
+                index.invalidate()
+
+        if returncode != 0:
+            exit(returncode)
+
+    def execute(
+        self,
+        config,
+        transfer: "Transfer",
+        files_from: Optional[str],
+        files: Optional[List[str]],
+        invalid: Dict[str, str],
+        plan: Optional[Plan] = None,
+    ) -> int:
+        chunked = self.chunked_transfer(config, transfer, files_from)
+        if chunked is None:
+            return self.run_transfer(config, transfer, files_from, files, invalid, plan)
+
+        if len(chunked.files) > 0 and self.should_confirm(config):
+            chunked.print_files()
+
+        # the large files are excluded from rsync, and sent afterwards
+        returncode = self.run_transfer(
+            config, chunked.rest(), files_from, files, invalid, plan
+        )
+        if len(chunked.files) == 0:
+            return returncode
+
+        chunked_returncode, stats, elapsed = chunked.run()
+        self.log_transfer(
+            config, transfer, chunked_returncode, stats, elapsed, label="chunked"
+        )
+        return max(returncode, chunked_returncode)
+
+    def chunked_transfer(
+        self, config, transfer: "Transfer", files_from: Optional[str]
+    ) -> Optional[ChunkedTransfer]:
+        # replicas on this machine are copied with reflinks or copy_file_range, which are already as fast as it gets
+        if getattr(config, "large_files", None) is None or transfer.same_host:
+            return None
+
+        chunked = ChunkedTransfer(
+            transfer,
+            parse_size(config.large_files, 1024),
+            parse_size(config.chunk_size, 1024),
+            connections=config.streams if config.streams > 1 else DEFAULT_CONNECTIONS,
+            retries=config.retries,
+        )
+        if not chunked.select(files_from):
+            exit(1)
+        return chunked
+
+    def run_transfer(
+        self,
+        config,
+        transfer: "Transfer",
+        files_from: Optional[str],
+        files: Optional[List[str]],
+        invalid: Dict[str, str],
+        plan: Optional[Plan] = None,
+    ) -> int:
+        command = transfer.command(files_from)
+        confirm = self.should_confirm(config)
+
+        if confirm and plan is None:
+            # the dry run shows what is going to happen, then its file list is run without comparing the folders again
+            plan = Plan.compute(transfer, files_from, files)
+
+        plan_from = None
+        if plan is not None and config.streams == 1 and not config.resume:
+            if len(plan.entries) == 0:
+                print("Nothing to transfer.")
+                plan.remove()
+                return 0
+
+            plan_from = write_files_from(plan.files_from(transfer.delete))
+            command = transfer.command(
+                plan_from, recursive=False, extra=plan.options(transfer.delete)
+            )
+
+        # same-host replicas are copied natively, unless rsync is needed for the plan or --resume
+        native = transfer.same_host and plan_from is None and not config.resume
+
+        try:
+            if confirm:
+                if native:
+                    print(f"Local copy: {transfer.src} -> {transfer.tgt}")
+                else:
+                    print("Command to be executed:")
+                    print("  ", shlex.join(command))
+                if plan is not None:
+                    self.print_plan(transfer, plan)
+                elif files_from is not None:
+                    print(f"Files ({len(files)}):")
+                    for file in files:
+                        print("  ", file)
+                if config.streams > 1:
+                    print(
+                        f"Split into {config.streams} parallel {'workers' if native else 'streams'}"
+                    )
+
+                self.confirm()
+
+            if native:
+                return self.copy_locally(config, transfer, files, invalid)
 
+            if config.debug:
+                print("Executing", shlex.join(command))
+
+            if config.streams > 1:
+                sharded = ShardedTransfer(transfer, config.streams, files_from)
+                returncode = sharded.run()
+                for shard, status in sharded.statuses.items():
+                    self.log_transfer(
+                        config,
+                        transfer,
+                        status.returncode,
+                        status.stats,
+                        status.elapsed,
+                        label=shard,
+                    )
+                if len(invalid) > 0:
+                    self.print_summary(len(config.files), invalid)
+                return returncode
+
+            capture_stderr = len(config.files) > 0
+            if config.resume:
+                resumable = ResumableTransfer(
+                    transfer,
+                    files_from,
+                    files,
+                    retries=config.retries,
+                    timeout=config.timeout,
+                    log=lambda code, stats, elapsed, label: self.log_transfer(
+                        config, transfer, code, stats, elapsed, label
+                    ),
+                )
+                returncode, stderr = resumable.run(capture_stderr)
+            else:
+                returncode, stderr, stats, elapsed = stream_transfer(
+                    command, capture_stderr
+                )
+                self.log_transfer(
+                    config,
+                    transfer,
+                    returncode,
+                    stats,
+                    elapsed,
+                    label="plan" if plan_from is not None else None,
+                )
+                if returncode == 0 and plan_from is not None:
+                    plan.remove()
+        finally:
+            if plan_from is not None:
+                os.remove(plan_from)
+
+        if len(config.files) == 0:
+            return returncode
+
+        invalid.update(self.missing_from_stderr(stderr, transfer.src))
+
+        if returncode != 0 or len(invalid) > 0:
+            self.print_summary(len(config.files), invalid, stderr, returncode)
+
+        return returncode
+
+    def copy_locally(
+        self,
+        config,
+        transfer: "Transfer",
+        files: Optional[List[str]],
+        invalid: Dict[str, str],
+    ) -> int:
+        local = LocalTransfer(
+            Path(transfer.src),
+            Path(transfer.tgt),
+            self.matcher(config, Path(transfer.local), transfer.replica),
+            files or None,
+            transfer.delete,
+            workers=config.streams if config.streams > 1 else DEFAULT_WORKERS,
+        )
+        returncode, stats, elapsed = local.run()
+        self.log_transfer(config, transfer, returncode, stats, elapsed, label="local")
+
+        invalid.update(local.missing)
+        if len(config.files) > 0 and (returncode != 0 or len(invalid) > 0):
+            self.print_summary(len(config.files), invalid, returncode=returncode)
+        return returncode
+
+    def push_snapshot(self, config, transfer: "Transfer") -> int:
+        dest = transfer.replica
+        if transfer.remote_path != f"{dest.absolute_path}/":
+            print(
+                "Snapshots are taken of the whole project: run psync push --snapshot from its root, without --remote."
+            )
+            return 1
+
+        store = SnapshotStore(dest, transfer.host)
+        snapshots = store.list(create=True)
+        if snapshots is None:
+            return 1
+
+        name = store.new_name()
+        extra = []
+        if len(snapshots) > 0:
+            # unchanged files become hard links to those of the previous snapshot: nothing is sent, nor stored
+            extra.append(f"--link-dest={store.path(snapshots[-1])}")
+
+        snapshot = dataclasses.replace(
+            transfer, remote=store.target(name), delete=False
+        )
+        command = snapshot.command(extra=extra)
+
+        if self.should_confirm(config):
+            print("Command to be executed:")
+            print("  ", shlex.join(command))
+            self.confirm()
+
+        if config.debug:
+            print("Executing", shlex.join(command))
+
+        returncode, _, stats, elapsed = stream_transfer(command, capture_stderr=False)
+        self.log_transfer(
+            config, snapshot, returncode, stats, elapsed, label=f"snapshot-{name}"
+        )
+        if returncode != 0:
+            return returncode
+
+        policy = RetentionPolicy.for_replica(dest)
+        expired = policy.expired(snapshots + [name])
+        if not store.finalize(name, expired):
+            return 1
+
+        basis = f" (unchanged files linked to {snapshots[-1]})" if snapshots else ""
+        print(f"Snapshot {name} pushed to {dest.alias}{basis}.")
+        if len(expired) > 0:
+            print(f"Removed {len(expired)} expired snapshot(s), keeping {policy}.")
+        return 0
+
+    @staticmethod
+    def split_destination(config):
         # destination might actually be a file...
         # if that's the case, set it to None and prepend the file to the list of files
-        if destination is not None and (cwd / destination).exists():
+        destination = config.destination
+        if destination is not None and (Path.cwd() / destination).exists():
             config.destination = None
             config.files.insert(0, destination)
 
-        if config.debug:
-            print(config)
+    def destination(self, config) -> PsyncReplicaConfig:
+        if getattr(config, "fastest", False):
+            config.destination = self.fastest_replica()
+
+        if config.destination is not None:
+            return pconf.replicas[config.destination]
+        return pconf.default_replica
 
-        dest = (
-            pconf.replicas[config.destination]
-            if config.destination is not None
-            else pconf.default_replica
+    def saved_plan(self, config, transfer: "Transfer") -> Plan:
+        """The plan saved by psync plan for `transfer`, as long as its source did not change since then."""
+        files, _ = self.split_files(
+            config.files, Path(transfer.local), self.mode == "push"
         )
+        plan = Plan.load(transfer, files)
+        if plan is None:
+            print(
+                f"No plan from the last {PLAN_TTL // 60} minutes for this transfer: run psync plan {self.mode} "
+                "with the same arguments first."
+            )
+            exit(1)
+
+        changed = self.changed_since(config, transfer, files, plan.created)
+        if changed is None or len(changed) > 0:
+            reason = (
+                "the source could not be listed"
+                if changed is None
+                else f"{len(changed)} file(s) changed since then, e.g. {changed[0]}"
+            )
+            print(f"The plan is outdated ({reason}): run psync plan {self.mode} again.")
+            exit(1)
+        return plan
+
+    def changed_since(
+        self, config, transfer: "Transfer", files: Optional[List[str]], since: float
+    ) -> Optional[List[str]]:
+        """The files of the source (among `files`, if any) modified or created after `since`, or None if unknown."""
+        if self.mode == "push":
+            root = Path(transfer.local)
+            # the ctime also changes when a file is created, moved or copied with its modification time
+            states = {
+                path: max(stat.st_mtime, stat.st_ctime)
+                for path, stat in walk(
+                    root, self.matcher(config, root, transfer.replica)
+                )
+            }
+        else:
+            replica = self.replica_states(transfer)
+            if replica is None:
+                return None
+            states = {path: mtime or 0 for path, (_, mtime) in replica.items()}
+
+        return sorted(
+            path
+            for path, mtime in states.items()
+            if mtime > since
+            and (
+                not files
+                or any(path == file or path.startswith(file + "/") for file in files)
+            )
+        )
+
+    @staticmethod
+    def print_plan(transfer: "Transfer", plan: Plan):
+        directories = plan.directories()
+        header = ("directory", "files", "size", "deleted")
+        rows = [
+            (
+                name,
+                str(directory.files),
+                format_size(directory.size),
+                str(directory.deleted),
+            )
+            for name, directory in directories.items()
+        ]
+        files = sum(directory.files for directory in directories.values())
+        deleted = sum(directory.deleted for directory in directories.values())
+        rows.append(("total", str(files), format_size(plan.size), str(deleted)))
+
+        print(f"Plan ({transfer.mode} {transfer.replica.alias}):")
+        widths = [
+            max(len(row[i]) for row in [header] + rows) for i in range(len(header))
+        ]
+        for row in [header] + rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print("  ", line.rstrip())
+
+        others = len(plan.entries) - files - deleted
+        if others > 0:
+            print(f"Plus {others} folder(s), link(s) or attribute change(s).")
+        if plan.stats.total_size > 0:
+            print(
+                f"{format_size(plan.size)} to send, out of {format_size(plan.stats.total_size)} "
+                "(rsync's delta transfer may send less)."
+            )
+
+        if plan.size == 0:
+            return
+
+        prober = ReplicaProber(THROUGHPUT_TTL)
+        result = prober.probe([transfer.replica])[0]
+        if result.throughput is None and time.time() - result.timestamp > DEFAULT_TTL:
+            # an old failed measurement, the replica might be back online
+            result = prober.probe([transfer.replica], refresh=True)[0]
+
+        if result.local:
+            print(f"Estimated time: unknown ({transfer.replica.alias} is local).")
+        elif result.throughput is None:
+            print(
+                f"Estimated time: unknown ({transfer.replica.alias} could not be measured)."
+            )
+        else:
+            print(
+                f"Estimated time: {format_duration(plan.size / result.throughput)} at "
+                f"{format_size(result.throughput)}/s (measured "
+                f"{format_duration(time.time() - result.timestamp)} ago)."
+            )
+
+    def uses_index(self, config) -> bool:
+        # the index tracks what was pushed to the replica's path, and only makes sense when pushing the whole folder
+        return (
+            self.mode == "push"
+            and not getattr(config, "full", True)
+            and len(config.files) == 0
+            and config.remote is None
+            and config.local is None
+        )
+
+    @staticmethod
+    def changed_files(
+        config, index: ChangeIndex, scanned, transfer: "Transfer"
+    ) -> Optional[List[str]]:
+        """
+        Returns the files to push according to the index, or None if the whole folder must be pushed (i.e., the
+        replica changed since the last push or deleted files need to be removed from it).
+        """
+        if index.token is None:
+            return None
+
+        if index.remote_token(transfer.host, transfer.replica) != index.token:
+            print(
+                f"Replica {transfer.replica.alias} changed since the last push, pushing the whole folder."
+            )
+            index.invalidate()
+            return None
+
+        root = Path(transfer.local)
+        changed, deleted = index.diff(scanned, root)
+        if len(deleted) > 0 and config.delete:
+            return None
+        if not config.check_drift:
+            return changed
+
+        # the files edited on the replica itself, which the token cannot tell: this needs a listing of the replica
+        replica = PushPullCommand.replica_states(transfer)
+        if replica is None:
+            return None
+
+        drifted, extra = index.drift(replica, root)
+        if config.delete and len(extra) > 0:
+            return None
+
+        # those deleted here as well are left alone, as by a push without --delete
+        drifted = [path for path in drifted if index.prefix(root) + path in scanned]
+        if len(drifted) > 0:
+            print(
+                f"{len(drifted)} file(s) changed on {transfer.replica.alias} since the last push, sending them again."
+            )
+        return sorted(set(changed) | set(drifted))
+
+    @staticmethod
+    def forget_index(aliases: List[str]):
+        # for the pushes which do not go through the index: the next one compares the whole folder again
+        if pconf.found and pconf.project is not None:
+            for alias in aliases:
+                ChangeIndex(Path(pconf.project), alias).invalidate()
+
+    @staticmethod
+    def replica_states(transfer: "Transfer") -> Optional[ReplicaStates]:
+        """The size and modification time of the files on the replica, according to rsync (with the same filters)."""
+        listing = check_output(
+            dataclasses.replace(transfer, mode="pull").list_command(
+                extra=["--no-human-readable"]
+            )
+        )
+        if listing is None:
+            return None
+
+        return {
+            # symlinks keep their own modification time only where rsync can set it
+            entry.path: (entry.size, entry.mtime if entry.type != "l" else None)
+            for entry in parse_listing(listing)
+            if entry.type != "d"
+        }
+
+    @staticmethod
+    def metrics_log(config) -> Optional[MetricsLog]:
+        path = getattr(config, "metrics_file", None)
+        if path is not None:
+            return MetricsLog(Path(path).expanduser())
+        if pconf.found:
+            return MetricsLog(Path(pconf.project) / ".psync" / "transfers.jsonl")
+        return None
+
+    def log_transfer(
+        self,
+        config,
+        transfer: "Transfer",
+        returncode: int,
+        stats: TransferStats,
+        elapsed: float,
+        label: Optional[str] = None,
+    ):
+        log = self.metrics_log(config)
+        if log is None:
+            return
+
+        record = TransferRecord(
+            mode=transfer.mode,
+            replica=transfer.replica.alias,
+            source=transfer.src,
+            target=transfer.tgt,
+            returncode=returncode,
+            wall_time=elapsed,
+            stats=stats,
+            compression=str(transfer.compression),
+            label=label,
+        )
+        log.append(record)
+
+        if config.debug:
+            print(
+                f"Transfer of {format_size(stats.transferred_size)} "
+                f"({format_size(stats.literal_data)} literal, {format_size(stats.matched_data)} matched, "
+                f"speedup {stats.speedup:.2f}) in {elapsed:.1f}s, logged to {log.path}"
+            )
+
+    @staticmethod
+    def exclusions(config, dest: Optional[PsyncReplicaConfig] = None) -> List[str]:
+        replica = dest.exclude if dest is not None else []
+        return DEFAULT_EXCLUSIONS + replica + (config.exclude or [])
+
+    @staticmethod
+    def ignore_project(config, root: Path) -> Optional[Path]:
+        """The folder whose ignore files apply to a transfer of `root` (None if they are disabled)."""
+        if getattr(config, "no_ignore", False):
+            return None
+
+        if pconf.found:
+            project = Path(pconf.project).expanduser().absolute()
+            if root == project or project in root.parents:
+                return project
+        return root
+
+    def matcher(
+        self, config, root: Path, dest: Optional[PsyncReplicaConfig] = None
+    ) -> ExclusionMatcher:
+        matcher = ExclusionMatcher(self.exclusions(config, dest))
+        project = self.ignore_project(config, root)
+        if project is None:
+            return matcher
+        return load_rules(project, matcher).matcher_for(root)
+
+    def transfer(self, config, dest: PsyncReplicaConfig) -> "Transfer":
+        with span("transfer", COMMAND, replica=dest.alias):
+            return self.build_transfer(config, dest)
+
+    def build_transfer(self, config, dest: PsyncReplicaConfig) -> "Transfer":
+        cwd = Path.cwd()
+
+        exclusions = []
+
+        for exclusion in self.exclusions(config, dest):
+            exclusions += ["--exclude", exclusion]
+
         hostdata = dest.hostdata.filled
-        port = config.port or hostdata.port
-        custom_ssh = "" if (port is None or port == 22) else f'-e "ssh -p {port}" '
+        if config.port is not None:
+            hostdata.port = config.port
 
         remote = config.remote or dest.path
         local = config.local or pconf.project
@@ -148,47 +916,451 @@ class PushPullCommand(PsyncBaseCommand):
         if config.debug:
             print(relative, local, remote)
 
-        local_path = local
-        remote_path = f"{hostdata.user}@{hostdata.hostname}:{remote}"
+        project = self.ignore_project(config, Path(local))
+        if project is not None:
+            # after the exclusions, which must win over any negated pattern
+            rules = load_rules(project, ExclusionMatcher(self.exclusions(config, dest)))
+            filter_file = rules.filter_file(Path(local))
+            if filter_file is not None:
+                exclusions.append(f"--filter=merge {filter_file}")
+            if config.debug:
+                print(f"ignore rules ({len(rules.rules)}):", filter_file)
+
+        compression = self.compression(config, dest, hostdata, Path(local))
+        if config.debug:
+            print(f"compression ({dest.alias}):", compression)
 
-        if mode == "push":
-            src, tgt = local_path, remote_path
+        if hostdata.is_local:
+            # a path on this machine: rsync copies it directly, rather than through ssh to localhost
+            shell = []
+            target = remote
         else:
-            src, tgt = remote_path, local_path
+            shell = ["-e", hostdata.ssh_command]
+            target = f"{hostdata.user}@{hostdata.hostname}:{remote}"
 
-        pre_cmd = (
-            f"rsync {custom_ssh}-avh{compress_flag}P --info=progress2 {exclusions}"
+        # exact numbers: the --stats of every transfer are parsed (see TransferStats), and -h would round them
+        return Transfer(
+            mode=self.mode,
+            replica=dest,
+            host=hostdata,
+            options=["rsync"]
+            + shell
+            + ["-avP", "--no-human-readable", "--info=progress2", "--stats"]
+            + compression.options
+            + exclusions,
+            local=local,
+            remote=target,
+            delete=config.delete,
+            compression=compression,
         )
-        commands = []
 
-        if len(config.files) > 0:
-            for file in config.files:
-                file_sync_command = f"{pre_cmd}{src}{file} {tgt}{file}"
-                commands.append(file_sync_command)
+    def compression(
+        self, config, dest: PsyncReplicaConfig, hostdata: HostData, local: Path
+    ) -> Compression:
+        if hostdata.is_local:
+            # there is no link to save bandwidth on
+            return Compression(reason="local replica")
+
+        mode = self.compression_mode(config)
+        if mode == AUTO:
+            return auto_compression(
+                dest,
+                hostdata,
+                local,
+                self.matcher(config, local, dest),
+                self.probes.get(dest.alias),
+            )
+        if mode == YES:
+            return Compression("zlib")
+        return Compression()
+
+    @staticmethod
+    def compression_mode(config) -> str:
+        if getattr(config, "compression", None) is not None:
+            return config.compression
+        if config.compress:
+            return YES
+        return normalize(pconf.general.compress if pconf.found else None)
+
+    def fan_out(self, config):
+        if config.destination is not None:
+            print("A destination cannot be combined with --to/--all.")
+            exit(1)
+
+        if config.all:
+            aliases = [alias for alias in pconf.aliases if alias != pconf.general.local]
         else:
-            commands.append(f"{pre_cmd}{src} {tgt}")
+            aliases = [alias.strip() for alias in config.to.split(",") if alias]
 
-        if config.confirm or pconf.general.ask_confirm or config.debug:
+        unknown = [alias for alias in aliases if alias not in pconf.replicas]
+        if len(unknown) > 0:
+            valid = ", ".join(pconf.aliases)
+            print(f"{', '.join(unknown)} not among valid remotes: {valid}")
+            exit(1)
 
-            print("Command(s) to be executed:")
-            for command in commands:
-                print("  ", command)
+        if self.compression_mode(config) == AUTO:
+            # the links are measured all at once, rather than by each transfer in turn
+            replicas = [pconf.replicas[alias] for alias in aliases]
+            self.probes = {
+                result.alias: result for result in ReplicaProber().probe(replicas)
+            }
 
-            choice = input("Execute? [y/n]\n>>> ")
-            if choice != "y":
-                print("Exiting.")
-                exit(0)
+        transfers = [self.transfer(config, pconf.replicas[alias]) for alias in aliases]
 
-        for cmd in commands:
-            if config.debug:
-                print("Executing", cmd)
+        # offline replicas would only make their transfers hang until ssh times out
+        online = asyncio.run(
+            probe_online(
+                {transfer.replica.alias: transfer.host for transfer in transfers}
+            )
+        )
+        offline = [alias for alias, is_online in online.items() if not is_online]
+        if len(offline) > 0:
+            print(f"Skipping offline replica(s): {', '.join(offline)}")
+            transfers = [t for t in transfers if online[t.replica.alias]]
+            if len(transfers) == 0:
+                exit(1)
+
+        local = Path(transfers[0].local)
+        files, invalid = self.split_files(config.files, local, True)
+        if len(invalid) > 0:
+            self.print_summary(len(config.files), invalid)
+            if len(files) == 0:
+                exit(1)
+
+        files_from = write_files_from(files) if len(files) > 0 else None
+
+        try:
+            commands = {
+                transfer.replica.alias: transfer.command(files_from)
+                for transfer in transfers
+            }
+
+            if self.should_confirm(config):
+                print("Commands to be executed:")
+                for alias, command in commands.items():
+                    print(f"   [{alias}]", shlex.join(command))
+                self.confirm()
 
-            run_command(cmd, get_result=False)
+            fan_out = FanOut(commands, config.jobs)
+            returncode = fan_out.run()
+            self.forget_index([transfer.replica.alias for transfer in transfers])
+            for transfer in transfers:
+                status = fan_out.statuses[transfer.replica.alias]
+                self.log_transfer(
+                    config, transfer, status.returncode, status.stats, status.elapsed
+                )
+            exit(max(returncode, 1 if len(offline) > 0 else 0))
+
+        finally:
+            if files_from is not None:
+                os.remove(files_from)
+
+    def swarm_pull(self, config):
+        aliases = [alias.strip() for alias in config.sources.split(",") if alias]
+
+        unknown = [alias for alias in aliases if alias not in pconf.replicas]
+        if len(unknown) > 0:
+            valid = ", ".join(pconf.aliases)
+            print(f"{', '.join(unknown)} not among valid remotes: {valid}")
+            exit(1)
+
+        replicas = [pconf.replicas[alias] for alias in dict.fromkeys(aliases)]
+        results = {result.alias: result for result in ReplicaProber().probe(replicas)}
+        skipped = [
+            alias
+            for alias, result in results.items()
+            if not (result.online and result.has_data)
+        ]
+        if len(skipped) > 0:
+            print(
+                f"Skipping offline replica(s) or without the project: {', '.join(skipped)}"
+            )
+        replicas = [replica for replica in replicas if replica.alias not in skipped]
+        if len(replicas) == 0:
+            exit(1)
+
+        # the fastest first: the files are listed there
+        replicas.sort(key=lambda replica: results[replica.alias].rank, reverse=True)
+        transfers = [self.transfer(config, replica) for replica in replicas]
+
+        files, invalid = self.split_files(config.files, Path(transfers[0].local), False)
+        if len(config.files) > 0 and len(files) == 0:
+            self.print_summary(len(config.files), invalid)
+            exit(1)
+
+        files_from = write_files_from(files) if len(files) > 0 else None
+
+        try:
+            swarm = SwarmTransfer(
+                transfers,
+                {alias: result.throughput for alias, result in results.items()},
+            )
+            if not swarm.select(files_from):
+                exit(1)
+
+            if self.should_confirm(config):
+                print(f"Pulling {len(swarm.entries)} file(s) from:")
+                for alias, status in swarm.statuses.items():
+                    print(
+                        f"   [{alias}] {len(status.queue)} file(s), {format_size(status.remaining)} "
+                        f"(at {format_size(status.throughput)}/s)"
+                    )
+                self.confirm()
+
+            returncode = swarm.run()
+            for transfer in transfers:
+                status = swarm.statuses[transfer.replica.alias]
+                self.log_transfer(
+                    config,
+                    transfer,
+                    status.returncode,
+                    status.stats,
+                    status.elapsed,
+                    label="swarm",
+                )
+            swarm.print_summary()
+
+            if returncode == 0 and transfers[0].delete:
+                returncode = 0 if swarm.delete_extraneous(files_from) else 1
+        finally:
+            if files_from is not None:
+                os.remove(files_from)
+
+        if returncode == 0 and config.verify:
+            print("Verifying the checksums on every source...")
+            mismatches = swarm.verify()
+            if len(mismatches) > 0:
+                print(f"{len(mismatches)} file(s) differ between the sources:")
+                for file, disagreeing in mismatches.items():
+                    print(f"   {file}: {', '.join(disagreeing)}")
+                returncode = 1
+            else:
+                print(f"All {len(replicas)} source(s) agree.")
+
+        if len(invalid) > 0:
+            self.print_summary(len(config.files), invalid)
+        if returncode != 0:
+            exit(returncode)
+
+    @staticmethod
+    def fastest_replica() -> str:
+        local = pconf.general.local
+        replicas = [
+            replica for alias, replica in pconf.replicas.items() if alias != local
+        ]
+        results = [
+            result
+            for result in ReplicaProber().probe(replicas)
+            if result.online and result.has_data
+        ]
+
+        if len(results) == 0:
+            print("No online replica holds the project.")
+            exit(1)
+
+        best = max(results, key=lambda result: result.rank)
+        if best.local:
+            print(f"Fastest replica: {best.alias} (local)")
+        else:
+            print(
+                f"Fastest replica: {best.alias} ({format_size(best.throughput or 0)}/s, "
+                f"{best.ssh_ms:.0f}ms handshake)"
+            )
+        return best.alias
+
+    @staticmethod
+    def should_confirm(config) -> bool:
+        return config.confirm or pconf.general.ask_confirm or config.debug
+
+    @staticmethod
+    def confirm():
+        choice = input("Execute? [y/n]\n>>> ")
+        if choice != "y":
+            print("Exiting.")
+            exit(0)
+
+    @staticmethod
+    def split_files(
+        files: List[str], base: Path, check_exists: bool
+    ) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Normalizes `files` to paths relative to `base` (i.e., the folder being synchronized), returning the valid
+        ones along with the reason why each of the others has been discarded.
+        """
+        valid, invalid = [], {}
+
+        for file in files:
+            path = Path(file).expanduser()
+            if path.is_absolute():
+                try:
+                    path = path.relative_to(base)
+                except ValueError:
+                    invalid[file] = f"outside of {base}"
+                    continue
+
+            normalized = os.path.normpath(path)
+            if normalized == ".." or normalized.startswith("../"):
+                invalid[file] = f"outside of {base}"
+            elif check_exists and not (base / normalized).exists():
+                invalid[file] = "no such file or directory"
+            elif normalized not in valid:
+                valid.append(normalized)
+
+        return valid, invalid
+
+    @staticmethod
+    def missing_from_stderr(stderr: str, src: str) -> Dict[str, str]:
+        base = src.split(":", 1)[1] if ":" in src else src
+        missing = {}
+
+        for line in stderr.splitlines():
+            match = LINK_STAT_ERROR.search(line)
+            if match is not None:
+                path = match.group("path")
+                if path.startswith(base):
+                    path = path[len(base) :]
+                missing[path] = match.group("reason").lower()
+
+        return missing
+
+    @staticmethod
+    def print_summary(
+        n_files: int,
+        invalid: Dict[str, str],
+        stderr: str = "",
+        returncode: int = 0,
+    ):
+        if len(invalid) > 0:
+            print(f"Skipped {len(invalid)} out of {n_files} file(s):")
+            for file, reason in invalid.items():
+                print(f"   {file}: {reason}")
+
+        other_errors = [
+            line
+            for line in stderr.splitlines()
+            if line and LINK_STAT_ERROR.search(line) is None
+        ]
+        if returncode != 0 and len(other_errors) > 0:
+            print(f"rsync failed with exit code {returncode}:")
+            for line in other_errors:
+                print("  ", line)
 
 
 class PushCommand(PushPullCommand):
     name = "push"
 
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = super().parser()
+
+        parser.add_argument(
+            "--to",
+            default=None,
+            help="Comma-separated replicas to push to concurrently (e.g., r1,r2,r3)",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Push to all replicas (except the local one) concurrently",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=8,
+            help="Maximum number of concurrent transfers when using --to/--all",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Push the whole folder, instead of only the files changed since the last push",
+        )
+        parser.add_argument(
+            "--check-drift",
+            action="store_true",
+            help="Also list the replica to find the files edited there since the last push, and send them again",
+        )
+        parser.add_argument(
+            "--snapshot",
+            action="store_true",
+            help="Push the project into a new timestamped snapshot on the replica, hard-linking the files unchanged "
+            "since the previous one (see psync snapshots)",
+        )
+
+        return parser
+
 
 class PullCommand(PushPullCommand):
     name = "pull"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = super().parser()
+
+        parser.add_argument(
+            "--fastest",
+            action="store_true",
+            help="Pull from the fastest online replica which holds the project (see psync replicas status)",
+        )
+        parser.add_argument(
+            "--from",
+            dest="sources",
+            default=None,
+            help="Comma-separated replicas holding the same data (e.g., r1,r2,r3) to pull from at once, each one "
+            "sending a share of the files in proportion to its throughput",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="With --from, check that the pulled files have the same SHA-1 on every source",
+        )
+
+        return parser
+
+
+class PlanCommand(PushPullCommand):
+    name = "plan"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser(
+            description="Shows what a push/pull would transfer (per top-level directory) and roughly how long it "
+            "would take, without transferring anything."
+        )
+
+        parser.add_argument("mode", choices=["push", "pull"])
+        self.add_transfer_arguments(parser)
+
+        return parser
+
+    def run(self, config):
+        self.mode = config.mode
+        self.split_destination(config)
+
+        if config.debug:
+            print(config)
+
+        transfer = self.transfer(config, self.destination(config))
+
+        files, invalid = self.split_files(
+            config.files, Path(transfer.local), self.mode == "push"
+        )
+        if len(invalid) > 0:
+            self.print_summary(len(config.files), invalid)
+            if len(files) == 0:
+                exit(1)
+
+        files_from = write_files_from(files) if files else None
+        try:
+            plan = Plan.compute(transfer, files_from, files)
+        finally:
+            if files_from is not None:
+                os.remove(files_from)
+
+        if plan is None:
+            exit(1)
+
+        self.print_plan(transfer, plan)
+        if len(plan.entries) > 0:
+            plan.save()
+            print(
+                f"psync {self.mode} --plan with the same arguments transfers exactly these files, if run within "
+                f"the next {PLAN_TTL // 60} minutes."
+            )
@@ -1,4 +1,7 @@
 import os
+import subprocess
+import time
+from pathlib import Path
 from typing import Optional
 
 from jsonargparse import ArgumentParser
@@ -8,7 +11,10 @@ from psync.config import PsyncReplicaConfig
 from psync.host_data import HostData
 
 from psync import config as pconf
-from psync.utils import run_command
+from psync.connection import get_manager
+from psync.probe import DEFAULT_TTL, ReplicaProber
+from psync.runner import INHERIT, run
+from psync.utils import format_size
 
 
 class ListReplica(PsyncSubcommand):
@@ -119,22 +125,135 @@ class SetupReplica(PsyncSubcommand):
         #   - it returns 'ERROR: No identities found' in case no ssh key exists
         #   - it says 'All keys were skipped because they already exist on the remote system'
         #     if the key is already on the host, in which case we silently return
-        first_attempt = run_command(
-            f"ssh-copy-id -n {replica_host.ssh_connection}",
-            get_result=True,
-            from_stderr=True,
+        ssh_copy_id = (
+            ["ssh-copy-id"] + replica_host.ssh_options + replica_host.ssh_connection
         )
+        first_attempt = run(ssh_copy_id[:1] + ["-n"] + ssh_copy_id[1:]).stderr
 
         if "No identities found" in first_attempt:
-            # this command creates a no-passphrase ssh key under ~/.ssh/id_rsa
-            run_command('cat /dev/zero | ssh-keygen -q -N ""', get_result=False)
+            # creates a no-passphrase ssh key under ~/.ssh/id_rsa
+            key = Path("~/.ssh/id_rsa").expanduser()
+            key.parent.mkdir(mode=0o700, exist_ok=True)
+            run(
+                ["ssh-keygen", "-q", "-N", "", "-f", key],
+                stdin=subprocess.DEVNULL,
+                capture_stdout=False,
+                stderr=INHERIT,
+            ).check()
         elif "All keys were skipped" in first_attempt:
             print(
                 f"Alias {alias} -> {replica_host} skipped because the key is already added."
             )
             return
 
-        run_command(f"ssh-copy-id {replica_host.ssh_connection}", get_result=False)
+        run(ssh_copy_id, capture_stdout=False, stderr=INHERIT).check()
+
+
+class ConnectionsReplica(PsyncSubcommand):
+    name = "connections"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser()
+        parser.add_argument("alias", nargs="?", default=None)
+        parser.add_argument(
+            "--close", action="store_true", help="Close the open connection(s)"
+        )
+        return parser
+
+    def run(self, alias=None, close=False):
+        if alias is not None and alias not in pconf.aliases:
+            aliases = ", ".join(pconf.replicas_real.keys())
+            print(f"{alias} not among valid remotes: {aliases}")
+            return
+
+        manager = get_manager()
+        local = pconf.general.local
+        aliases = [alias] if alias is not None else pconf.aliases
+
+        n_open = 0
+        for alias_name in aliases:
+            if alias_name == local:
+                continue
+
+            host = pconf.replicas[alias_name].hostdata.filled
+            connections = manager.open_connections(host)
+            if connections == 0:
+                continue
+
+            n_open += 1
+            # the extra lanes opened by the parallel ranges of large files (see psync.chunked)
+            lanes = f" ({connections} connections)" if connections > 1 else ""
+            if close:
+                manager.close(host)
+                print(
+                    f"{alias_name} -> {host.user}@{host.hostname}:{host.port}    CLOSED{lanes}"
+                )
+            else:
+                print(
+                    f"{alias_name} -> {host.user}@{host.hostname}:{host.port}    OPEN{lanes}"
+                )
+
+        if n_open == 0:
+            print("No open connections.")
+
+
+class StatusReplica(PsyncSubcommand):
+    name = "status"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser()
+        parser.add_argument("alias", nargs="?", default=None)
+        parser.add_argument(
+            "--refresh", action="store_true", help="Ignore the cached measurements"
+        )
+        parser.add_argument(
+            "--ttl",
+            type=float,
+            default=DEFAULT_TTL,
+            help="Seconds after which cached measurements are refreshed",
+        )
+        return parser
+
+    def run(self, alias=None, refresh=False, ttl=DEFAULT_TTL):
+        if alias is not None and alias not in pconf.aliases:
+            aliases = ", ".join(pconf.replicas_real.keys())
+            print(f"{alias} not among valid remotes: {aliases}")
+            return
+
+        local = pconf.general.local
+        replicas = [
+            replica
+            for name, replica in pconf.replicas.items()
+            if name != local and alias in (None, name)
+        ]
+
+        header = ("replica", "status", "tcp", "ssh", "throughput", "age")
+        rows = []
+        for result in ReplicaProber(ttl).probe(replicas, refresh):
+            if not result.online:
+                status = f"offline ({result.error})"
+            else:
+                status = "local" if result.local else "online"
+                if not result.has_data:
+                    status += " (no data)"
+
+            rows.append(
+                (
+                    result.alias,
+                    status,
+                    f"{result.tcp_ms:.1f}ms" if result.tcp_ms is not None else "-",
+                    f"{result.ssh_ms:.0f}ms" if result.ssh_ms is not None else "-",
+                    f"{format_size(result.throughput)}/s" if result.throughput else "-",
+                    f"{time.time() - result.timestamp:.0f}s",
+                )
+            )
+
+        widths = [
+            max(len(row[i]) for row in [header] + rows) for i in range(len(header))
+        ]
+        for row in [header] + rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print(line.rstrip())
 
 
 # TODO: this requires pconf.general to actually be accessible (instead of returning a copy of the object)
@@ -162,5 +281,13 @@ class SetupReplica(PsyncSubcommand):
 #         )
 
 PsyncReplicasCommand = PsyncCommandWithSubcommands.create(
-    "replicas", (ListReplica, AddReplica, DelReplica, SetupReplica)
+    "replicas",
+    (
+        ListReplica,
+        AddReplica,
+        DelReplica,
+        SetupReplica,
+        ConnectionsReplica,
+        StatusReplica,
+    ),
 )
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Set, Tuple
+
+from psync.fanout import PROGRESS
+from psync.filters import PARTIAL_DIR
+from psync.shards import parse_listing
+from psync.telemetry import TransferStats, stream_transfer
+from psync.runner import check_output
+from psync.utils import cache_dir, write_files_from
+
+# rsync exit codes caused by the connection (rather than by the files), after which retrying makes sense
+RESUMABLE = {
+    10: "error in socket I/O",
+    12: "error in rsync protocol data stream",
+    30: "timeout in data send/receive",
+    35: "timeout waiting for daemon connection",
+    255: "connection failed",
+}
+MAX_BACKOFF = 60  # seconds
+
+# lines printed by rsync -v which are not the name of a transferred file
+NOT_A_NAME = re.compile(
+    r"^((sending|receiving) incremental file list|building file list.*|created directory .*|deleting .*|"
+    r"sent .* bytes .*|total size is .*|)$"
+)
+
+
+class Checkpoint:
+    """
+    The progress of a resumable transfer: the files it has to move (as listed by rsync after the first failure) and
+    those which are already done, stored in ~/.cache/psync/checkpoints/ so that a restart resumes from there.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.entries: Optional[List[str]] = None
+        self.completed: Set[str] = set()
+        self._current: Optional[str] = None
+
+    @classmethod
+    def for_transfer(cls, transfer, files: Optional[List[str]]) -> "Checkpoint":
+        signature = json.dumps([transfer.mode, transfer.src, transfer.tgt, files or []])
+        return cls(hashlib.sha1(signature.encode()).hexdigest()[:16]).load()
+
+    @property
+    def path(self) -> Path:
+        return cache_dir("checkpoints") / f"{self.key}.json"
+
+    def load(self) -> "Checkpoint":
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return self
+
+        self.entries = data["entries"]
+        self.completed = set(data["completed"])
+        return self
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps(dict(entries=self.entries, completed=sorted(self.completed)))
+        )
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+    @property
+    def remaining(self) -> List[str]:
+        return [entry for entry in self.entries if entry not in self.completed]
+
+    def feed(self, line: str):
+        # rsync prints the name of a file as it starts transferring it, so the previous one is complete
+        if PROGRESS.match(line) is not None or NOT_A_NAME.match(line) is not None:
+            return
+
+        if self._current is not None:
+            self.completed.add(self._current)
+        self._current = line.rstrip("/")
+
+    def end_attempt(self, success: bool):
+        if success and self._current is not None:
+            self.completed.add(self._current)
+        self._current = None
+
+
+class ResumableTransfer:
+    """
+    Runs a transfer keeping partially transferred files (in a partial-dir on the target) and retrying with an
+    exponential backoff when rsync fails because of the connection. After the first failure, the remaining attempts
+    only send the files which were not completed yet, then a final regular pass picks up anything that changed in
+    the meantime (and applies --delete, if requested).
+    """
+
+    def __init__(
+        self,
+        transfer,
+        files_from: Optional[str],
+        files: Optional[List[str]],
+        retries: int = 5,
+        timeout: int = 60,
+        backoff: float = 2.0,
+        log: Optional[Callable[[int, TransferStats, float, str], None]] = None,
+    ):
+        self.transfer = transfer
+        self.files_from = files_from
+        self.retries = retries
+        self.backoff = backoff
+        self.log = log
+        self.options = [f"--partial-dir={PARTIAL_DIR}", f"--timeout={timeout}"]
+        self.checkpoint = Checkpoint.for_transfer(transfer, files)
+
+    def run(self, capture_stderr: bool = True) -> Tuple[int, str]:
+        if self.checkpoint.entries is not None:
+            print(
+                f"Resuming the previous transfer: {len(self.checkpoint.remaining)} out of "
+                f"{len(self.checkpoint.entries)} file(s) left."
+            )
+
+        attempt = 0
+        while True:
+            returncode, stderr = self._attempt(attempt, capture_stderr)
+            if returncode == 0:
+                break
+
+            if returncode not in RESUMABLE or attempt >= self.retries:
+                if self.checkpoint.entries is not None:
+                    self.checkpoint.save()
+                    print("Progress saved, run the same command again to resume.")
+                return returncode, stderr
+
+            if self.checkpoint.entries is None:
+                self._list_entries()
+            if self.checkpoint.entries is not None:
+                self.checkpoint.save()
+
+            delay = min(self.backoff * 2**attempt, MAX_BACKOFF)
+            attempt += 1
+            print(
+                f"rsync failed with exit code {returncode} ({RESUMABLE[returncode]}), "
+                f"retrying in {delay:.0f}s ({attempt}/{self.retries})..."
+            )
+            time.sleep(delay)
+
+        if self.checkpoint.entries is not None:
+            # the files changed (or deleted) while we were retrying
+            returncode, stderr = self._attempt(attempt + 1, capture_stderr, final=True)
+
+        if returncode == 0:
+            self.checkpoint.remove()
+        return returncode, stderr
+
+    def _attempt(
+        self, attempt: int, capture_stderr: bool, final: bool = False
+    ) -> Tuple[int, str]:
+        remaining_from = None
+        if self.checkpoint.entries is None or final:
+            command = self.transfer.command(self.files_from, extra=self.options)
+        else:
+            # the remaining entries include their folders, so no recursion is needed
+            remaining_from = write_files_from(self.checkpoint.remaining)
+            command = self.transfer.command(
+                remaining_from, recursive=False, extra=self.options
+            )
+
+        try:
+            returncode, stderr, stats, elapsed = stream_transfer(
+                command, capture_stderr, on_line=self.checkpoint.feed
+            )
+        finally:
+            if remaining_from is not None:
+                os.remove(remaining_from)
+
+        self.checkpoint.end_attempt(returncode == 0)
+        if self.log is not None:
+            self.log(
+                returncode,
+                stats,
+                elapsed,
+                "final" if final else f"attempt-{attempt + 1}",
+            )
+
+        return returncode, stderr
+
+    def _list_entries(self):
+        listing = check_output(self.transfer.list_command(self.files_from))
+        if listing is not None:
+            self.checkpoint.entries = [entry.path for entry in parse_listing(listing)]
@@ -0,0 +1,394 @@
+import asyncio
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import IO, Callable, Dict, Iterable, List, Optional, Sequence
+
+from psync.profiling import profiler
+
+LineCallback = Callable[[str], None]
+
+# what to do with stderr
+CAPTURE, MERGE, INHERIT = "capture", "merge", "inherit"
+
+# rsync refreshes its progress with \r, so lines are split on both \r and \n to see every update
+LINE_SEPARATOR = re.compile(rb"[\r\n]")
+CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class CommandResult:
+    argv: List[str]
+    returncode: int
+    stdout: str = ""
+    stderr: str = ""
+    elapsed: float = 0.0
+    timed_out: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+    @property
+    def command(self) -> str:
+        return shlex.join(self.argv)
+
+    def check(self) -> bool:
+        """Returns whether the command succeeded, printing why it did not otherwise."""
+        if self.timed_out:
+            print(f'Command "{self.command}" timed out after {self.elapsed:.1f}s')
+        elif self.returncode != 0:
+            print(f'Command "{self.command}" failed with exit code {self.returncode}')
+        return self.ok
+
+
+@dataclass
+class ProcessStats:
+    count: int = 0
+    elapsed: float = 0.0
+
+
+_accounting: Dict[str, ProcessStats] = {}
+_accounting_lock = threading.Lock()
+
+
+def _account(result: CommandResult):
+    with _accounting_lock:
+        stats = _accounting.setdefault(result.argv[0], ProcessStats())
+        stats.count += 1
+        stats.elapsed += result.elapsed
+    profiler.record_process(result.argv, result.returncode, result.elapsed)
+
+
+def process_stats() -> Dict[str, ProcessStats]:
+    """Returns how many processes were spawned (and for how long they ran) per program, since psync started."""
+    with _accounting_lock:
+        return {
+            name: ProcessStats(stats.count, stats.elapsed)
+            for name, stats in _accounting.items()
+        }
+
+
+class LineSplitter:
+    def __init__(self, on_line: Optional[LineCallback]):
+        self.on_line = on_line
+        self.pending = b""
+
+    def feed(self, chunk: bytes):
+        if self.on_line is None:
+            return
+
+        *lines, self.pending = LINE_SEPARATOR.split(self.pending + chunk)
+        for line in lines:
+            if line:
+                self.on_line(line.decode("utf-8", errors="replace"))
+
+    def close(self):
+        if self.on_line is not None and self.pending:
+            self.on_line(self.pending.decode("utf-8", errors="replace"))
+        self.pending = b""
+
+
+def _decode(chunks: List[bytes]) -> str:
+    return b"".join(chunks).decode("utf-8", errors="replace")
+
+
+def _pump(
+    stream: IO[bytes],
+    chunks: Optional[List[bytes]],
+    on_line: Optional[LineCallback],
+    echo: bool,
+):
+    splitter = LineSplitter(on_line)
+
+    while True:
+        chunk = stream.read1(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        if chunks is not None:
+            chunks.append(chunk)
+        if echo:
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+        splitter.feed(chunk)
+
+    splitter.close()
+
+
+def run(
+    argv: Sequence[str],
+    *,
+    stdin=None,
+    capture_stdout: bool = True,
+    stderr: str = CAPTURE,
+    echo: bool = False,
+    on_stdout: Optional[LineCallback] = None,
+    on_stderr: Optional[LineCallback] = None,
+    timeout: Optional[float] = None,
+) -> CommandResult:
+    """
+    Runs `argv` (without a shell) and waits for it, streaming its output line by line to `on_stdout`/`on_stderr`.
+    With `echo`, stdout is also shown as it comes (e.g., rsync's progress). The process is killed after `timeout`
+    seconds, or if psync is interrupted while waiting for it.
+    """
+    argv = [str(arg) for arg in argv]
+    start = time.perf_counter()
+
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr={
+                CAPTURE: subprocess.PIPE,
+                MERGE: subprocess.STDOUT,
+                INHERIT: None,
+            }[stderr],
+        )
+    except OSError as e:
+        # e.g. the program does not exist, reported like the shell would
+        return CommandResult(argv, 127, stderr=str(e))
+
+    if echo:
+        # anything printed by psync must come before the output of the process
+        sys.stdout.flush()
+
+    stdout_chunks: List[bytes] = []
+    stderr_chunks: List[bytes] = []
+    readers = [
+        threading.Thread(
+            target=_pump,
+            args=(
+                process.stdout,
+                stdout_chunks if capture_stdout else None,
+                on_stdout,
+                echo,
+            ),
+            daemon=True,
+        )
+    ]
+    if process.stderr is not None:
+        readers.append(
+            threading.Thread(
+                target=_pump,
+                args=(process.stderr, stderr_chunks, on_stderr, False),
+                daemon=True,
+            )
+        )
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        timed_out = True
+    except BaseException:
+        # e.g. KeyboardInterrupt: the process must not outlive psync
+        process.kill()
+        process.wait()
+        raise
+
+    for reader in readers:
+        reader.join()
+
+    result = CommandResult(
+        argv,
+        process.returncode,
+        _decode(stdout_chunks),
+        _decode(stderr_chunks),
+        time.perf_counter() - start,
+        timed_out,
+    )
+    _account(result)
+    return result
+
+
+def _feed(stream: IO[bytes], source: Iterable[bytes]):
+    try:
+        for chunk in source:
+            stream.write(chunk)
+        stream.close()
+    except (BrokenPipeError, ValueError):
+        # the process exited early (its exit code tells why)
+        pass
+
+
+def run_binary(
+    argv: Sequence[str],
+    *,
+    source: Optional[Iterable[bytes]] = None,
+    on_chunk: Optional[Callable[[bytes], None]] = None,
+) -> CommandResult:
+    """
+    Runs `argv` (without a shell) streaming binary data: the chunks of `source` are written to its stdin, and its
+    stdout is passed to `on_chunk` as it comes (it is captured, as text, without it). stderr is captured.
+    """
+    argv = [str(arg) for arg in argv]
+    start = time.perf_counter()
+
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL if source is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        return CommandResult(argv, 127, stderr=str(e))
+
+    stdout_chunks: List[bytes] = []
+    stderr_chunks: List[bytes] = []
+    threads = [
+        threading.Thread(
+            target=_pump,
+            args=(process.stderr, stderr_chunks, None, False),
+            daemon=True,
+        )
+    ]
+    if source is not None:
+        threads.append(
+            threading.Thread(target=_feed, args=(process.stdin, source), daemon=True)
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            chunk = process.stdout.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            if on_chunk is not None:
+                on_chunk(chunk)
+            else:
+                stdout_chunks.append(chunk)
+        process.wait()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+
+    for thread in threads:
+        thread.join()
+
+    result = CommandResult(
+        argv,
+        process.returncode,
+        _decode(stdout_chunks),
+        _decode(stderr_chunks),
+        time.perf_counter() - start,
+    )
+    _account(result)
+    return result
+
+
+async def _pump_async(
+    stream: asyncio.StreamReader,
+    chunks: Optional[List[bytes]],
+    on_line: Optional[LineCallback],
+    on_chunk: Optional[Callable[[bytes], None]] = None,
+):
+    splitter = LineSplitter(on_line)
+
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        if chunks is not None:
+            chunks.append(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
+        splitter.feed(chunk)
+
+    splitter.close()
+
+
+async def run_async(
+    argv: Sequence[str],
+    *,
+    stdin=asyncio.subprocess.DEVNULL,
+    capture_stdout: bool = True,
+    stderr: str = CAPTURE,
+    on_stdout: Optional[LineCallback] = None,
+    on_stderr: Optional[LineCallback] = None,
+    on_stdout_chunk: Optional[Callable[[bytes], None]] = None,
+    timeout: Optional[float] = None,
+) -> CommandResult:
+    """
+    Same as run, for asyncio: many commands can run concurrently (e.g., with asyncio.gather). `on_stdout_chunk` gets
+    the raw output as it comes, e.g. for binary data.
+    """
+    argv = [str(arg) for arg in argv]
+    start = time.perf_counter()
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr={
+                CAPTURE: asyncio.subprocess.PIPE,
+                MERGE: asyncio.subprocess.STDOUT,
+                INHERIT: None,
+            }[stderr],
+        )
+    except OSError as e:
+        return CommandResult(argv, 127, stderr=str(e))
+
+    stdout_chunks: List[bytes] = []
+    stderr_chunks: List[bytes] = []
+    tasks = [
+        asyncio.ensure_future(
+            _pump_async(
+                process.stdout,
+                stdout_chunks if capture_stdout else None,
+                on_stdout,
+                on_stdout_chunk,
+            )
+        ),
+        asyncio.ensure_future(process.wait()),
+    ]
+    if process.stderr is not None:
+        tasks.append(
+            asyncio.ensure_future(_pump_async(process.stderr, stderr_chunks, on_stderr))
+        )
+
+    timed_out = False
+    try:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if len(pending) > 0:
+            process.kill()
+            timed_out = True
+        # once the process is gone, its pipes are closed and the readers finish
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        process.kill()
+        for task in tasks:
+            task.cancel()
+        await process.wait()
+        raise
+
+    result = CommandResult(
+        argv,
+        process.returncode,
+        _decode(stdout_chunks),
+        _decode(stderr_chunks),
+        time.perf_counter() - start,
+        timed_out,
+    )
+    _account(result)
+    return result
+
+
+def check_output(argv: Sequence[str], **kwargs) -> Optional[str]:
+    """Returns the (stripped) stdout of the command, or None (printing why) if it failed."""
+    result = run(argv, **kwargs)
+    return result.stdout.rstrip() if result.check() else None
@@ -0,0 +1,139 @@
+import heapq
+import os
+import re
+import time
+from typing import List, NamedTuple, Optional
+
+from psync.connection import get_manager
+from psync.fanout import FanOut
+from psync.runner import INHERIT, check_output, run
+from psync.utils import parse_size, write_files_from
+
+# e.g. "-rw-r--r--          1,234 2021/06/01 12:00:00 path/to/file"
+LISTING_ENTRY = re.compile(
+    r"^(?P<type>[-dlcbps])(?P<permissions>\S{9})\s+(?P<size>[\d.,]+[KMGTP]?)\s+(?P<mtime>\S+ \S+)\s+(?P<path>.+)$"
+)
+LISTING_TIME = "%Y/%m/%d %H:%M:%S"
+
+
+class ListingEntry(NamedTuple):
+    type: str
+    path: str
+    size: int
+    mtime: int = 0  # seconds since the epoch (the listing is in local time)
+    permissions: str = ""  # e.g. rw-r--r--
+
+    @property
+    def mode(self) -> int:
+        # the permission bits, e.g. 0o644 (setuid, setgid and sticky are ignored)
+        return sum(
+            1 << (8 - i) for i, char in enumerate(self.permissions) if char not in "-ST"
+        )
+
+
+def parse_listing(output: str) -> List[ListingEntry]:
+    entries = []
+
+    for line in output.splitlines():
+        match = LISTING_ENTRY.match(line)
+        if match is None:
+            continue
+
+        entry_type, path = match.group("type"), match.group("path")
+        if entry_type == "l":
+            path = path.split(" -> ", 1)[0]
+        if path == ".":
+            continue
+
+        try:
+            mtime = time.mktime(time.strptime(match.group("mtime"), LISTING_TIME))
+        except ValueError:
+            mtime = 0
+        entries.append(
+            ListingEntry(
+                entry_type,
+                path,
+                parse_size(match.group("size")),
+                int(mtime),
+                match.group("permissions"),
+            )
+        )
+
+    return entries
+
+
+def make_shards(entries: List[ListingEntry], n: int) -> List[List[str]]:
+    """
+    Splits `entries` into (at most) `n` shards of similar total size, assigning the largest files first, each to the
+    currently smallest shard. Directories all go to the first shard, as they are only needed to create empty ones.
+    """
+    shards = [[] for _ in range(n)]
+    heap = [(0, i) for i in range(n)]
+
+    for entry in sorted(entries, key=lambda e: e.size, reverse=True):
+        if entry.type == "d":
+            shards[0].append(entry.path)
+            continue
+
+        size, i = heapq.heappop(heap)
+        shards[i].append(entry.path)
+        heapq.heappush(heap, (size + entry.size, i))
+
+    return [shard for shard in shards if len(shard) > 0]
+
+
+class ShardedTransfer:
+    """
+    Runs a transfer as `streams` parallel rsync processes over the same multiplexed connection, each one moving a
+    size-balanced shard of the files. Deletions (if enabled) are applied by a final pass which transfers nothing.
+    """
+
+    def __init__(self, transfer, streams: int, files_from: Optional[str] = None):
+        self.transfer = transfer
+        self.streams = streams
+        self.files_from = files_from
+        self.statuses = {}  # shard -> ReplicaStatus, once run
+
+    def run(self) -> int:
+        # the master connection must exist before the streams start, otherwise each one would open its own
+        get_manager().open(self.transfer.host)
+
+        listing = check_output(self.transfer.list_command(self.files_from))
+        if listing is None:
+            return 1
+
+        shards = make_shards(parse_listing(listing), self.streams)
+        returncode = 0
+        if len(shards) == 0:
+            print("Nothing to transfer.")
+        else:
+            returncode = self.run_shards(shards)
+
+        if returncode == 0 and self.transfer.delete:
+            # only deletes extraneous files on the target: every other file is skipped by --existing/--ignore-existing
+            command = self.transfer.command(
+                self.files_from, extra=["--existing", "--ignore-existing"]
+            )
+            result = run(command, capture_stdout=False, stderr=INHERIT)
+            if not result.check():
+                return result.returncode or 1
+
+        return returncode
+
+    def run_shards(self, shards: List[List[str]]) -> int:
+        shard_files = [write_files_from(shard) for shard in shards]
+
+        try:
+            # the shards list every file (and directory) explicitly, so no recursion is needed
+            commands = {
+                f"shard-{i + 1}": self.transfer.command(files_from, recursive=False)
+                for i, files_from in enumerate(shard_files)
+            }
+            fan_out = FanOut(commands, jobs=len(commands), label="shard")
+            returncode = fan_out.run()
+            self.statuses = fan_out.statuses
+        finally:
+            for files_from in shard_files:
+                os.remove(files_from)
+
+        return returncode
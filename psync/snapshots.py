@@ -0,0 +1,294 @@
+import re
+import shlex
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from jsonargparse import ArgumentParser
+
+from psync import config as pconf
+from psync.command import PsyncCommandWithSubcommands, PsyncSubcommand
+from psync.config import PsyncReplicaConfig
+from psync.host_data import HostData
+from psync.utils import format_duration, format_size
+
+# on the replica, relative to its path (.psync is excluded from every transfer, so pushes never touch it)
+SNAPSHOTS_DIR = ".psync/snapshots"
+LATEST = "latest"  # symlink to the newest snapshot
+PARTIAL_SUFFIX = ".partial"  # snapshots being written (or whose push failed)
+
+NAME_FORMAT = "%Y%m%d-%H%M%S"
+SNAPSHOT_NAME = re.compile(r"^\d{8}-\d{6}$")
+
+DEFAULT_KEEP = 10
+# partial snapshots younger than this may belong to a push still running, so prune leaves them alone
+STALE_PARTIAL = 24 * 60 * 60  # seconds
+
+
+def snapshot_time(name: str) -> float:
+    return time.mktime(time.strptime(name, NAME_FORMAT))
+
+
+class RetentionPolicy:
+    """
+    Which snapshots to keep: the newest `keep` ones, and any taken in the last `keep_days` days. When neither is set,
+    the newest DEFAULT_KEEP are kept. The newest snapshot is never removed, as the next one is linked to it.
+    """
+
+    def __init__(self, keep: Optional[int] = None, keep_days: Optional[float] = None):
+        if keep is None and keep_days is None:
+            keep = DEFAULT_KEEP
+        self.keep = keep
+        self.keep_days = keep_days
+
+    @classmethod
+    def for_replica(
+        cls,
+        replica: PsyncReplicaConfig,
+        keep: Optional[int] = None,
+        keep_days: Optional[float] = None,
+    ) -> "RetentionPolicy":
+        # the command line overrides the config of the replica
+        if keep is None and keep_days is None:
+            keep, keep_days = replica.keep_snapshots, replica.keep_snapshot_days
+        return cls(keep, keep_days)
+
+    def expired(self, names: List[str], now: Optional[float] = None) -> List[str]:
+        now = time.time() if now is None else now
+        names = sorted(names)
+        kept = set(names[-1:])
+
+        if self.keep is not None and self.keep > 0:
+            kept.update(names[-self.keep :])
+        if self.keep_days is not None:
+            kept.update(
+                name
+                for name in names
+                if now - snapshot_time(name) <= self.keep_days * 24 * 60 * 60
+            )
+
+        return [name for name in names if name not in kept]
+
+    def __str__(self):
+        rules = []
+        if self.keep is not None:
+            rules.append(f"the last {self.keep}")
+        if self.keep_days is not None:
+            rules.append(f"those of the last {self.keep_days:g} day(s)")
+        return " and ".join(rules)
+
+
+class SnapshotStore:
+    """The snapshots of the project on a replica, each one a full copy hard-linked to the previous one."""
+
+    def __init__(self, replica: PsyncReplicaConfig, host: Optional[HostData] = None):
+        self.replica = replica
+        self.host = host if host is not None else replica.hostdata.filled
+
+    @property
+    def root(self) -> str:
+        return f"{self.replica.absolute_path}/{SNAPSHOTS_DIR}"
+
+    def path(self, name: str) -> str:
+        return f"{self.root}/{name}"
+
+    def target(self, name: str) -> str:
+        # where rsync writes a new snapshot, renamed once complete
+        path = f"{self.path(name + PARTIAL_SUFFIX)}/"
+        if self.host.is_local:
+            return path
+        return f"{self.host.user}@{self.host.hostname}:{path}"
+
+    @staticmethod
+    def new_name() -> str:
+        return datetime.now().strftime(NAME_FORMAT)
+
+    def list(self, partial: bool = False, create: bool = False) -> Optional[List[str]]:
+        """
+        Returns the (complete) snapshots from the oldest, or None if it failed. The folder is only created (if
+        needed) with `create`, i.e. before pushing a new snapshot.
+        """
+        root = shlex.quote(self.root)
+        if create:
+            script = f"mkdir -p {root} && ls -1 {root}"
+        else:
+            script = f"if [ -d {root} ]; then ls -1 {root}; fi"
+        result = self.host.run_remote(script)
+        if not result.check():
+            return None
+
+        names = result.stdout.split()
+        if partial:
+            return sorted(
+                name
+                for name in names
+                if name.endswith(PARTIAL_SUFFIX)
+                and SNAPSHOT_NAME.match(name[: -len(PARTIAL_SUFFIX)])
+            )
+        return sorted(name for name in names if SNAPSHOT_NAME.match(name))
+
+    def stale_partial(self, now: Optional[float] = None) -> Optional[List[str]]:
+        """The partial snapshots left behind by failed (or interrupted) pushes, i.e. started long enough ago."""
+        now = time.time() if now is None else now
+        names = self.list(partial=True)
+        if names is None:
+            return None
+        return [
+            name
+            for name in names
+            if now - snapshot_time(name[: -len(PARTIAL_SUFFIX)]) > STALE_PARTIAL
+        ]
+
+    def finalize(self, name: str, expired: List[str]) -> bool:
+        """Marks the snapshot `name` as complete (and the latest one), removing the `expired` ones."""
+        # POSIX only (no mv -T): the name is new, so mv cannot move the snapshot into an existing folder
+        script = (
+            f"cd {shlex.quote(self.root)} && [ ! -e {name} ] && mv {name}{PARTIAL_SUFFIX} {name} && "
+            f"ln -sfn {name} {LATEST}"
+        )
+        if len(expired) > 0:
+            script += " && " + shlex.join(["rm", "-rf", "--"] + expired)
+        return self.host.run_remote(script).check()
+
+    def remove(self, names: List[str]) -> bool:
+        if len(names) == 0:
+            return True
+        script = f"cd {shlex.quote(self.root)} && " + shlex.join(
+            ["rm", "-rf", "--"] + names
+        )
+        return self.host.run_remote(script).check()
+
+    def sizes(self, names: List[str]) -> Dict[str, int]:
+        """
+        The disk space taken by each snapshot on top of the older ones: du counts hard links only the first time it
+        sees them, so listing the snapshots from the oldest gives the data which is new in each one.
+        """
+        if len(names) == 0:
+            return {}
+
+        # in KiB, as -B1 is GNU only
+        script = f"cd {shlex.quote(self.root)} && " + shlex.join(
+            ["du", "-sk", "--"] + names
+        )
+        result = self.host.run_remote(script)
+        if not result.check():
+            return {}
+
+        sizes = {}
+        for line in result.stdout.splitlines():
+            size, _, name = line.partition("\t")
+            if size.isdigit():
+                sizes[name] = int(size) * 1024
+        return sizes
+
+
+def snapshot_replica(alias: Optional[str]) -> Optional[PsyncReplicaConfig]:
+    if alias is None:
+        return pconf.default_replica
+
+    if alias not in pconf.aliases:
+        print(f"{alias} not among valid remotes: {', '.join(pconf.aliases)}")
+        return None
+    return pconf.replicas[alias]
+
+
+class ListSnapshots(PsyncSubcommand):
+    name = "list"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser()
+        parser.add_argument("alias", nargs="?", default=None)
+        return parser
+
+    def run(self, alias=None):
+        replica = snapshot_replica(alias)
+        if replica is None:
+            return
+
+        store = SnapshotStore(replica)
+        names = store.list()
+        if names is None:
+            return
+        if len(names) == 0:
+            print(f"No snapshots on {replica.alias}.")
+            return
+
+        sizes = store.sizes(names)
+        now = time.time()
+
+        header = ("snapshot", "age", "new data")
+        rows = [
+            (
+                name,
+                format_duration(now - snapshot_time(name)),
+                format_size(sizes[name]) if name in sizes else "-",
+            )
+            for name in names
+        ]
+        rows.append(("total", "", format_size(sum(sizes.values()))))
+
+        widths = [
+            max(len(row[i]) for row in [header] + rows) for i in range(len(header))
+        ]
+        for row in [header] + rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print(line.rstrip())
+
+
+class PruneSnapshots(PsyncSubcommand):
+    name = "prune"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser()
+        parser.add_argument("alias", nargs="?", default=None)
+        parser.add_argument(
+            "--keep",
+            type=int,
+            default=None,
+            help=f"Number of snapshots to keep (defaults to keep_snapshots of the replica, or {DEFAULT_KEEP})",
+        )
+        parser.add_argument(
+            "--keep-days",
+            type=float,
+            default=None,
+            help="Also keep the snapshots taken in the last days (defaults to keep_snapshot_days of the replica)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only print the snapshots which would be removed",
+        )
+        return parser
+
+    def run(self, alias=None, keep=None, keep_days=None, dry_run=False):
+        replica = snapshot_replica(alias)
+        if replica is None:
+            return
+
+        store = SnapshotStore(replica)
+        names = store.list()
+        if names is None:
+            return
+
+        partial = store.stale_partial()
+        if partial is None:
+            return
+
+        policy = RetentionPolicy.for_replica(replica, keep, keep_days)
+        expired = policy.expired(names) + partial
+
+        if len(expired) == 0:
+            print(f"Nothing to prune on {replica.alias} (keeping {policy}).")
+            return
+
+        print(f"{'Would remove' if dry_run else 'Removing'} from {replica.alias}:")
+        for name in expired:
+            print("  ", name)
+
+        if not dry_run and store.remove(expired):
+            print(f"{len(names) - len(policy.expired(names))} snapshot(s) left.")
+
+
+PsyncSnapshotsCommand = PsyncCommandWithSubcommands.create(
+    "snapshots", (ListSnapshots, PruneSnapshots)
+)
@@ -0,0 +1,115 @@
+import glob
+import json
+import os
+from pathlib import Path
+from typing import Dict, List
+
+from psync.runner import check_output
+from psync.utils import cache_dir
+
+USER_CONFIG = Path("~/.ssh/config").expanduser()
+SYSTEM_CONFIG = Path("/etc/ssh/ssh_config")
+
+# host -> every option printed by `ssh -G host`
+_resolved: Dict[str, Dict[str, str]] = {}
+
+
+def _includes(path: Path, base: Path) -> List[Path]:
+    # like ssh, relative paths are resolved against ~/.ssh for the user config (and the files it includes, however
+    # deeply), and against /etc/ssh for the system one
+    found = []
+
+    try:
+        lines = path.read_text().splitlines()
+    except OSError:
+        return found
+
+    for line in lines:
+        parts = line.strip().split(None, 1)
+        if len(parts) != 2 or parts[0].lower() != "include":
+            continue
+
+        for pattern in parts[1].split():
+            pattern = os.path.expanduser(pattern)
+            if not os.path.isabs(pattern):
+                pattern = str(base / pattern)
+            found.extend(Path(p) for p in sorted(glob.glob(pattern)))
+
+    return found
+
+
+def config_files() -> List[Path]:
+    """The ssh config files (with their includes, recursively) which can affect `ssh -G`."""
+    files = []
+    pending = [(USER_CONFIG, USER_CONFIG.parent), (SYSTEM_CONFIG, SYSTEM_CONFIG.parent)]
+
+    while pending:
+        path, base = pending.pop(0)
+        if path in files or not path.exists():
+            continue
+        files.append(path)
+        pending.extend((include, base) for include in _includes(path, base))
+
+    return files
+
+
+def config_stamp() -> str:
+    stamps = [f"{path}:{path.stat().st_mtime_ns}" for path in config_files()]
+    return "|".join([os.environ.get("USER", "")] + stamps)
+
+
+def _cache_file() -> Path:
+    return cache_dir() / "ssh_hosts.json"
+
+
+def _load_cache(stamp: str) -> Dict[str, Dict[str, str]]:
+    try:
+        cached = json.loads(_cache_file().read_text())
+    except (OSError, ValueError):
+        return {}
+
+    if cached.get("stamp") != stamp:
+        return {}
+    return cached.get("hosts", {})
+
+
+def _store_cache(stamp: str, hosts: Dict[str, Dict[str, str]]):
+    path = _cache_file()
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}")
+
+    try:
+        tmp_path.write_text(json.dumps(dict(stamp=stamp, hosts=hosts)))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def parse_ssh_g(output: str) -> Dict[str, str]:
+    options = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(" ")
+        # multi-valued options are printed once per value: the first one is the effective one
+        options.setdefault(key.lower(), value)
+    return options
+
+
+def resolve_host(host: str) -> Dict[str, str]:
+    """
+    Resolves `host` through the ssh config with a single `ssh -G` call. Results are memoized for the lifetime of the
+    process and cached on disk until any of the ssh config files change.
+    """
+    if host in _resolved:
+        return _resolved[host]
+
+    stamp = config_stamp()
+    hosts = _load_cache(stamp)
+
+    if host not in hosts:
+        output = check_output(["ssh", "-G", host])
+        if output is None:
+            return {}
+        hosts[host] = parse_ssh_g(output)
+        _store_cache(stamp, hosts)
+
+    _resolved.update(hosts)
+    return hosts[host]
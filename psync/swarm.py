@@ -0,0 +1,363 @@
+import hashlib
+import os
+import re
+import shlex
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from psync.connection import get_manager
+from psync.runner import INHERIT, check_output, run
+from psync.shards import ListingEntry, parse_listing
+from psync.telemetry import TransferStats
+from psync.utils import format_duration, format_size, write_files_from
+
+# each batch should take about this long at the throughput of its source, so that the last ones end together
+BATCH_SECONDS = 5.0
+# the throughput assumed for sources which were never measured (see psync replicas status)
+DEFAULT_THROUGHPUT = 10 * 1024**2
+# batches smaller than this tell little about the throughput of their source
+MIN_SAMPLE = 1024**2
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# e.g. "da39a3ee5e6b4b0d3255bfef95601890afd80709  path/to/file" (prefixed by \ if the path is escaped)
+SHA1SUM_LINE = re.compile(
+    r"^(?P<escaped>\\?)(?P<digest>[0-9a-f]{40}) [ *](?P<path>.+)$"
+)
+
+
+@dataclass
+class SourceStatus:
+    alias: str
+    throughput: float  # bytes/s, first estimated, then observed
+    queue: Deque[ListingEntry] = field(default_factory=deque)  # largest files first
+    remaining: int = 0  # bytes in the queue
+    stats: TransferStats = field(default_factory=TransferStats)
+    batches: int = 0
+    stolen: int = 0  # files taken from the queue of another source
+    elapsed: float = 0.0
+    returncode: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def eta(self) -> float:
+        return self.remaining / self.throughput
+
+
+class SwarmTransfer:
+    """
+    Pulls the files from several replicas holding the same data at once. The files are first split among the
+    sources in proportion to their throughput (largest first, each to the source which would finish it soonest).
+    Every source then runs rsync on batches taken from the front of its queue, sized to last a few seconds at its
+    observed throughput, and once its queue is empty it steals the smallest files from the source which would
+    otherwise finish last, so a slow node does not hold up the transfer. A failing source gives its files back to
+    the others.
+    """
+
+    def __init__(self, transfers: List, throughputs: Dict[str, Optional[float]]):
+        self.transfers = {t.replica.alias: t for t in transfers}
+        self.statuses = {
+            alias: SourceStatus(alias, throughputs.get(alias) or DEFAULT_THROUGHPUT)
+            for alias in self.transfers
+        }
+        self.entries: List[ListingEntry] = []
+        self.failed: List[ListingEntry] = []  # left when every source failed
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        # notified whenever a batch ends, as a failed one may hand its files to the sources which are waiting
+        self._batch_done = threading.Condition(self._lock)
+        self._in_flight = 0
+
+    def select(self, files_from: Optional[str]) -> bool:
+        """Lists the files on the first (fastest) source and splits them among the sources."""
+        first = next(iter(self.transfers.values()))
+        listing = check_output(first.list_command(files_from, ["--no-human-readable"]))
+        if listing is None:
+            return False
+
+        self.entries = parse_listing(listing)
+        statuses = list(self.statuses.values())
+        for entry in sorted(self.entries, key=lambda e: e.size, reverse=True):
+            if entry.type == "d":
+                # only needed to create empty folders, see make_shards
+                statuses[0].queue.append(entry)
+                continue
+
+            status = min(
+                statuses, key=lambda s: (s.remaining + entry.size) / s.throughput
+            )
+            status.queue.append(entry)
+            status.remaining += entry.size
+
+        return True
+
+    def run(self) -> int:
+        start = time.perf_counter()
+
+        # the master connections must exist before the batches start, otherwise each one would open its own
+        for transfer in self.transfers.values():
+            get_manager().open(transfer.host)
+
+        with ThreadPoolExecutor(len(self.transfers)) as executor:
+            list(executor.map(self.work, self.transfers))
+        self.elapsed = time.perf_counter() - start
+
+        self.failed = [
+            entry for status in self.statuses.values() for entry in status.queue
+        ]
+        if len(self.failed) > 0:
+            print(f"{len(self.failed)} file(s) could not be pulled from any source.")
+            return max(status.returncode for status in self.statuses.values())
+        return 0
+
+    def work(self, alias: str):
+        status, transfer = self.statuses[alias], self.transfers[alias]
+
+        while True:
+            batch = self.next_batch(status)
+            if len(batch) == 0:
+                return
+
+            files_from = write_files_from([entry.path for entry in batch])
+            stats = TransferStats()
+            try:
+                # every file (and folder) is listed, so no recursion is needed
+                result = run(
+                    transfer.command(files_from, recursive=False),
+                    capture_stdout=False,
+                    on_stdout=stats.feed,
+                )
+            finally:
+                os.remove(files_from)
+
+            size = sum(entry.size for entry in batch)
+            self.add_stats(status, stats, result.elapsed)
+            self.print_batch(status, batch, size, result)
+
+            if not result.ok:
+                status.returncode = result.returncode
+                status.errors += result.stderr.splitlines()
+                self.give_back(status, batch)
+                self.end_batch()
+                return
+            self.end_batch()
+
+            if size >= MIN_SAMPLE and result.elapsed > 0:
+                # smoothed, as batches of small files are slower than those of large ones
+                status.throughput = (status.throughput + size / result.elapsed) / 2
+
+    def next_batch(self, status: SourceStatus) -> List[ListingEntry]:
+        """
+        Takes the next batch of `status`, waiting while there is nothing left to take but other batches are still
+        running (their files come back if they fail). An empty batch means the transfer is over.
+        """
+        with self._batch_done:
+            while True:
+                batch = self.take_batch(status)
+                if len(batch) > 0:
+                    self._in_flight += 1
+                    status.batches += 1
+                    return batch
+                if self._in_flight == 0:
+                    return []
+                self._batch_done.wait()
+
+    def end_batch(self):
+        with self._batch_done:
+            self._in_flight -= 1
+            self._batch_done.notify_all()
+
+    def take_batch(self, status: SourceStatus) -> List[ListingEntry]:
+        # called with the lock held
+        queue, stealing = status.queue, False
+        # at most a quarter of what is left, so that batches get smaller towards the end (and the estimates
+        # are corrected early)
+        budget = min(
+            status.throughput * BATCH_SECONDS, max(status.remaining / 4, MIN_SAMPLE)
+        )
+
+        if len(queue) == 0:
+            victim = max(
+                (s for s in self.statuses.values() if s.returncode == 0),
+                key=lambda s: (s.eta, len(s.queue)),
+            )
+            if len(victim.queue) == 0:
+                return []
+            # the smallest files, at most half of what is left: the victim keeps working on the rest
+            queue, stealing = victim.queue, True
+            budget = min(budget, victim.remaining / 2)
+
+        batch, size = [], 0
+        while len(queue) > 0:
+            entry = queue[-1] if stealing else queue[0]
+            if len(batch) > 0 and size + entry.size > budget:
+                break
+            if stealing:
+                queue.pop()
+                victim.remaining -= entry.size
+            else:
+                queue.popleft()
+                status.remaining -= entry.size
+            batch.append(entry)
+            size += entry.size
+
+        if stealing:
+            status.stolen += len(batch)
+        return batch
+
+    def give_back(self, status: SourceStatus, batch: List[ListingEntry]):
+        """Moves the files of a failed source (its last batch included) to the working source which will finish first."""
+        with self._lock:
+            working = [s for s in self.statuses.values() if s.returncode == 0]
+            if len(working) == 0:
+                # nobody left: they are reported as failed
+                status.queue.extendleft(reversed(batch))
+                return
+
+            heir = min(working, key=lambda s: s.eta)
+            entries = batch + list(status.queue)
+            heir.queue = deque(
+                sorted(list(heir.queue) + entries, key=lambda e: e.size, reverse=True)
+            )
+            heir.remaining += sum(entry.size for entry in entries)
+            status.queue.clear()
+            status.remaining = 0
+
+    def add_stats(self, status: SourceStatus, stats: TransferStats, elapsed: float):
+        total = status.stats
+        for name in (
+            "files",
+            "created_files",
+            "transferred_files",
+            "total_size",
+            "transferred_size",
+            "literal_data",
+            "matched_data",
+            "bytes_sent",
+            "bytes_received",
+        ):
+            setattr(total, name, getattr(total, name) + getattr(stats, name))
+        status.elapsed += elapsed
+
+    @staticmethod
+    def print_batch(status: SourceStatus, batch: List[ListingEntry], size: int, result):
+        state = "done" if result.ok else f"failed ({result.returncode})"
+        print(
+            f"[{status.alias}] {state}: {len(batch)} file(s), {format_size(size)} "
+            f"in {format_duration(result.elapsed)}",
+            flush=True,
+        )
+
+    def delete_extraneous(self, files_from: Optional[str]) -> bool:
+        # only deletes extraneous files on the target: every other file is skipped by --existing/--ignore-existing
+        first = next(iter(self.transfers.values()))
+        command = first.command(files_from, extra=["--existing", "--ignore-existing"])
+        return run(command, capture_stdout=False, stderr=INHERIT).check()
+
+    def print_summary(self):
+        header = ("source", "status", "batches", "stolen", "transferred", "elapsed")
+        rows = [
+            (
+                status.alias,
+                "ok" if status.returncode == 0 else f"failed ({status.returncode})",
+                str(status.batches),
+                str(status.stolen),
+                format_size(status.stats.transferred_size),
+                f"{status.elapsed:.1f}s",
+            )
+            for status in self.statuses.values()
+        ]
+
+        widths = [
+            max(len(row[i]) for row in [header] + rows) for i in range(len(header))
+        ]
+        print()
+        for row in [header] + rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print(line.rstrip())
+
+        transferred = sum(s.stats.transferred_size for s in self.statuses.values())
+        throughput = transferred / self.elapsed if self.elapsed > 0 else 0
+        print(
+            f"\nTotal: {format_size(transferred)} in {self.elapsed:.1f}s "
+            f"({format_size(throughput)}/s)"
+        )
+
+        for status in self.statuses.values():
+            if len(status.errors) > 0:
+                print(f"\n[{status.alias}] errors:")
+                for line in status.errors:
+                    print("  ", line)
+
+    def verify(self) -> Dict[str, List[str]]:
+        """
+        Checks that every source holds the same content as the pulled files (by SHA-1, hashed on each source in
+        parallel), returning the files which differ along with the sources which disagree.
+        """
+        files = [entry.path for entry in self.entries if entry.type == "-"]
+        if len(files) == 0:
+            return {}
+
+        files_from = write_files_from(files)
+        try:
+            with ThreadPoolExecutor(len(self.transfers) + 1) as executor:
+                local = executor.submit(self.local_digests, files)
+                remote = {
+                    alias: executor.submit(self.remote_digests, transfer, files_from)
+                    for alias, transfer in self.transfers.items()
+                }
+                digests = local.result()
+                sources = {alias: future.result() for alias, future in remote.items()}
+        finally:
+            os.remove(files_from)
+
+        mismatches = {}
+        for file in files:
+            disagreeing = [
+                alias
+                for alias, source in sources.items()
+                if source.get(file) != digests.get(file)
+            ]
+            if len(disagreeing) > 0:
+                mismatches[file] = disagreeing
+        return mismatches
+
+    def local_digests(self, files: List[str]) -> Dict[str, str]:
+        root = Path(next(iter(self.transfers.values())).local)
+
+        def digest(file: str) -> Tuple[str, Optional[str]]:
+            sha1 = hashlib.sha1()
+            try:
+                with open(root / file, "rb") as f:
+                    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                        sha1.update(block)
+            except OSError:
+                return file, None
+            return file, sha1.hexdigest()
+
+        with ThreadPoolExecutor(4) as executor:
+            return dict(executor.map(digest, files))
+
+    @staticmethod
+    def remote_digests(transfer, files_from: str) -> Dict[str, str]:
+        # sha1sum needs GNU coreutils on the replica, and xargs -0
+        with open(files_from, "rb") as files:
+            result = transfer.host.run_remote(
+                f"cd {shlex.quote(transfer.remote_path)} && xargs -0 sha1sum --",
+                stdin=files,
+            )
+
+        digests = {}
+        for line in result.stdout.splitlines():
+            match = SHA1SUM_LINE.match(line)
+            if match is None:
+                continue
+            path = match.group("path")
+            if match.group("escaped"):
+                path = path.replace("\\n", "\n").replace("\\\\", "\\")
+            digests[path] = match.group("digest")
+        return digests
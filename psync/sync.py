@@ -0,0 +1,285 @@
+import dataclasses
+import hashlib
+import json
+import os
+import shlex
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from jsonargparse import ArgumentParser
+
+from psync import config as pconf
+from psync.filters import ExclusionMatcher, walk
+from psync.plan import Plan
+from psync.profiling import FILE_LIST, span
+from psync.push_pull import PushPullCommand, Transfer
+from psync.runner import run
+from psync.shards import parse_listing
+from psync.telemetry import stream_transfer
+from psync.utils import write_files_from
+
+# relative path (to the transfer root) -> (size, mtime in seconds), as seen on either side
+SyncStates = Dict[str, Tuple[int, int]]
+
+REPORT, LOCAL, REMOTE, NEWER = "report", "local", "remote", "newer"
+
+
+class SyncManifest:
+    """
+    The state of the files after the last sync of a folder with a replica (stored under
+    <project>/.psync/manifests/), i.e., the common ancestor of both sides: a file which differs from it on one side
+    only changed there, while a file which differs on both sides is a conflict.
+    """
+
+    def __init__(self, project: Path, transfer: Transfer):
+        self.project = project
+        self.alias = transfer.replica.alias
+        self.key = hashlib.sha1(
+            json.dumps([transfer.local, transfer.remote]).encode()
+        ).hexdigest()[:16]
+        self.files: SyncStates = {}
+
+    @property
+    def path(self) -> Path:
+        return self.project / ".psync" / "manifests" / f"{self.alias}-{self.key}.json"
+
+    def load(self) -> "SyncManifest":
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return self
+
+        self.files = {path: tuple(state) for path, state in data["files"].items()}
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(dict(files=self.files)))
+        os.replace(tmp_path, self.path)
+
+
+@dataclass
+class SyncDiff:
+    push: List[str] = field(default_factory=list)
+    pull: List[str] = field(default_factory=list)
+    conflicts: List[str] = field(default_factory=list)
+    # files which are the same on both sides
+    synced: SyncStates = field(default_factory=dict)
+
+
+def three_way(
+    local: SyncStates, remote: SyncStates, base: SyncStates, delete: bool
+) -> SyncDiff:
+    """
+    Compares both sides with their last synced state. Without `delete`, files deleted on one side are copied back
+    from the other one, rather than deleted there too.
+    """
+    diff = SyncDiff()
+
+    for path in sorted(local.keys() | remote.keys() | base.keys()):
+        ours, theirs, ancestor = local.get(path), remote.get(path), base.get(path)
+        if ours == theirs:
+            if ours is not None:
+                diff.synced[path] = ours
+            continue
+
+        if not delete and (ours is None or theirs is None):
+            ancestor = None
+
+        if theirs == ancestor:
+            diff.push.append(path)
+        elif ours == ancestor:
+            diff.pull.append(path)
+        else:
+            diff.conflicts.append(path)
+
+    return diff
+
+
+def resolve(diff: SyncDiff, local: SyncStates, remote: SyncStates, policy: str):
+    """Moves the conflicts to the push/pull lists according to `policy` (they are left as they are with report)."""
+    if policy == REPORT:
+        return
+
+    for path in diff.conflicts:
+        if policy == NEWER:
+            # a deleted file is older than one which has been modified
+            ours, theirs = local.get(path), remote.get(path)
+            keep_ours = theirs is None or (ours is not None and ours[1] >= theirs[1])
+        else:
+            keep_ours = policy == LOCAL
+        (diff.push if keep_ours else diff.pull).append(path)
+
+    diff.conflicts = []
+
+
+def local_states(root: Path, matcher: ExclusionMatcher) -> SyncStates:
+    return {
+        path: (stat.st_size, int(stat.st_mtime)) for path, stat in walk(root, matcher)
+    }
+
+
+def remote_states(transfer: Transfer) -> Optional[SyncStates]:
+    """Lists the files on the replica (with a single rsync call), returning None (printing why) if it failed."""
+    pull = dataclasses.replace(transfer, mode="pull")
+    # exact sizes, rather than the rounded ones printed with -h
+    result = run(pull.list_command(extra=["--no-human-readable"]))
+
+    if not result.ok:
+        if "No such file or directory" in result.stderr:
+            # the folder does not exist on the replica yet
+            return {}
+        result.check()
+        print(result.stderr.rstrip())
+        return None
+
+    return {
+        entry.path: (entry.size, entry.mtime)
+        for entry in parse_listing(result.stdout)
+        if entry.type != "d"
+    }
+
+
+class SyncCommand(PushPullCommand):
+    name = "sync"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser(
+            description="Synchronizes the current folder with a replica in both directions, sending the files "
+            "changed on each side since the last sync."
+        )
+
+        self.add_transfer_arguments(parser)
+
+        parser.add_argument(
+            "--conflicts",
+            choices=[REPORT, LOCAL, REMOTE, NEWER],
+            default=REPORT,
+            help="What to do with files changed on both sides: report them (leaving them as they are), keep the "
+            "local or the remote version, or keep the most recently modified one",
+        )
+        parser.add_argument(
+            "-n",
+            "--confirm",
+            action="store_true",
+            help="Print what is going to be transferred before execution",
+        )
+        parser.add_argument(
+            "--metrics-file",
+            default=None,
+            help="JSON-lines file where the statistics of each transfer are appended (defaults to "
+            ".psync/transfers.jsonl in the project)",
+        )
+
+        return parser
+
+    def run(self, config):
+        self.mode = "push"
+        self.split_destination(config)
+
+        if len(config.files) > 0:
+            print(
+                "psync sync synchronizes whole folders, run it from the folder to synchronize."
+            )
+            exit(1)
+
+        if config.debug:
+            print(config)
+
+        dest = self.destination(config)
+        transfer = self.transfer(config, dest)
+        root = Path(transfer.local)
+
+        # each side is walked once: locally, and with a single listing on the replica
+        with span("local states", FILE_LIST):
+            local = local_states(root, self.matcher(config, root, dest))
+        with span("remote states", FILE_LIST, replica=dest.alias):
+            remote = remote_states(transfer)
+        if remote is None:
+            exit(1)
+
+        manifest = SyncManifest(Path(pconf.project), transfer).load()
+        diff = three_way(local, remote, manifest.files, config.delete)
+        resolve(diff, local, remote, config.conflicts)
+
+        if len(diff.push) + len(diff.pull) + len(diff.conflicts) == 0:
+            print(f"Already in sync with {dest.alias}.")
+            manifest.files = diff.synced
+            manifest.save()
+            return
+
+        if self.should_confirm(config):
+            for label, paths in [("push", diff.push), ("pull", diff.pull)]:
+                print(f"To {label} ({len(paths)}):")
+                for path in paths:
+                    state = local.get(path) if label == "push" else remote.get(path)
+                    print("  ", path if state is not None else f"{path} (delete)")
+            if len(diff.conflicts) > 0:
+                print(f"Conflicts, left as they are: {len(diff.conflicts)}")
+            self.confirm()
+
+        base = dict(diff.synced)
+        for path in diff.conflicts:
+            if path in manifest.files:
+                base[path] = manifest.files[path]
+
+        returncodes = []
+        for mode, paths, states in [
+            ("push", diff.push, local),
+            ("pull", diff.pull, remote),
+        ]:
+            if len(paths) == 0:
+                continue
+
+            returncode = self.send(
+                config, dataclasses.replace(transfer, mode=mode), paths
+            )
+            returncodes.append(returncode)
+
+            for path in paths:
+                if returncode == 0:
+                    # deleted files are not tracked anymore
+                    if path in states:
+                        base[path] = states[path]
+                elif path in manifest.files:
+                    # we cannot know what made it to the other side, they will be compared again
+                    base[path] = manifest.files[path]
+
+        manifest.files = base
+        manifest.save()
+
+        if len(diff.conflicts) > 0:
+            print(
+                f"{len(diff.conflicts)} file(s) changed on both sides, left as they are:"
+            )
+            for path in diff.conflicts:
+                print("  ", path)
+            print("Use --conflicts local/remote/newer to choose which version to keep.")
+
+        if (
+            any(returncode != 0 for returncode in returncodes)
+            or len(diff.conflicts) > 0
+        ):
+            exit(max(returncodes + [1]))
+
+    def send(self, config, transfer: Transfer, paths: List[str]) -> int:
+        files_from = write_files_from(paths)
+        try:
+            # the files to delete are missing on the source (see Plan.options)
+            command = transfer.command(
+                files_from, recursive=False, extra=Plan.options(config.delete)
+            )
+            if config.debug:
+                print("Executing", shlex.join(command))
+
+            returncode, _, stats, elapsed = stream_transfer(
+                command, capture_stderr=False
+            )
+            self.log_transfer(
+                config, transfer, returncode, stats, elapsed, label="sync"
+            )
+            return returncode
+        finally:
+            os.remove(files_from)
@@ -0,0 +1,147 @@
+import json
+import re
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from psync.runner import CAPTURE, INHERIT, run
+from psync.utils import parse_size
+
+# e.g. "Number of files: 1,234 (reg: 1,000, dir: 234)" or "Literal data: 1.23M bytes"
+STATS_LINE = re.compile(r"^(?P<key>[A-Z][A-Za-z ]+): (?P<value>[\d.,]+[KMGTP]?)")
+# e.g. "total size is 1.23G  speedup is 945.12"
+SPEEDUP_LINE = re.compile(r"speedup is (?P<speedup>[\d.,]+)")
+
+# rsync --stats key -> TransferStats field
+STATS_FIELDS = {
+    "Number of files": "files",
+    "Number of created files": "created_files",
+    "Number of deleted files": "deleted_files",
+    "Number of regular files transferred": "transferred_files",
+    "Total file size": "total_size",
+    "Total transferred file size": "transferred_size",
+    "Literal data": "literal_data",
+    "Matched data": "matched_data",
+    "File list size": "file_list_size",
+    "File list generation time": "file_list_generation_time",
+    "File list transfer time": "file_list_transfer_time",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+TIME_FIELDS = {"file_list_generation_time", "file_list_transfer_time"}
+
+
+@dataclass
+class TransferStats:
+    files: int = 0
+    created_files: int = 0
+    deleted_files: int = 0
+    transferred_files: int = 0
+    total_size: int = 0
+    transferred_size: int = 0
+    literal_data: int = 0
+    matched_data: int = 0
+    file_list_size: int = 0
+    file_list_generation_time: float = 0.0
+    file_list_transfer_time: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    speedup: float = 0.0
+
+    def feed(self, line: str) -> bool:
+        """
+        Parses a line of rsync's --stats output, returning whether it was one. The command must run with
+        --no-human-readable (as every Transfer does): the values rounded by -h are not exact.
+        """
+        match = STATS_LINE.match(line)
+        if match is not None and match.group("key") in STATS_FIELDS:
+            name, value = STATS_FIELDS[match.group("key")], match.group("value")
+            if name in TIME_FIELDS:
+                setattr(self, name, float(value.replace(",", "")))
+            else:
+                setattr(self, name, parse_size(value))
+            return True
+
+        match = SPEEDUP_LINE.search(line)
+        if match is not None:
+            self.speedup = float(match.group("speedup").replace(",", ""))
+            return True
+
+        return False
+
+
+@dataclass
+class TransferRecord:
+    mode: str
+    replica: str
+    source: str
+    target: str
+    returncode: int
+    wall_time: float
+    stats: TransferStats
+    compression: Optional[str] = None
+    label: Optional[str] = None  # e.g. the shard
+    timestamp: str = field(
+        default_factory=lambda: datetime.now().astimezone().isoformat()
+    )
+
+    @property
+    def phases(self) -> Dict[str, float]:
+        file_list = (
+            self.stats.file_list_generation_time + self.stats.file_list_transfer_time
+        )
+        return {
+            "file_list_generation": self.stats.file_list_generation_time,
+            "file_list_transfer": self.stats.file_list_transfer_time,
+            "transfer": max(self.wall_time - file_list, 0.0),
+        }
+
+    def as_dict(self) -> dict:
+        record = asdict(self)
+        record.update(record.pop("stats"))
+        record["phases"] = self.phases
+        record["throughput"] = (
+            self.stats.transferred_size / self.wall_time if self.wall_time > 0 else 0
+        )
+        return record
+
+
+class MetricsLog:
+    """Appends a JSON line per transfer to `path`, so that sync performance can be tracked over time."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def append(self, record: TransferRecord):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.write(json.dumps(record.as_dict()) + "\n")
+        except OSError as e:
+            print(f"Could not write transfer metrics to {self.path}: {e}")
+
+
+def stream_transfer(
+    argv: List[str],
+    capture_stderr: bool = True,
+    on_line: Optional[Callable[[str], None]] = None,
+) -> Tuple[int, str, TransferStats, float]:
+    """
+    Runs the rsync command `argv` showing its output live, while parsing its --stats (any other line of output is
+    passed to `on_line`). Returns the exit code, the captured stderr (if any), the stats and the wall time.
+    """
+    stats = TransferStats()
+
+    def feed(line: str):
+        if not stats.feed(line) and on_line is not None:
+            on_line(line)
+
+    result = run(
+        argv,
+        capture_stdout=False,
+        stderr=CAPTURE if capture_stderr else INHERIT,
+        echo=True,
+        on_stdout=feed,
+    )
+    return result.returncode, result.stderr, stats, result.elapsed
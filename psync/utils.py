@@ -1,20 +1,53 @@
-import subprocess
-from typing import Optional
+import os
+import tempfile
+from pathlib import Path
+from typing import List
 
 
-def run_command(
-    cmd: str, get_result: bool = True, from_stderr: bool = False
-) -> Optional[str]:
-    command = subprocess.run(cmd, shell=True, capture_output=get_result)
+def write_files_from(files: List[str]) -> str:
+    # NUL-separated, so that any file name is supported (see rsync's --from0)
+    with tempfile.NamedTemporaryFile(
+        "w", prefix="psync-", suffix=".files", delete=False
+    ) as f:
+        f.write("\0".join(files) + "\0")
+    return f.name
 
-    try:
-        command.check_returncode()
 
-        out = command.stderr if from_stderr else command.stdout
+def cache_dir(*parts: str) -> Path:
+    # follows the XDG spec, i.e. ~/.cache/psync unless $XDG_CACHE_HOME is set
+    base = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser()
+    path = base.joinpath("psync", *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
 
-        if get_result:
-            return out.decode("utf-8").rstrip()
 
-    except subprocess.CalledProcessError as _:
-        print(f'Command "{cmd}" failed with exit code {command.returncode}')
-        return None
+SIZE_UNITS = ["", "K", "M", "G", "T", "P"]
+
+
+def parse_size(size: str, base: int = 1000) -> int:
+    # parses the numbers printed by rsync, either plain (1,234,567) or human-readable with -h (1.23M), or those given
+    # by the user with base=1024 (256M being 256 MiB)
+    size = size.strip().replace(",", "")
+    unit = size[-1:].upper()
+    if unit in SIZE_UNITS[1:]:
+        return int(float(size[:-1]) * base ** SIZE_UNITS.index(unit))
+    return int(float(size or 0))
+
+
+def format_size(size: float) -> str:
+    for unit in SIZE_UNITS:
+        if abs(size) < 1000 or unit == SIZE_UNITS[-1]:
+            break
+        size /= 1000
+    return f"{size:.2f}{unit}B" if unit else f"{int(size)}B"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    if seconds < 86400:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 86400}d {seconds % 86400 // 3600:02d}h"
@@ -0,0 +1,182 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from jsonargparse import ArgumentParser
+
+from psync.filters import ExclusionMatcher
+from psync.hashing import (
+    ALGORITHMS,
+    CRC32,
+    DEFAULT_WORKERS,
+    HashCache,
+    file_states,
+    hash_files,
+    remote_script,
+)
+from psync.push_pull import PushPullCommand, Transfer
+from psync.utils import format_duration
+
+
+def excluded(matcher: ExclusionMatcher, path: str) -> bool:
+    # whether `path` (a file) would be skipped by a walk of the folder, i.e. it or any of its parents is excluded
+    parts = path.split("/")
+    return matcher.excluded(path) or any(
+        matcher.excluded("/".join(parts[:i]), True) for i in range(1, len(parts))
+    )
+
+
+class VerifyCommand(PushPullCommand):
+    name = "verify"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser(
+            description="Checks that the files of the current folder have the same content on a replica, hashing "
+            "both sides in parallel, and reports the files which differ, are missing or are extra on the replica."
+        )
+
+        self.add_transfer_arguments(parser)
+
+        parser.add_argument(
+            "--hash",
+            choices=ALGORITHMS,
+            default=CRC32,
+            help="Hash function: crc32 is the fastest, blake2b and sha256 are cryptographic",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help="Number of files hashed at the same time, on each side",
+        )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Hash every file, rather than only those whose inode, size or modification time changed since the "
+            "last verification",
+        )
+
+        return parser
+
+    def run(self, config):
+        # the paths are those of a push, from here to the replica
+        self.mode = "push"
+        self.split_destination(config)
+
+        if config.debug:
+            print(config)
+
+        dest = self.destination(config)
+        transfer = self.transfer(config, dest)
+        root = Path(transfer.local)
+
+        prefixes, invalid = self.split_files(config.files, root, False)
+        if len(invalid) > 0:
+            self.print_summary(len(config.files), invalid)
+            if len(prefixes) == 0:
+                exit(1)
+
+        matcher = self.matcher(config, root, dest)
+        local = file_states(root, matcher, prefixes)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(2) as executor:
+            # the replica hashes its files while we hash ours
+            remote_future = executor.submit(
+                self.hash_remote, config, transfer, list(local), prefixes
+            )
+            local_digests, local_hashed = hash_files(
+                root,
+                local,
+                config.hash,
+                HashCache(root, config.hash, not config.no_cache).load(),
+                config.workers,
+            )
+            remote = remote_future.result()
+
+        if remote is None:
+            exit(1)
+
+        remote_digests = remote["digests"]
+        unreadable = [path for path in local if path not in local_digests]
+        missing = [path for path in local if path not in remote_digests]
+        mismatched = [
+            path
+            for path, digest in local_digests.items()
+            if path in remote_digests and remote_digests[path] != digest
+        ]
+        extra = sorted(path for path in remote["extra"] if not excluded(matcher, path))
+
+        cached = (
+            ", the others were cached"
+            if min(local_hashed, remote["hashed"]) < len(local)
+            else ""
+        )
+        print(
+            f"Verified {len(local)} file(s) with {config.hash} in {format_duration(time.perf_counter() - start)} "
+            f"(hashed {local_hashed} here and {remote['hashed']} on {dest.alias}{cached})."
+        )
+
+        for label, paths in [
+            ("Different", mismatched),
+            (f"Missing on {dest.alias}", missing),
+            (f"Extra on {dest.alias}", extra),
+            ("Unreadable here", unreadable),
+        ]:
+            if len(paths) > 0:
+                print(f"{label} ({len(paths)}):")
+                for path in sorted(paths):
+                    print("  ", path)
+
+        if len(mismatched) + len(missing) + len(extra) + len(unreadable) > 0:
+            exit(1)
+        print(f"{dest.alias} matches.")
+
+    def hash_remote(
+        self, config, transfer: Transfer, files: List[str], prefixes: List[str]
+    ) -> Optional[Dict]:
+        request = dict(
+            root=transfer.remote_path,
+            files=files,
+            prefixes=prefixes,
+            # the ignore files are applied here, to the extra files only (see excluded)
+            exclude=self.exclusions(config, transfer.replica),
+            algorithm=config.hash,
+            workers=config.workers,
+            cache=not config.no_cache,
+        )
+        with tempfile.NamedTemporaryFile(
+            "w", prefix="psync-", suffix=".json", delete=False
+        ) as f:
+            json.dump(request, f)
+
+        try:
+            with open(f.name, "rb") as stdin:
+                # a single session: the program comes as an argument, the request on stdin
+                result = transfer.host.run_remote(
+                    ["python3", "-c", remote_script()], stdin=stdin
+                )
+        finally:
+            os.remove(f.name)
+
+        if not result.ok:
+            print(f"Could not hash the files on {transfer.replica.alias}:")
+            print("  ", result.stderr.strip())
+            return None
+
+        try:
+            response = json.loads(result.stdout)
+        except ValueError:
+            print(
+                f"Unexpected output from {transfer.replica.alias}: {result.stdout[:200]}"
+            )
+            return None
+
+        if "error" in response:
+            print(f"{transfer.replica.alias}: {response['error']}")
+            return None
+        return response
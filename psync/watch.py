@@ -0,0 +1,317 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import shlex
+import struct
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+from jsonargparse import ArgumentParser
+
+from psync import config as pconf
+from psync.command import PsyncBaseCommand
+from psync.connection import get_manager
+from psync.filters import ExclusionMatcher, walk
+from psync.push_pull import PushCommand
+from psync.runner import INHERIT, run
+from psync.utils import write_files_from
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+# returned instead of the changed paths when the watcher lost track of them
+RESCAN = None
+
+
+class InotifyWatcher:
+    """Reports the paths (relative to `root`) which changed, using one inotify watch per (non-excluded) folder."""
+
+    def __init__(self, root: Path, matcher: ExclusionMatcher):
+        self.root = root
+        self.matcher = matcher
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.dirs: Dict[int, str] = {}
+        self.add_tree("")
+
+    @classmethod
+    def available(cls) -> bool:
+        libc = ctypes.util.find_library("c")
+        return libc is not None and hasattr(ctypes.CDLL(libc), "inotify_init1")
+
+    def add_tree(self, relative_dir: str) -> Set[str]:
+        """Watches `relative_dir` and its subfolders, returning the files they already contain."""
+        files = set()
+        pending = [relative_dir]
+
+        while pending:
+            current = pending.pop()
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(self.root / current), WATCH_MASK
+            )
+            if wd < 0:
+                continue
+            self.dirs[wd] = current
+
+            try:
+                entries = list(os.scandir(self.root / current))
+            except OSError:
+                continue
+
+            for entry in entries:
+                relative = f"{current}/{entry.name}" if current else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self.matcher.excluded(relative, is_dir):
+                    continue
+                if is_dir:
+                    pending.append(relative)
+                else:
+                    files.add(relative)
+
+        return files
+
+    def changes(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[
+                offset + EVENT_HEADER.size : offset + EVENT_HEADER.size + length
+            ]
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return RESCAN
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs:
+                continue
+
+            name = os.fsdecode(name.rstrip(b"\0"))
+            relative_dir = self.dirs[wd]
+            relative = f"{relative_dir}/{name}" if relative_dir else name
+            is_dir = bool(mask & IN_ISDIR)
+
+            if self.matcher.excluded(relative, is_dir):
+                continue
+
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # files may have been created before the watch was in place
+                changed.update(self.add_tree(relative))
+
+            changed.add(relative)
+
+        return changed
+
+    def rescan(self):
+        # after an overflow: the folders created in the meantime are not watched yet (existing watches keep their wd)
+        self.dirs = {}
+        self.add_tree("")
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback for systems without inotify: periodically compares the tree with its previous state."""
+
+    def __init__(self, root: Path, matcher: ExclusionMatcher, interval: float = 1.0):
+        self.root = root
+        self.matcher = matcher
+        self.interval = interval
+        self.states = self.scan()
+
+    def scan(self):
+        return {
+            path: (stat.st_size, stat.st_mtime_ns, stat.st_mode)
+            for path, stat in walk(self.root, self.matcher)
+        }
+
+    def changes(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.monotonic(), 0))
+            time.sleep(wait)
+
+            states = self.scan()
+            changed = {
+                path
+                for path in states.keys() | self.states.keys()
+                if states.get(path) != self.states.get(path)
+            }
+            self.states = states
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def rescan(self):
+        self.states = self.scan()
+
+    def close(self):
+        pass
+
+
+class WatchCommand(PsyncBaseCommand):
+    name = "watch"
+
+    def parser(self) -> Optional[ArgumentParser]:
+        parser = ArgumentParser(
+            description="Pushes the files of the current folder as soon as they change."
+        )
+
+        parser.add_argument("destination", default=None, nargs="?")
+        parser.add_argument(
+            "-x",
+            "--exclude",
+            nargs="+",
+            type=str,
+            help="Exclusion patterns provided to rsync",
+        )
+        parser.add_argument(
+            "--no-ignore",
+            action="store_true",
+            help="Do not apply the exclusions of .gitignore/.psyncignore files",
+        )
+        parser.add_argument(
+            "-p",
+            "--port",
+            type=int,
+            default=None,
+            help="SSH port to use (not needed in case of a host configured via ssh config)",
+        )
+        parser.add_argument(
+            "-c", "--compress", action="store_true", help="Activates rsync compression"
+        )
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete files from the replica when they are deleted locally",
+        )
+        parser.add_argument(
+            "--debounce",
+            type=float,
+            default=0.2,
+            help="Seconds without new changes before pushing them",
+        )
+        parser.add_argument(
+            "--poll",
+            action="store_true",
+            help="Poll the folder for changes instead of relying on inotify",
+        )
+        parser.add_argument("--debug", action="store_true")
+
+        return parser
+
+    def run(self, config):
+        # the options used by PushCommand which cannot be set here
+        config.remote = config.local = None
+        config.files = []
+
+        push = PushCommand()
+        dest = (
+            pconf.replicas[config.destination]
+            if config.destination is not None
+            else pconf.default_replica
+        )
+        transfer = push.transfer(config, dest)
+        root = Path(transfer.local)
+        matcher = push.matcher(config, root, dest)
+
+        if config.poll or not InotifyWatcher.available():
+            watcher = PollingWatcher(root, matcher)
+        else:
+            watcher = InotifyWatcher(root, matcher)
+
+        get_manager().open(transfer.host)
+        print(f"Watching {root} -> {dest.alias} (Ctrl+C to stop)")
+
+        try:
+            while True:
+                batch = watcher.changes()
+
+                # debouncing: waits for the burst of events to be over
+                while batch is not RESCAN:
+                    more = watcher.changes(config.debounce)
+                    if more is RESCAN:
+                        batch = RESCAN
+                    elif len(more) > 0:
+                        batch |= more
+                        continue
+                    break
+
+                if batch is RESCAN:
+                    # before the push, so that what changes during it is not missed
+                    watcher.rescan()
+                self.push(config, transfer, root, batch)
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    @staticmethod
+    def push(config, transfer, root: Path, batch: Optional[Set[str]]):
+        start = time.perf_counter()
+        timestamp = datetime.now().strftime("%H:%M:%S")
+
+        if batch is RESCAN:
+            print(f"[{timestamp}] too many changes, pushing the whole folder")
+            run(transfer.command(), capture_stdout=False, stderr=INHERIT).check()
+            return
+
+        existing = sorted(path for path in batch if os.path.lexists(root / path))
+        deleted = sorted(path for path in batch if not os.path.lexists(root / path))
+        if len(existing) == 0 and (len(deleted) == 0 or not config.delete):
+            return
+
+        if len(existing) > 0:
+            files_from = write_files_from(existing)
+            try:
+                # no recursion: new folders come with the list of their files
+                command = transfer.command(files_from, recursive=False)
+                if config.debug:
+                    print("Executing", shlex.join(command))
+                if not run(command).check():
+                    return
+            finally:
+                os.remove(files_from)
+
+        if len(deleted) > 0 and config.delete:
+            remote_root = transfer.remote_path
+            paths = [f"{remote_root}{path}" for path in deleted]
+            transfer.host.run_remote(["rm", "-rf", "--"] + paths).check()
+
+        elapsed = time.perf_counter() - start
+        n_deleted = len(deleted) if config.delete else 0
+        print(
+            f"[{timestamp}] pushed {len(existing)} file(s), deleted {n_deleted} in {elapsed:.2f}s"
+        )
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from psync.shards import ListingEntry, make_shards, parse_listing
+
+LISTING = """\
+drwxr-xr-x          4,096 2021/06/01 12:00:00 .
+drwxr-xr-x          4,096 2021/06/01 12:00:00 data
+-rw-r--r--      1,234,567 2021/06/01 12:30:45 data/big file.bin
+-rwxr-x---             12 2021/06/02 08:00:00 run.sh
+lrwxrwxrwx              7 2021/06/03 09:15:00 latest -> data/big file.bin
+"""
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_parse_listing(utc):
+    entries = parse_listing(LISTING)
+
+    assert entries == [
+        ListingEntry("d", "data", 4096, 1622548800, "rwxr-xr-x"),
+        ListingEntry("-", "data/big file.bin", 1234567, 1622550645, "rw-r--r--"),
+        ListingEntry("-", "run.sh", 12, 1622620800, "rwxr-x---"),
+        ListingEntry("l", "latest", 7, 1622711700, "rwxrwxrwx"),
+    ]
+    assert entries[2].mode == 0o750
+
+
+def test_parse_listing_reads_local_time(monkeypatch):
+    line = "-rw-r--r--  1 2021/06/01 12:00:00 a"
+    monkeypatch.setenv("TZ", "Europe/Rome")
+    time.tzset()
+    try:
+        (entry,) = parse_listing(line)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    # 12:00 in Rome (summer time) is 10:00 UTC
+    assert entry.mtime == 1622541600
+
+
+def test_parse_listing_skips_other_lines():
+    output = "receiving incremental file list\n\nsent 1,234 bytes  received 56 bytes\n"
+
+    assert parse_listing(output) == []
+
+
+def file(path: str, size: int) -> ListingEntry:
+    return ListingEntry("-", path, size)
+
+
+def test_make_shards_balances_sizes():
+    entries = [file(str(size), size) for size in (1, 2, 3, 4, 5, 6, 7, 8, 9, 10)]
+
+    shards = make_shards(entries, 3)
+
+    sizes = [sum(int(path) for path in shard) for shard in shards]
+    assert sorted(path for shard in shards for path in shard) == sorted(
+        entry.path for entry in entries
+    )
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_make_shards_puts_large_files_apart():
+    entries = [file("huge", 1000), file("big", 900)] + [
+        file(f"small{i}", 1) for i in range(10)
+    ]
+
+    first, second = make_shards(entries, 2)
+
+    assert first[0] == "huge"
+    assert second[0] == "big"
+    # the small files even out the difference
+    assert len(second) == 11
+
+
+def test_make_shards_keeps_folders_in_the_first_shard():
+    entries = [ListingEntry("d", "empty", 4096), file("a", 10), file("b", 10)]
+
+    shards = make_shards(entries, 2)
+
+    assert shards == [["empty", "a"], ["b"]]
+
+
+def test_make_shards_drops_empty_shards():
+    assert make_shards([file("a", 1)], 4) == [["a"]]
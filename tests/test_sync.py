@@ -0,0 +1,135 @@
+from psync.sync import LOCAL, NEWER, REMOTE, REPORT, SyncDiff, resolve, three_way
+
+OLD, OURS, THEIRS = (10, 100), (20, 200), (30, 300)
+
+
+def test_unchanged_files_are_synced():
+    diff = three_way({"a": OLD}, {"a": OLD}, {"a": OLD}, delete=False)
+
+    assert diff == SyncDiff(synced={"a": OLD})
+
+
+def test_one_sided_edits_go_the_other_way():
+    local = {"ours": OURS, "theirs": OLD}
+    remote = {"ours": OLD, "theirs": THEIRS}
+    base = {"ours": OLD, "theirs": OLD}
+
+    diff = three_way(local, remote, base, delete=False)
+
+    assert diff.push == ["ours"]
+    assert diff.pull == ["theirs"]
+    assert diff.conflicts == []
+
+
+def test_new_files_are_copied_over():
+    diff = three_way({"new": OURS}, {"other": THEIRS}, {}, delete=False)
+
+    assert diff.push == ["new"]
+    assert diff.pull == ["other"]
+
+
+def test_edits_on_both_sides_conflict():
+    diff = three_way({"a": OURS}, {"a": THEIRS}, {"a": OLD}, delete=False)
+
+    assert diff.conflicts == ["a"]
+    assert diff.push == diff.pull == []
+
+
+def test_files_created_on_both_sides_conflict():
+    diff = three_way({"a": OURS}, {"a": THEIRS}, {}, delete=False)
+
+    assert diff.conflicts == ["a"]
+
+
+def test_deletes_are_copied_back_without_delete():
+    local = {"kept": OLD}
+    remote = {"gone": OLD}
+    base = {"kept": OLD, "gone": OLD}
+
+    diff = three_way(local, remote, base, delete=False)
+
+    assert diff.push == ["kept"]
+    assert diff.pull == ["gone"]
+
+
+def test_deletes_are_propagated_with_delete():
+    local = {"kept": OLD}
+    remote = {"gone": OLD}
+    base = {"kept": OLD, "gone": OLD}
+
+    diff = three_way(local, remote, base, delete=True)
+
+    # pushing a file missing here deletes it on the replica, and vice versa
+    assert diff.push == ["gone"]
+    assert diff.pull == ["kept"]
+    assert diff.conflicts == []
+
+
+def test_delete_against_edit_conflicts():
+    # each file is edited on one side and deleted on the other
+    local = {"edited-here": OURS}
+    remote = {"edited-there": THEIRS}
+    base = {"edited-here": OLD, "edited-there": OLD}
+
+    diff = three_way(local, remote, base, delete=True)
+    assert diff.conflicts == ["edited-here", "edited-there"]
+
+    # without delete, the edits are simply copied back
+    diff = three_way(local, remote, base, delete=False)
+    assert (diff.push, diff.pull, diff.conflicts) == (
+        ["edited-here"],
+        ["edited-there"],
+        [],
+    )
+
+
+def test_deleted_on_both_sides_is_nothing_to_do():
+    diff = three_way({}, {}, {"a": OLD}, delete=True)
+
+    assert diff == SyncDiff()
+
+
+def conflicts(*paths: str) -> SyncDiff:
+    return SyncDiff(conflicts=list(paths))
+
+
+def test_report_leaves_conflicts():
+    diff = conflicts("a")
+
+    resolve(diff, {"a": OURS}, {"a": THEIRS}, REPORT)
+
+    assert diff.conflicts == ["a"]
+    assert diff.push == diff.pull == []
+
+
+def test_local_and_remote_pick_a_side():
+    local, remote = {"a": OURS}, {"a": THEIRS}
+
+    diff = conflicts("a")
+    resolve(diff, local, remote, LOCAL)
+    assert (diff.push, diff.pull, diff.conflicts) == (["a"], [], [])
+
+    diff = conflicts("a")
+    resolve(diff, local, remote, REMOTE)
+    assert (diff.push, diff.pull, diff.conflicts) == ([], ["a"], [])
+
+
+def test_newer_keeps_the_latest_edit():
+    local = {"ours": (1, 500), "theirs": (1, 100)}
+    remote = {"ours": (2, 400), "theirs": (2, 600)}
+    diff = conflicts("ours", "theirs")
+
+    resolve(diff, local, remote, NEWER)
+
+    assert diff.push == ["ours"]
+    assert diff.pull == ["theirs"]
+    assert diff.conflicts == []
+
+
+def test_newer_prefers_edits_to_deletes():
+    diff = conflicts("deleted-here", "deleted-there")
+
+    resolve(diff, {"deleted-there": OLD}, {"deleted-here": OLD}, NEWER)
+
+    assert diff.push == ["deleted-there"]
+    assert diff.pull == ["deleted-here"]